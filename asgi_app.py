@@ -0,0 +1,232 @@
+"""ASGI entry point for the enhanced app.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5001
+
+Routes that wait (for yt-dlp extraction or for progress) are served by
+coroutines: extraction runs on a thread pool and progress listeners just wait
+on the event loop, so thousands of idle progress connections don't need a
+thread each. Every other route is passed through to the Flask app unchanged.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+import enhanced_app as core
+from profiling import current_trace
+from progress_events import ProgressEventStream
+
+# yt-dlp extraction runs here, off the event loop
+extract_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_EXTRACT_WORKERS', 8)))
+
+# Routes without an async version run in the Flask app on this many threads
+flask_app = WSGIMiddleware(core.app, workers=int(os.environ.get('ASGI_WSGI_WORKERS', 10)))
+
+
+async def run_blocking(func, *args):
+    """Run func on the extraction pool, within the current request's trace (and profile, if it's profiled)"""
+    trace = current_trace()
+    if trace is not None:
+        func = functools.partial(trace.run, func, *args)
+        args = ()
+    return await asyncio.get_running_loop().run_in_executor(extract_pool, functools.partial(contextvars.copy_context().run, func, *args))
+
+
+def client_id(request):
+    """Identify the requesting client for fair scheduling, like get_client_id in the Flask app"""
+    client_id, request.state.client_cookie = core.client_from_cookie(request.cookies.get(core.CLIENT_COOKIE))
+    return client_id
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def get_video_info(request):
+    payload, status_code = await run_blocking(core.video_info_payload, await read_json(request), client_id(request))
+    return JSONResponse(payload, status_code)
+
+
+async def forward_download(request):
+    """Response passing a /download request to Flask if it isn't one for the async handler, else None"""
+    body = await request.body()
+    data = {}
+    if request.method == 'POST':
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            pass
+    if request.method == 'GET' or not isinstance(data, dict) or data.get('stream') or not data.get('url') or not data.get('format_id'):
+        # Streaming downloads and invalid requests are handled by Flask, hand it the body we already read
+        return forward(body, request.receive)
+    request.state.data = data
+    return None
+
+
+async def download(request):
+    payload, status_code = await run_blocking(core.queue_download, request.state.data, client_id(request))
+    return JSONResponse(payload, status_code)
+
+
+async def progress_stream_events(job_id):
+    """Async version of enhanced_app.progress_stream_events"""
+    stream = ProgressEventStream(job_id, core.progress_broker, core.download_status, core.progress_store.status)
+    yield stream.RETRY
+
+    while True:
+        event = stream.next_event()
+        if event:
+            yield event
+            if stream.finished:
+                return
+            await asyncio.sleep(core.PROGRESS_STREAM_INTERVAL)
+        elif await core.progress_broker.wait_async(job_id, stream.version, timeout=stream.wait_timeout()) == stream.version:
+            keep_alive = stream.idle()
+            if keep_alive:
+                yield keep_alive
+
+
+async def progress_stream(request):
+    job_id = core.get_job_id(request.query_params)
+
+    if not job_id:
+        return JSONResponse({'error': 'Job ID is required'}, 400)
+
+    return StreamingResponse(progress_stream_events(job_id), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def progress_poll(request):
+    job_id = core.get_job_id(request.query_params)
+    try:
+        since = int(request.query_params.get('since', -1))
+    except ValueError:
+        return JSONResponse({'error': 'since must be a number'}, 400)
+
+    if not job_id:
+        return JSONResponse({'error': 'Job ID is required'}, 400)
+
+    if core.progress_store.status(job_id) is None:
+        return JSONResponse({'status': 'error', 'error': 'Unknown job'}, 404)
+
+    version = core.progress_broker.version(job_id)
+    if version <= since:
+        version = await core.progress_broker.wait_async(job_id, since, timeout=25)
+
+    payload, status_code = core.download_status(job_id)
+    payload['version'] = version
+    return JSONResponse(payload, status_code)
+
+
+async def check_download_status(request):
+    job_id = core.get_job_id(request.query_params)
+
+    if not job_id:
+        return JSONResponse({'error': 'Job ID or video ID is required'}, 400)
+
+    payload, status_code = core.download_status(job_id)
+    return JSONResponse(payload, status_code)
+
+
+async def get_download_progress(request):
+    return JSONResponse(core.progress_with_queue_info(core.get_job_id(request.query_params)))
+
+
+ROUTES = {
+    ('/get_video_info', 'POST'): get_video_info,
+    ('/download', 'GET'): download,
+    ('/download', 'POST'): download,
+    ('/progress/stream', 'GET'): progress_stream,
+    ('/progress/poll', 'GET'): progress_poll,
+    ('/check_download_status', 'GET'): check_download_status,
+    ('/get_download_progress', 'GET'): get_download_progress,
+}
+
+
+def forward(body, receive):
+    """Response that runs a request whose body was already read through the Flask app"""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    class FlaskResponse:
+        async def __call__(self, scope, receive, send):
+            await flask_app(scope, replay, send)
+
+    return FlaskResponse()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Journaled jobs are registered before the first request can ask for them
+                core.start_recovery()
+                await send({'type': 'lifespan.startup.complete'})
+                core.start_warm_up()
+            elif message['type'] == 'lifespan.shutdown':
+                extract_pool.shutdown(wait=False)
+                core.ydl_pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    handler = ROUTES.get((scope.get('path'), scope.get('method'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await flask_app(scope, receive, send)
+        return
+
+    request = Request(scope, receive)
+    if handler is download:
+        # Requests passed through to Flask are traced by the Flask app, not here as well
+        flask_response = await forward_download(request)
+        if flask_response is not None:
+            await flask_response(scope, receive, send)
+            return
+    trace = None
+    if scope['path'] not in core.UNTRACED_PATHS:
+        # Only the blocking work handed to run_blocking is profiled, the event loop is shared with other requests
+        trace = core.profiler.start(f"{scope['method']} {scope['path']}", profile=core.wants_profile(request.headers), enable=False)
+    error = None
+    try:
+        response = await handler(request)
+    except Exception as e:
+        error = str(e)
+        print(f"Error in {scope['path']}: {str(e)}")
+        print(traceback.format_exc())
+        response = JSONResponse({'error': str(e)}, 500)
+    if trace is not None:
+        core.profiler.finish(trace, status=response.status_code, error=error)
+        if trace.spans:
+            response.headers['Server-Timing'] = ', '.join(f"{s['name']};dur={s['seconds'] * 1000:.1f}" for s in trace.spans)
+        if trace.profiler is not None:
+            response.headers['X-Profile-Id'] = trace.trace_id
+    cookie = getattr(request.state, 'client_cookie', None)
+    if cookie:
+        response.set_cookie(core.CLIENT_COOKIE, cookie, max_age=core.CLIENT_COOKIE_MAX_AGE, httponly=True, samesite='lax')
+    await response(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print("YouTube Offline Downloader starting (ASGI)...")
+    uvicorn.run(app, host='0.0.0.0', port=5001)
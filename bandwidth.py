@@ -0,0 +1,195 @@
+import threading
+import time
+
+from scheduler import PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_BACKGROUND
+
+# Share of the global limit a job gets relative to the other running jobs, by scheduler priority
+WEIGHTS = {PRIORITY_INTERACTIVE: 8, PRIORITY_BULK: 1, PRIORITY_BACKGROUND: 0.25}
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk', PRIORITY_BACKGROUND: 'background'}
+
+# A job may get ahead of its rate by this many seconds' worth of bytes
+BURST_SECONDS = 0.5
+
+# Longest single sleep, so cancellations and changed limits are noticed quickly
+MAX_SLEEP = 0.25
+
+# Default for arguments of BandwidthGovernor.configure that should stay as they are
+_UNCHANGED = object()
+
+
+class Lease:
+    """One running job's token bucket, refilled at the rate the governor allocates to it"""
+
+    def __init__(self, governor, job_id, priority, cancelled=None):
+        self.governor = governor
+        self.job_id = job_id
+        self.priority = priority
+        self.cancelled = cancelled or (lambda: False)
+        self.limit = None
+        self.rate = None
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._reported = {}
+
+    def _refill(self, now):
+        # Called with the governor's lock held
+        if self.rate is None:
+            self._tokens = 0.0
+        else:
+            burst = max(self.rate * BURST_SECONDS, 64 * 1024)
+            self._tokens = min(burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, amount):
+        """Account for amount bytes received, sleeping until the job is back within its allocation"""
+        lock = self.governor._lock
+        with lock:
+            self._refill(time.monotonic())
+            if self.rate is None:
+                return
+            self._tokens -= amount
+
+        while not self.cancelled():
+            with lock:
+                self._refill(time.monotonic())
+                if self.rate is None or self._tokens >= 0:
+                    return
+                wait = -self._tokens / self.rate
+            time.sleep(min(wait, MAX_SLEEP))
+
+    def progress_hook(self, d):
+        """yt-dlp progress hook throttling a download, works for several streams sharing the lease"""
+        if d.get('status') != 'downloading':
+            return
+        downloaded = d.get('downloaded_bytes') or 0
+        key = d.get('tmpfilename') or d.get('filename')
+        with self.governor._lock:
+            previous = self._reported.get(key, 0)
+            self._reported[key] = downloaded
+        # A smaller count means yt-dlp started the stream over
+        received = downloaded - previous if downloaded >= previous else downloaded
+        if received > 0:
+            self.consume(received)
+
+    def release(self):
+        self.governor._release(self)
+
+
+class BandwidthGovernor:
+    """Shares a global download rate between running jobs.
+
+    Each job holds a Lease while it downloads and is throttled to the rate
+    allocated to it. The global limit is divided in proportion to the jobs'
+    priority weights (see WEIGHTS). A job is never given more than its own
+    limit, and what its limit leaves of its share goes to the other jobs.
+    Without a global limit jobs are only held to their own limits. A limit of
+    0 or None means unlimited. Limits can be changed at any time and take
+    effect on running jobs.
+    """
+
+    def __init__(self, global_limit=0, job_limit=0):
+        self.global_limit = global_limit or None
+        self.job_limit = job_limit or None
+        self._job_limits = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, job_id, priority=PRIORITY_INTERACTIVE, cancelled=None, limit=None):
+        """Register a job that is about to download and return its Lease, limit overrides the per-job limit"""
+        lease = Lease(self, job_id, priority, cancelled)
+        with self._lock:
+            self._leases[job_id] = lease
+            if limit:
+                self._job_limits[job_id] = limit
+            self._allocate()
+        return lease
+
+    def promote(self, job_id, priority):
+        """Give a running job another priority, and the default per-job limit instead of its own"""
+        with self._lock:
+            lease = self._leases.get(job_id)
+            if lease is None:
+                return
+            lease.priority = priority
+            self._job_limits.pop(job_id, None)
+            self._allocate()
+
+    def _release(self, lease):
+        with self._lock:
+            if self._leases.get(lease.job_id) is lease:
+                del self._leases[lease.job_id]
+                self._job_limits.pop(lease.job_id, None)
+                self._allocate()
+
+    def throttle(self, chunks, job_id, priority=PRIORITY_INTERACTIVE):
+        """Pass chunks through, no faster than the rate allocated to job_id"""
+        lease = self.acquire(job_id, priority)
+        try:
+            for chunk in chunks:
+                lease.consume(len(chunk))
+                yield chunk
+        finally:
+            lease.release()
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def configure(self, global_limit=_UNCHANGED, job_limit=_UNCHANGED, job_id=None, limit=_UNCHANGED):
+        """Change the global limit, the default per-job limit, or the limit of one running job"""
+        with self._lock:
+            if global_limit is not _UNCHANGED:
+                self.global_limit = global_limit or None
+            if job_limit is not _UNCHANGED:
+                self.job_limit = job_limit or None
+            if job_id is not None and limit is not _UNCHANGED:
+                if job_id not in self._leases:
+                    raise KeyError(job_id)
+                self._job_limits[job_id] = limit or None
+            self._allocate()
+
+    def _allocate(self):
+        # Called with the lock held: weighted max-min fair shares, capped by each job's limit
+        now = time.monotonic()
+        pending = []
+        for lease in self._leases.values():
+            lease._refill(now)
+            lease.limit = self._job_limits.get(lease.job_id, self.job_limit)
+            lease.rate = lease.limit
+            pending.append(lease)
+        if not self.global_limit:
+            return
+
+        remaining = float(self.global_limit)
+        while pending:
+            total_weight = sum(WEIGHTS.get(lease.priority, 1) for lease in pending)
+            share = {lease: remaining * WEIGHTS.get(lease.priority, 1) / total_weight for lease in pending}
+            capped = [lease for lease in pending if lease.limit is not None and lease.limit <= share[lease]]
+            if not capped:
+                for lease in pending:
+                    lease.rate = share[lease]
+                return
+            for lease in capped:
+                remaining -= lease.limit
+                pending.remove(lease)
+
+    def allocation(self, job_id):
+        """Bytes per second currently allocated to a job, None if unlimited or not downloading"""
+        with self._lock:
+            lease = self._leases.get(job_id)
+            return None if lease is None or lease.rate is None else round(lease.rate)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'global_limit': self.global_limit,
+                'job_limit': self.job_limit,
+                'jobs': [
+                    {
+                        'job_id': lease.job_id,
+                        'priority': PRIORITY_NAMES.get(lease.priority, lease.priority),
+                        'limit': lease.limit,
+                        'allocation': None if lease.rate is None else round(lease.rate),
+                    }
+                    for lease in self._leases.values()
+                ],
+            }
@@ -0,0 +1,195 @@
+import threading
+import time
+import uuid
+
+from codec_plan import pair_audio
+from formats import FormatTable
+from metadata_cache import canonical_video_id
+
+def _watch_url(entry):
+    url = entry.get('url') or entry.get('webpage_url')
+    if url and url.startswith(('http://', 'https://')):
+        return url
+    return f"https://www.youtube.com/watch?v={entry.get('id')}"
+
+
+def _flatten(ydl, result, items, max_items, depth=0):
+    """Collect the videos of a (possibly nested) flat playlist result"""
+    if len(items) >= max_items or not result:
+        return
+    if result.get('_type') in ('playlist', 'multi_video'):
+        for entry in result.get('entries') or []:
+            _flatten(ydl, entry, items, max_items, depth)
+            if len(items) >= max_items:
+                return
+    elif result.get('_type') == 'url' and result.get('ie_key') not in (None, 'Youtube'):
+        # A channel tab or a playlist inside a playlist, list its videos too
+        if depth < 2:
+            _flatten(ydl, ydl.extract_info(result['url'], download=False), items, max_items, depth + 1)
+    else:
+        item = {'video_id': result.get('id'), 'url': _watch_url(result), 'title': result.get('title')}
+        if result.get('formats'):
+            # A fully extracted single video, no need to extract it again
+            item['info'] = result
+        items.append(item)
+
+
+def expand_urls(urls, ydl_opts, max_items=500):
+    """Turn video, playlist and channel URLs into a list of videos.
+
+    Plain video URLs are used as they are. Everything else goes through yt-dlp's
+    flat extraction, which lists a playlist's videos in a single request instead
+    of extracting every one of them.
+    """
+    import yt_dlp
+
+    items = []
+    flat_opts = dict(ydl_opts, extract_flat='in_playlist')
+    with yt_dlp.YoutubeDL(flat_opts) as ydl:
+        for url in urls:
+            if len(items) >= max_items:
+                break
+            video_id = canonical_video_id(url)
+            if video_id and 'list=' not in url:
+                items.append({'video_id': video_id, 'url': url, 'title': None})
+                continue
+            _flatten(ydl, ydl.extract_info(url, download=False), items, max_items)
+
+    # The same video can appear in several of the given playlists
+    seen = set()
+    unique = []
+    for item in items:
+        key = item['video_id'] or item['url']
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+    return unique
+
+
+def select_format(info_dict, quality='best'):
+    """Pick a format ID for a batch item.
+
+    quality is 'best', 'audio' or the highest video height to accept (e.g. 720).
+    """
+    formats = info_dict.get('formats') or []
+    if quality == 'audio':
+        audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+        if not audio:
+            return None
+        return max(audio, key=lambda f: f.get('abr') or 0)['format_id']
+
+    max_height = None if quality in (None, '', 'best') else int(quality)
+    video = [
+        f for f in formats
+        if f.get('vcodec') not in (None, 'none') and f.get('height')
+        and (max_height is None or f['height'] <= max_height)
+    ]
+    if not video:
+        return None
+    return max(video, key=lambda f: (f['height'], f.get('fps') or 0, f.get('tbr') or 0))['format_id']
+
+
+def estimate_size(info_dict, format_id):
+    """Expected output size in bytes for a format, including the audio merged into video-only formats"""
+    table = FormatTable(info_dict)
+    selected = table.get(format_id)
+    if selected is None:
+        return 0
+    entry = selected['entry']
+    size = entry.get('filesize') or entry.get('filesize_approx') or 0
+    if not selected['is_audio_only'] and not selected['has_audio']:
+        # The same audio stream plan_download merges the video with
+        _, audio = pair_audio(entry, table.audio_by_family, table.best_audio)
+        if audio:
+            size += audio.get('filesize') or audio.get('filesize_approx') or 0
+    return size
+
+
+class Batch:
+    """A group of downloads queued together, with progress aggregated over all its items"""
+
+    def __init__(self, urls, quality='best', client_id='anonymous'):
+        self.batch_id = uuid.uuid4().hex
+        self.urls = urls
+        self.quality = quality
+        self.client_id = client_id
+        # Subscribes the batch to its downloads, so cancelling it leaves downloads other clients wait for alone
+        self.subscriber = f"batch:{self.batch_id}"
+        self.status = 'expanding'
+        self.error = None
+        self.cancelled = False
+        self.items = []
+        self.created = time.time()
+        self._lock = threading.Lock()
+
+    def set_items(self, items):
+        with self._lock:
+            self.items = [
+                {
+                    'video_id': item['video_id'],
+                    'url': item['url'],
+                    'title': item.get('title'),
+                    'status': 'pending',
+                    'job_id': None,
+                    'total_bytes': 0,
+                }
+                for item in items
+            ]
+
+    def update_item(self, index, **values):
+        with self._lock:
+            self.items[index].update(values)
+
+    def summary(self, get_progress):
+        """Aggregate and per-item progress, get_progress(job_id) returns a job's progress dict"""
+        with self._lock:
+            items = [dict(item) for item in self.items]
+
+        done = failed = 0
+        bytes_done = bytes_total = 0
+        speed = 0
+        for item in items:
+            if item['job_id']:
+                progress = get_progress(item['job_id'])
+                status = progress.get('status')
+                # Progress entries are replaced as a download moves on, so remember the largest total seen
+                item['total_bytes'] = max(item['total_bytes'], progress.get('total_bytes') or 0)
+                item['status'] = status
+                item['percent'] = progress.get('percent', 0)
+                if progress.get('error'):
+                    item['error'] = progress['error']
+                if status == 'downloading':
+                    bytes_done += min(progress.get('downloaded_bytes') or 0, item['total_bytes'])
+                    speed += progress.get('speed') or 0
+            status = item['status']
+            if status == 'complete':
+                done += 1
+                bytes_done += item['total_bytes']
+            elif status in ('error', 'cancelled'):
+                failed += 1
+            bytes_total += item['total_bytes'] if status not in ('error', 'cancelled') else 0
+
+        with self._lock:
+            for index, item in enumerate(items):
+                self.items[index]['total_bytes'] = item['total_bytes']
+
+        remaining = max(bytes_total - bytes_done, 0)
+        if self.cancelled:
+            status = 'cancelled'
+        elif self.status == 'queued' and done + failed == len(items):
+            status = 'complete'
+        else:
+            status = self.status
+        return {
+            'batch_id': self.batch_id,
+            'status': status,
+            'error': self.error,
+            'items_total': len(items),
+            'items_done': done,
+            'items_failed': failed,
+            'bytes_done': bytes_done,
+            'bytes_total': bytes_total,
+            'speed': speed,
+            'eta': round(remaining / speed, 2) if speed and remaining else None,
+            'items': items,
+        }
@@ -0,0 +1,80 @@
+"""Benchmark building the format table from recorded info dicts.
+
+Runs offline against the JSON fixtures in benchmarks/fixtures, plus copies of
+them blown up to very large format lists. Pass --budget-us to fail (exit code
+1) when building a table takes longer than that many microseconds per format,
+e.g. in CI.
+
+    python benchmarks/bench_formats.py
+    python benchmarks/bench_formats.py --budget-us 5
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from formats import FormatTable
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Sizes the recorded format lists are scaled up to
+LARGE_SIZES = (1000, 10000)
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json'))):
+        with open(path) as f:
+            fixtures[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+    return fixtures
+
+
+def scaled(info_dict, size):
+    """Copy of info_dict with its formats repeated (under new IDs) until there are size of them"""
+    formats = info_dict['formats']
+    large = copy.deepcopy(info_dict)
+    large['formats'] = []
+    for i in range(size):
+        entry = dict(formats[i % len(formats)])
+        entry['format_id'] = f"{entry['format_id']}-{i}"
+        large['formats'].append(entry)
+    return large
+
+
+def bench(name, info_dict, budget_us):
+    count = len(info_dict['formats'])
+    number = max(1, 20000 // count)
+    build = min(timeit.repeat(lambda: FormatTable(info_dict), number=number, repeat=5)) / number
+
+    table = FormatTable(info_dict)
+    format_ids = [entry['format_id'] for entry in info_dict['formats']]
+    lookup = min(timeit.repeat(lambda: [table.get(format_id) for format_id in format_ids], number=number, repeat=5))
+    lookup /= number * count
+
+    per_format_us = build / count * 1e6
+    slow = budget_us is not None and per_format_us > budget_us
+    print(f"{name:<28} {count:>6} formats  build {build * 1e3:9.3f} ms ({per_format_us:6.2f} us/format)"
+          f"  lookup {lookup * 1e9:7.1f} ns{'  OVER BUDGET' if slow else ''}")
+    return not slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-us', type=float, help='maximum build time per format, in microseconds')
+    args = parser.parse_args()
+
+    ok = True
+    for name, info_dict in load_fixtures().items():
+        ok &= bench(name, info_dict, args.budget_us)
+        for size in LARGE_SIZES:
+            ok &= bench(f"{name} x{size}", scaled(info_dict, size), args.budget_us)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
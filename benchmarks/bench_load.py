@@ -0,0 +1,243 @@
+"""Load test the whole download flow offline, against the local YouTube stand-in.
+
+Starts benchmarks/fake_youtube.py in-process and the app in a subprocess
+whose yt-dlp extracts from it. Then --users concurrent users each run the
+real flow --iterations times: POST /get_video_info, POST /download,
+long-poll /progress/poll until the job finishes, and GET /download_file.
+Every flow uses a new video ID unless --same-video is given.
+
+For each scenario (a format to download) this reports flows per second, p50
+and p99 latency of the whole flow and of each step, and the CPU time and
+peak memory of the app process. The app is restarted with an empty media
+store for every scenario.
+
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --users 20 --bandwidth 2000000 --latency 0.05 --server asgi
+    python benchmarks/bench_load.py --scenarios progressive --json results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_serving import ROOT, SERVERS, free_port, process_stats, wait_until_up
+from fake_youtube import FakeYoutube, serve
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+
+# Format downloaded by each scenario
+SCENARIOS = {
+    'progressive': '18',  # video with audio, no post-processing
+    'audio': '140',       # DASH audio only
+    'dash': '137',        # DASH video, merged with audio by ffmpeg
+}
+
+STEPS = ('info', 'queue', 'wait', 'file')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process so far, from /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except OSError:
+        return None
+
+
+def peak_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class User:
+    """One simulated browser, keeping its connection to the app open like a browser would"""
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data) if data is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def flow(self, video_id, format_id):
+        """Run one full download flow, returning the seconds spent in each step"""
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        timings = {}
+
+        start = time.perf_counter()
+        status, body = self.request('POST', '/get_video_info', {'url': url})
+        if status != 200:
+            raise RuntimeError(f"/get_video_info returned {status}: {body[:200]}")
+        timings['info'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        status, body = self.request('POST', '/download', {'url': url, 'format_id': format_id})
+        if status != 200:
+            raise RuntimeError(f"/download returned {status}: {body[:200]}")
+        job_id = json.loads(body)['job_id']
+        timings['queue'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        version = -1
+        while True:
+            status, body = self.request('GET', f"/progress/poll?job_id={job_id}&since={version}")
+            progress = json.loads(body)
+            version = progress.get('version', version)
+            if progress.get('status') == 'complete':
+                break
+            if progress.get('status') in ('error', 'cancelled'):
+                raise RuntimeError(f"Download {progress.get('status')}: {progress.get('error')}")
+        timings['wait'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        status, body = self.request('GET', f"/download_file?job_id={job_id}")
+        if status != 200:
+            raise RuntimeError(f"/download_file returned {status}")
+        timings['file'] = time.perf_counter() - start
+        return timings
+
+
+def run_scenario(name, args, fake_url):
+    port = free_port()
+    env = dict(
+        os.environ,
+        FAKE_YOUTUBE_URL=fake_url,
+        MEDIA_STORE_DIR=tempfile.mkdtemp(prefix='bench-store-'),
+        PYTHONPATH=os.pathsep.join(filter(None, [PLUGINS_DIR, ROOT, os.environ.get('PYTHONPATH')])),
+    )
+    process = subprocess.Popen(SERVERS[args.server](port), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    flows = []
+    failures = []
+    lock = threading.Lock()
+
+    def user(index):
+        client = User(port)
+        for iteration in range(args.iterations):
+            video_id = 'load0000000' if args.same_video else f"u{index:04d}i{iteration:05d}"
+            start = time.perf_counter()
+            try:
+                timings = client.flow(video_id, SCENARIOS[name])
+                timings['flow'] = time.perf_counter() - start
+                with lock:
+                    flows.append(timings)
+            except Exception as e:
+                with lock:
+                    failures.append(str(e))
+
+    try:
+        wait_until_up(port)
+        cpu_before = cpu_seconds(process.pid)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        cpu_after = cpu_seconds(process.pid)
+        stats = process_stats(process.pid)
+        peak = peak_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+    result = {
+        'scenario': name,
+        'server': args.server,
+        'users': args.users,
+        'flows': len(flows),
+        'failures': len(failures),
+        'seconds': round(elapsed, 2),
+        'flows_per_second': round(len(flows) / elapsed, 2),
+        'cpu_seconds': round(cpu_after - cpu_before, 2) if cpu_before is not None and cpu_after is not None else None,
+        'threads': stats.get('threads'),
+        'rss_mb': stats.get('rss_mb'),
+        'peak_rss_mb': peak,
+    }
+    for step in STEPS + ('flow',):
+        values = [timings[step] for timings in flows]
+        if values:
+            result[f"{step}_p50_ms"] = round(statistics.median(values) * 1000, 1)
+            result[f"{step}_p99_ms"] = round(percentile(values, 0.99) * 1000, 1)
+    if failures:
+        result['first_failure'] = failures[0]
+    return result
+
+
+def report(result):
+    print(f"{result['scenario']:<12} {result['flows']:>4} flows  {result['failures']:>3} failed  "
+          f"{result['flows_per_second']:6.2f} flows/s  "
+          f"flow p50 {result.get('flow_p50_ms', 0):8.1f} ms  p99 {result.get('flow_p99_ms', 0):8.1f} ms  "
+          f"cpu {result['cpu_seconds']} s  peak rss {result['peak_rss_mb']} MB")
+    print('             ' + '  '.join(
+        f"{step} p50/p99 {result.get(f'{step}_p50_ms', 0)}/{result.get(f'{step}_p99_ms', 0)} ms" for step in STEPS))
+    if result.get('first_failure'):
+        print(f"             first failure: {result['first_failure']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10, help='concurrent users')
+    parser.add_argument('--iterations', type=int, default=3, help='flows each user runs one after the other')
+    parser.add_argument('--scenarios', default=None,
+                        help='comma separated list of: ' + ', '.join(SCENARIOS) + ' (dash needs ffmpeg)')
+    parser.add_argument('--server', default='flask', choices=sorted(SERVERS))
+    parser.add_argument('--bandwidth', type=int, default=0, help='stand-in bytes per second per connection, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in seconds before every response')
+    parser.add_argument('--seconds', type=int, default=10, help='length of the test media')
+    parser.add_argument('--same-video', action='store_true', help='every flow downloads the same video')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    fake = FakeYoutube(seconds=args.seconds, bandwidth=args.bandwidth, latency=args.latency)
+    server = serve(fake)
+    print(f"Fake YouTube on {server.url}, {'encoded' if fake.real_media else 'random'} media, "
+          f"bandwidth {args.bandwidth or 'unlimited'}, latency {args.latency} s")
+
+    if args.scenarios:
+        names = [name.strip() for name in args.scenarios.split(',')]
+    else:
+        # Merging random bytes fails, so the merge scenario needs encoded media
+        names = [name for name in SCENARIOS if fake.real_media or name != 'dash']
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenario: {', '.join(unknown)}")
+
+    results = []
+    for name in names:
+        result = run_scenario(name, args, server.url)
+        report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    server.shutdown()
+    if any(result['failures'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Compare the Flask development server with the ASGI server under idle progress connections.
+
+For each server this starts the app on a local port, opens --idle long-poll
+connections to /progress/poll (which wait for progress that never comes, like
+browsers following downloads), and then measures /check_download_status
+latency while they are held open. It also reports the server's thread count
+and memory use. No network access or YouTube requests are needed.
+
+    python benchmarks/bench_serving.py
+    python benchmarks/bench_serving.py --idle 2000 --requests 500 --servers asgi
+"""
+import argparse
+import http.client
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SERVERS = {
+    'flask': lambda port: [sys.executable, '-c', f"import enhanced_app; enhanced_app.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/scheduler/stats')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} didn't start")
+
+
+def process_stats(pid):
+    """Thread count and resident memory (MB) of a process, from /proc"""
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'Threads':
+                    stats['threads'] = int(value)
+                elif key == 'VmRSS':
+                    stats['rss_mb'] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return stats
+
+
+def open_idle_connections(port, count):
+    sockets = []
+    for i in range(count):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(f"GET /progress/poll?job_id=idle-{i}&since=0 HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+        sockets.append(s)
+    return sockets
+
+
+def measure_latency(port, requests):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        connection.request('GET', f"/check_download_status?job_id=bench-{i}")
+        connection.getresponse().read()
+        latencies.append((time.perf_counter() - start) * 1000)
+    connection.close()
+    return latencies
+
+
+def bench(name, idle, requests):
+    port = free_port()
+    env = dict(os.environ, MEDIA_STORE_DIR=tempfile.mkdtemp(prefix='bench-store-'))
+    process = subprocess.Popen(SERVERS[name](port), cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sockets = []
+    try:
+        wait_until_up(port)
+        baseline = process_stats(process.pid)
+
+        start = time.perf_counter()
+        sockets = open_idle_connections(port, idle)
+        # Give the server a moment to accept everything
+        time.sleep(1)
+        opened = time.perf_counter() - start
+
+        latencies = measure_latency(port, requests)
+        loaded = process_stats(process.pid)
+        latencies.sort()
+        print(f"{name:<6} idle={idle:<5} open {opened:6.2f} s  "
+              f"status p50 {statistics.median(latencies):7.2f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1]:7.2f} ms  "
+              f"threads {baseline.get('threads')} -> {loaded.get('threads')}  "
+              f"rss {baseline.get('rss_mb')} -> {loaded.get('rss_mb')} MB")
+    finally:
+        for s in sockets:
+            s.close()
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--idle', type=int, default=1000, help='idle progress connections to hold open')
+    parser.add_argument('--requests', type=int, default=200, help='status requests to time')
+    parser.add_argument('--servers', default='flask,asgi', help='comma separated list of: ' + ', '.join(SERVERS))
+    args = parser.parse_args()
+
+    # Every idle connection is a file descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.idle + 100 > hard:
+        print(f"Warning: the open file limit ({hard}) is too low for {args.idle} connections")
+
+    for name in args.servers.split(','):
+        bench(name.strip(), args.idle, args.requests)
+
+
+if __name__ == '__main__':
+    main()
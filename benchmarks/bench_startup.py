@@ -0,0 +1,115 @@
+"""Measure how long the app takes to start, and how long its first real request takes.
+
+For each variant the app is started --runs times in a subprocess, and this
+reports the time from spawning it to its first HTTP response, and from then
+to the first POST /get_video_info answered through the local YouTube
+stand-in (benchmarks/fake_youtube.py), which includes loading yt-dlp unless
+a warm-up already did. The first request is sent --delay seconds after the
+app is up, the time a user takes to paste a URL. The import time of
+enhanced_app is reported too.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --variants flask,flask-no-warmup --runs 10 --delay 0
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_serving import ROOT, free_port, wait_until_up
+from fake_youtube import FakeYoutube, serve
+from bench_load import PLUGINS_DIR, User
+
+# Command and extra environment of each variant
+VARIANTS = {
+    'flask': (lambda port: [sys.executable, 'enhanced_app.py'], {'FLASK_DEBUG': '0', 'WARMUP': '1'}),
+    'flask-no-warmup': (lambda port: [sys.executable, 'enhanced_app.py'], {'FLASK_DEBUG': '0', 'WARMUP': '0'}),
+    'flask-debug': (lambda port: [sys.executable, 'enhanced_app.py'], {'FLASK_DEBUG': '1', 'WARMUP': '1'}),
+    'asgi': (lambda port: [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1',
+                           '--port', str(port), '--log-level', 'warning'], {'WARMUP': '1'}),
+}
+
+
+def import_seconds():
+    """Time to import enhanced_app in a fresh interpreter"""
+    code = "import time; t = time.perf_counter(); import enhanced_app; print(time.perf_counter() - t)"
+    env = dict(os.environ, MEDIA_STORE_DIR=tempfile.mkdtemp(prefix='bench-store-'))
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def start_once(name, fake_url, delay, run):
+    command, extra = VARIANTS[name]
+    port = free_port()
+    env = dict(
+        os.environ,
+        **extra,
+        PORT=str(port),
+        FAKE_YOUTUBE_URL=fake_url,
+        MEDIA_STORE_DIR=tempfile.mkdtemp(prefix='bench-store-'),
+        PYTHONPATH=os.pathsep.join(filter(None, [PLUGINS_DIR, ROOT, os.environ.get('PYTHONPATH')])),
+    )
+    start = time.perf_counter()
+    # A new session, so the reloader's child process is stopped along with it
+    process = subprocess.Popen(command(port), cwd=ROOT, env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        up = time.perf_counter() - start
+        time.sleep(delay)
+        begin = time.perf_counter()
+        status, body = User(port).request('POST', '/get_video_info',
+                                          {'url': f"https://www.youtube.com/watch?v=start{run:06d}"})
+        if status != 200:
+            raise RuntimeError(f"/get_video_info returned {status}: {body[:200]}")
+        return up, time.perf_counter() - begin
+    finally:
+        os.killpg(process.pid, 15)
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--variants', default=','.join(VARIANTS), help='comma separated list of: ' + ', '.join(VARIANTS))
+    parser.add_argument('--runs', type=int, default=5, help='starts of each variant')
+    parser.add_argument('--delay', type=float, default=1.0, help='seconds between the app coming up and the first request')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.variants.split(',')]
+    unknown = [name for name in names if name not in VARIANTS]
+    if unknown:
+        parser.error(f"Unknown variant: {', '.join(unknown)}")
+
+    server = serve(FakeYoutube(seconds=1))
+    imports = [import_seconds() for _ in range(args.runs)]
+    print(f"import enhanced_app  median {statistics.median(imports) * 1000:7.1f} ms")
+
+    results = [{'variant': 'import', 'import_ms': round(statistics.median(imports) * 1000, 1)}]
+    for name in names:
+        ups, firsts = zip(*(start_once(name, server.url, args.delay, run) for run in range(args.runs)))
+        result = {
+            'variant': name,
+            'runs': args.runs,
+            'up_ms': round(statistics.median(ups) * 1000, 1),
+            'first_info_ms': round(statistics.median(firsts) * 1000, 1),
+            'up_max_ms': round(max(ups) * 1000, 1),
+            'first_info_max_ms': round(max(firsts) * 1000, 1),
+        }
+        print(f"{name:<19} up median {result['up_ms']:7.1f} ms (max {result['up_max_ms']:7.1f})  "
+              f"first info median {result['first_info_ms']:7.1f} ms (max {result['first_info_max_ms']:7.1f})")
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
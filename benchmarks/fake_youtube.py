@@ -0,0 +1,233 @@
+"""Local stand-in for YouTube, for benchmarks that must run offline.
+
+Serves the recorded info dict in benchmarks/fixtures/standard_video.json for
+any video ID, reduced to three formats whose streams point back at this
+server: 18 (progressive MP4 with audio), 137 (DASH video) and 140 (DASH
+audio). The DASH formats are served in fragments. Every response waits
+--latency seconds first and is sent at no more than --bandwidth bytes per
+second per connection.
+
+The media are real test clips encoded with ffmpeg when it is installed, and
+random bytes of the same sizes otherwise (enough for downloads, but merging
+and transcoding them will fail).
+
+The app finds the stand-in through the yt-dlp plugin in benchmarks/plugins,
+which handles YouTube URLs whenever FAKE_YOUTUBE_URL is set:
+
+    python benchmarks/fake_youtube.py --port 8900 --bandwidth 5000000 --latency 0.05
+    FAKE_YOUTUBE_URL=http://127.0.0.1:8900 PYTHONPATH=benchmarks/plugins python enhanced_app.py
+"""
+import argparse
+import copy
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'standard_video.json')
+
+# Formats kept from the fixture, and the file each is served from
+MEDIA = {'18': 'progressive.mp4', '137': 'video.mp4', '140': 'audio.m4a'}
+
+# Formats that are served in fragments, like YouTube's DASH streams
+FRAGMENTED = ('137', '140')
+
+FRAGMENT_SIZE = 512 * 1024
+
+
+def make_media(directory, seconds):
+    """Write the test media for each format into directory and return their paths"""
+    paths = {format_id: os.path.join(directory, name) for format_id, name in MEDIA.items()}
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        video = ['-f', 'lavfi', '-i', f"testsrc2=size=1920x1080:rate=30:duration={seconds}"]
+        audio = ['-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}"]
+        h264 = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+        commands = {
+            '137': [*video, *h264],
+            '140': [*audio, '-c:a', 'aac'],
+            '18': [*video, *audio, *h264, '-s', '640x360', '-c:a', 'aac'],
+        }
+        for format_id, args in commands.items():
+            subprocess.run([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', *args, paths[format_id]], check=True)
+    else:
+        # About the bitrates of the real formats
+        sizes = {'18': 62_000, '137': 550_000, '140': 16_000}
+        for format_id, bytes_per_second in sizes.items():
+            with open(paths[format_id], 'wb') as f:
+                f.write(os.urandom(bytes_per_second * seconds))
+    return paths
+
+
+class FakeYoutube:
+    """The stand-in's media and settings, shared by all request handlers"""
+
+    def __init__(self, media_dir=None, seconds=10, bandwidth=0, latency=0.0):
+        self.media_dir = media_dir or tempfile.mkdtemp(prefix='fake-youtube-')
+        self.seconds = seconds
+        self.paths = make_media(self.media_dir, seconds)
+        self.real_media = shutil.which('ffmpeg') is not None
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        with open(FIXTURE) as f:
+            self.fixture = json.load(f)
+
+    def info(self, base_url, video_id):
+        """Info dict for video_id, with its formats served by this stand-in"""
+        info = {key: value for key, value in self.fixture.items() if key != 'formats'}
+        info.update(id=video_id, title=f"{info.get('title', 'Video')} ({video_id})", duration=self.seconds,
+                    webpage_url=f"https://www.youtube.com/watch?v={video_id}")
+        info['formats'] = []
+        for recorded in self.fixture['formats']:
+            format_id = recorded['format_id']
+            if format_id not in MEDIA:
+                continue
+            entry = copy.deepcopy(recorded)
+            size = os.path.getsize(self.paths[format_id])
+            entry.pop('filesize_approx', None)
+            entry.update(filesize=size, tbr=round(size * 8 / 1000 / self.seconds, 1),
+                         url=f"{base_url}/media/{format_id}", protocol='https')
+            if format_id in FRAGMENTED:
+                count = -(-size // FRAGMENT_SIZE)
+                entry.update(
+                    protocol='http_dash_segments',
+                    fragment_base_url=f"{base_url}/media/{format_id}/",
+                    fragments=[{'path': f"frag/{i}", 'duration': self.seconds / count} for i in range(count)],
+                )
+            info['formats'].append(entry)
+        return info
+
+    def count(self, sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def do_GET(self):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        base_url = f"http://{self.headers.get('Host')}"
+
+        match = re.fullmatch(r'/info/([0-9A-Za-z_-]{11})\.json', self.path)
+        if match:
+            body = json.dumps(self.fake.info(base_url, match.group(1))).encode()
+            return self.send_body(200, body, 'application/json', 0, len(body))
+
+        match = re.fullmatch(r'/media/(\w+)(?:/frag/(\d+))?', self.path)
+        if not match or match.group(1) not in self.fake.paths:
+            return self.send_body(404, b'Not found', 'text/plain', 0, 9)
+
+        path = self.fake.paths[match.group(1)]
+        size = os.path.getsize(path)
+        start, end = 0, size
+        if match.group(2) is not None:
+            start = int(match.group(2)) * FRAGMENT_SIZE
+            end = min(start + FRAGMENT_SIZE, size)
+            if start >= size:
+                return self.send_body(404, b'Not found', 'text/plain', 0, 9)
+
+        status = 200
+        requested = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if requested:
+            first = start + int(requested.group(1))
+            last = start + int(requested.group(2)) + 1 if requested.group(2) else end
+            if first >= end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{end - start}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            content_range = f"bytes {first - start}-{min(last, end) - 1}/{end - start}"
+            start, end, status = first, min(last, end), 206
+        else:
+            content_range = None
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self.send_body(status, f, 'application/octet-stream', start, end, content_range)
+
+    def send_body(self, status, body, content_type, start, end, content_range=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+        if isinstance(body, bytes):
+            self.wfile.write(body)
+            self.fake.count(len(body))
+            return
+
+        # Send in small chunks, pausing to stay under the bandwidth limit
+        remaining = end - start
+        chunk_size = 64 * 1024
+        began = time.perf_counter()
+        sent = 0
+        try:
+            while remaining > 0:
+                chunk = body.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                remaining -= len(chunk)
+                if self.fake.bandwidth:
+                    ahead = sent / self.fake.bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.fake.count(sent)
+
+
+def serve(fake, host='127.0.0.1', port=0):
+    """Start the stand-in on a background thread and return the server (its URL is server.url)"""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--seconds', type=int, default=10, help='length of the test media')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second per connection, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every response')
+    args = parser.parse_args()
+
+    fake = FakeYoutube(seconds=args.seconds, bandwidth=args.bandwidth, latency=args.latency)
+    server = serve(fake, args.host, args.port)
+    print(f"Fake YouTube on {server.url} ({'encoded' if fake.real_media else 'random'} media in {fake.media_dir})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
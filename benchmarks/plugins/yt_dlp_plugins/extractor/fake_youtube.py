@@ -0,0 +1,23 @@
+"""yt-dlp plugin that sends YouTube extraction to the local stand-in in benchmarks/fake_youtube.py.
+
+yt-dlp loads plugins from the yt_dlp_plugins package on PYTHONPATH and tries
+them before its own extractors. This one only matches while FAKE_YOUTUBE_URL
+is set, so having it on the path changes nothing otherwise.
+"""
+import os
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class FakeYoutubeIE(InfoExtractor):
+    IE_NAME = 'fakeyoutube'
+    _VALID_URL = r'https?://(?:(?:www|m)\.)?(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/)|youtu\.be/)(?P<id>[0-9A-Za-z_-]{11})'
+
+    @classmethod
+    def suitable(cls, url):
+        return bool(os.environ.get('FAKE_YOUTUBE_URL')) and super().suitable(url)
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        base_url = os.environ['FAKE_YOUTUBE_URL'].rstrip('/')
+        return self._download_json(f"{base_url}/info/{video_id}.json", video_id)
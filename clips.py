@@ -0,0 +1,88 @@
+class ClipError(ValueError):
+    """Raised when a requested time range or chapter doesn't fit the video"""
+
+
+def parse_timestamp(value):
+    """Seconds for a timestamp such as 90, "90", "1:30", "01:02:03.5" or "1m30s", None if empty"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    from yt_dlp.utils import parse_duration
+    seconds = parse_duration(str(value).strip())
+    if seconds is None:
+        raise ClipError(f"Invalid timestamp: {value}")
+    return float(seconds)
+
+
+def format_timestamp(seconds):
+    """Filename-safe label for a position, e.g. 1h02m03s or 4m05s"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    return f"{minutes}m{seconds:02d}s"
+
+
+def resolve_clip(info_dict, start=None, end=None, chapters=None):
+    """Work out the part of a video to download.
+
+    Either start/end timestamps or chapter titles (a list, or a comma separated
+    string, matched case-insensitively) can be given. Several chapters are
+    downloaded as the one range that spans them. Returns None for the whole
+    video, otherwise a dict with start, end, duration and a label.
+    """
+    duration = info_dict.get('duration')
+
+    if isinstance(chapters, str):
+        chapters = [name.strip() for name in chapters.split(',')]
+    chapters = [name for name in chapters or [] if name]
+
+    if chapters:
+        by_title = {(chapter.get('title') or '').strip().lower(): chapter for chapter in info_dict.get('chapters') or []}
+        missing = [name for name in chapters if name.strip().lower() not in by_title]
+        if missing:
+            raise ClipError(f"Unknown chapter: {', '.join(missing)}")
+        selected = [by_title[name.strip().lower()] for name in chapters]
+        start = min(chapter['start_time'] for chapter in selected)
+        end = max(chapter['end_time'] for chapter in selected)
+    else:
+        start = parse_timestamp(start)
+        end = parse_timestamp(end)
+        if start is None and end is None:
+            return None
+        start = start or 0.0
+        if end is None:
+            if not duration:
+                raise ClipError('An end time is required for videos of unknown length')
+            end = duration
+
+    if start < 0 or end <= start:
+        raise ClipError('The end of a clip must come after its start')
+    if duration:
+        if start >= duration:
+            raise ClipError('The clip starts after the end of the video')
+        end = min(end, duration)
+        if start == 0 and end == duration:
+            return None
+
+    return {
+        'start': start,
+        'end': end,
+        'duration': end - start,
+        'label': f"{format_timestamp(start)}-{format_timestamp(end)}",
+    }
+
+
+def clip_ydl_opts(clip):
+    """yt-dlp options that only fetch the clip's part of the video.
+
+    The cut is made on the nearest keyframes with a stream copy, so no
+    re-encoding is needed and the clip may start slightly early.
+    """
+    from yt_dlp.utils import download_range_func
+    return {
+        'download_ranges': download_range_func(None, [(clip['start'], clip['end'])]),
+        'force_keyframes_at_cuts': False,
+    }
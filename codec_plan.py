@@ -0,0 +1,123 @@
+import re
+
+# Containers that can hold these video and audio codec families as they are, in order of preference
+CONTAINERS = [
+    ('mp4', ('avc1', 'h264', 'hev1', 'hvc1', 'av01'), ('mp4a',)),
+    ('webm', ('vp9', 'vp09', 'vp8', 'av01'), ('opus', 'vorbis')),
+]
+
+
+class PlanError(ValueError):
+    """Raised when a format can't be downloaded"""
+
+
+def codec_family(codec):
+    """Codec name without its profile and level, e.g. avc1.640028 -> avc1"""
+    return (codec or '').split('.')[0].lower()
+
+
+def _abr(entry):
+    abr = entry.get('abr')
+    return abr if isinstance(abr, (int, float)) else 0
+
+
+def pair_audio(video_entry, audio_by_family, best_audio):
+    """Container and audio stream to merge a video-only format with, without re-encoding either.
+
+    The first container that can hold the video codec and has an audio stream
+    of a compatible codec wins; otherwise the video is paired with the best
+    audio overall in Matroska, which holds anything. audio_by_family maps codec
+    families to the best audio format of that family.
+    """
+    family = codec_family(video_entry.get('vcodec'))
+    for container, video_codecs, audio_codecs in CONTAINERS:
+        if family in video_codecs:
+            candidates = [audio_by_family[codec] for codec in audio_codecs if codec in audio_by_family]
+            if candidates:
+                return container, max(candidates, key=_abr)
+    if best_audio is None:
+        return video_entry.get('ext') or 'mp4', None
+    return 'mkv', best_audio
+
+
+def plan_download(table, format_id, audio_format='original'):
+    """How to download format_id from a FormatTable.
+
+    Returns a dict with the yt-dlp format string, the output extension, the
+    media store profile, the ffmpeg arguments of a transcode to run after the
+    download (None when there is none) and a description of the transcode
+    (None when everything is stream-copied).
+    audio_format 'mp3' converts audio-only downloads to MP3, anything else
+    keeps the original m4a or webm/opus stream.
+    """
+    selected = table.get(format_id)
+    if selected is None:
+        raise PlanError(f"Format {format_id} is not available")
+    entry = selected['entry']
+
+    if selected['is_audio_only']:
+        if audio_format == 'mp3':
+            return {
+                'format': format_id,
+                'ext': 'mp3',
+                'profile': 'mp3-192',
+                'ffmpeg_args': ['-vn', '-c:a', 'libmp3lame', '-b:a', '192k'],
+                'transcode': f"{codec_family(entry.get('acodec'))} audio to MP3",
+            }
+        # The audio stream is saved exactly as YouTube serves it
+        return {
+            'format': format_id,
+            'ext': entry.get('ext') or 'm4a',
+            'profile': 'audio-copy',
+            'ffmpeg_args': None,
+            'transcode': None,
+        }
+
+    if selected['has_audio']:
+        return {
+            'format': format_id,
+            'ext': entry.get('ext') or 'mp4',
+            'profile': 'copy',
+            'ffmpeg_args': None,
+            'transcode': None,
+        }
+
+    container, audio = pair_audio(entry, table.audio_by_family, table.best_audio)
+    if audio is None:
+        # Nothing to merge with, keep the video as it is
+        return {
+            'format': format_id,
+            'ext': container,
+            'profile': 'copy',
+            'ffmpeg_args': None,
+            'transcode': None,
+        }
+    return {
+        'format': f"{format_id}+{audio['format_id']}",
+        'video_format_id': format_id,
+        'audio_format_id': audio['format_id'],
+        'ext': container,
+        'profile': f"remux-{container}",
+        'ffmpeg_args': None,
+        'transcode': None,
+    }
+
+
+def plan_local_audio(plan, format_id, entries):
+    """Stored artifact an audio-only download can be taken from instead of downloading it again.
+
+    entries are the (key, entry) pairs of the video's media store artifacts.
+    A merge made by plan_download holds the audio stream format_id exactly as
+    YouTube serves it, and so does an unconverted audio download when an MP3
+    is wanted. Returns the artifact's key and the ffmpeg arguments that take
+    its audio track out (a stream copy, or plan's MP3 transcode), or None.
+    """
+    for key, entry in entries:
+        stored_format = entry.get('format') or ''
+        profile = entry.get('profile') or ''
+        # Clips have the clip appended to their profile and only hold part of the audio
+        merged = stored_format.endswith(f"+{format_id}") and re.fullmatch(r'remux-\w+', profile)
+        copied = stored_format == format_id and profile == 'audio-copy' and plan['profile'] != 'audio-copy'
+        if merged or copied:
+            return key, ['-map', '0:a:0', *(plan['ffmpeg_args'] or ['-vn', '-c:a', 'copy'])]
+    return None
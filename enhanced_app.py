@@ -1,23 +1,235 @@
 import os
 import re
+import atexit
+import hmac
+import copy
 import json
 import traceback
 import random
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, Response, g, request, jsonify, render_template, send_file
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+from itsdangerous import BadSignature, URLSafeSerializer
 import tempfile
-import yt_dlp
 import time
+import socket
 import threading
+import functools
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from metadata_cache import MetadataCache, canonical_video_id
+from media_store import MediaStore
+from journal import JobJournal
+from scheduler import DownloadScheduler, PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_BACKGROUND
+from progress_events import ProgressBroker, ProgressEventStream
+from progress_store import ProgressStore, FINAL_STATUSES
+from streaming import StreamError, plan_stream, iter_stream, tee
+from file_serving import content_disposition, media_etag, send_media_file
+from batch import Batch, expand_urls, select_format, estimate_size
+from formats import FormatTable
+from codec_plan import PlanError, plan_download, plan_local_audio
+from clips import ClipError, resolve_clip, clip_ydl_opts
+from parallel_fetch import FetchTuner, download_parallel
+from postprocess import PostProcessPool
+from metrics import CONTENT_TYPE, THROUGHPUT_BUCKETS, MetricsRegistry
+from profiling import Profiler, span
+from ydl_pool import YoutubeDLPool
+from bandwidth import BandwidthGovernor
+from prefetch import Prefetcher
+from thumbnails import DEFAULT_WIDTH, VIDEO_ID, ThumbnailCache, ThumbnailError, ThumbnailFetchError, pick_source, thumbnail_url
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)
 
+# How finished files are sent: '' (by this server, with sendfile where supported),
+# 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' (Apache/lighttpd X-Sendfile)
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '')
+# nginx internal location that maps to the media store directory, for 'x-accel'
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-media/')
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+
+# Signs the client_id cookie that identifies a browser for fair scheduling and cancellation. Without
+# SECRET_KEY a random key is used, so clients get new IDs when the server restarts
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(32)
+CLIENT_COOKIE = 'client_id'
+CLIENT_COOKIE_MAX_AGE = 365 * 24 * 3600
+client_signer = URLSafeSerializer(app.secret_key, salt='client-id')
+
 # Temporary storage for downloads
 TEMP_DIR = tempfile.gettempdir()
 
-# Dictionary to store download progress
-download_progress = {}
+# Wakes up progress stream and long-poll listeners whenever a job's progress changes
+progress_broker = ProgressBroker()
+
+# Download progress, keyed by job ID. Finished jobs are forgotten after PROGRESS_TTL seconds
+progress_store = ProgressStore(
+    ttl=int(os.environ.get('PROGRESS_TTL', 3600)),
+    max_entries=int(os.environ.get('PROGRESS_MAX_ENTRIES', 10000)),
+    min_interval=float(os.environ.get('PROGRESS_HOOK_INTERVAL', 0.25)),
+    on_change=progress_broker.publish
+)
+
+# Minimum seconds between two progress stream events, bursts of updates in between are coalesced
+PROGRESS_STREAM_INTERVAL = float(os.environ.get('PROGRESS_STREAM_INTERVAL', 0.5))
+
+# Cache of extracted video metadata shared by /get_video_info and /download
+metadata_cache = MetadataCache(
+    ttl=int(os.environ.get('METADATA_CACHE_TTL', 1800)),
+    max_entries=int(os.environ.get('METADATA_CACHE_SIZE', 256))
+)
+
+# Managed store of finished downloads, deduplicated by video, format and post-processing profile
+media_store = MediaStore(
+    os.environ.get('MEDIA_STORE_DIR', os.path.join(TEMP_DIR, 'youtube-offline-store')),
+    max_bytes=int(os.environ.get('MEDIA_STORE_MAX_BYTES', 10 * 1024 ** 3)),
+    policy=os.environ.get('MEDIA_STORE_POLICY', 'lru')
+)
+
+# Every job's URL, format, options and state, on the media store's volume so jobs survive a restart
+job_journal = JobJournal(os.environ.get('JOB_JOURNAL', os.path.join(media_store.root, 'jobs.sqlite3')))
+
+# Finished jobs are dropped from the journal this many seconds after they finished
+JOB_JOURNAL_RETENTION = int(os.environ.get('JOB_JOURNAL_RETENTION', 7 * 24 * 3600))
+
+# Resized thumbnails, and the images they were made from, in their own bounded store
+thumbnail_cache = ThumbnailCache(MediaStore(
+    os.environ.get('THUMBNAIL_CACHE_DIR', os.path.join(TEMP_DIR, 'youtube-offline-thumbnails')),
+    max_bytes=int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+))
+
+# Access times are written in batches, save the last ones on a clean exit
+atexit.register(media_store.flush)
+atexit.register(thumbnail_cache.store.flush)
+
+# Seconds browsers and proxies may reuse a thumbnail without asking again
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 30 * 24 * 3600))
+
+# Store keys currently being downloaded (mapped to their job ID), so identical requests don't download twice
+active_downloads = {}
+active_downloads_lock = threading.Lock()
+
+# Journaled jobs registered after a restart that haven't been queued again yet, guarded by active_downloads_lock
+resuming_jobs = set()
+
+# Downloads run on a fixed pool of workers instead of one thread per request. Prefetches never take
+# the last one, since a running job isn't preempted when someone asks for a download
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 2))
+download_scheduler = DownloadScheduler(workers=DOWNLOAD_WORKERS, limits={PRIORITY_BACKGROUND: max(DOWNLOAD_WORKERS - 1, 0)})
+
+# Fetch the video and audio of DASH downloads at the same time ('0' to fetch them one after the other)
+PARALLEL_FETCH = os.environ.get('PARALLEL_FETCH', '1') != '0'
+
+# Merges and transcodes run on their own pool of niced ffmpeg processes, using at most
+# POSTPROCESS_CPU_BUDGET cores with POSTPROCESS_THREADS threads per process
+postprocess_pool = PostProcessPool(
+    cpu_budget=int(os.environ.get('POSTPROCESS_CPU_BUDGET', max(1, (os.cpu_count() or 2) // 2))),
+    threads_per_job=int(os.environ.get('POSTPROCESS_THREADS', 2)),
+    nice=int(os.environ.get('POSTPROCESS_NICE', 10))
+)
+
+# Download rate shared between running jobs, in bytes per second (0 for unlimited)
+bandwidth_governor = BandwidthGovernor(
+    global_limit=int(os.environ.get('BANDWIDTH_LIMIT', 0)),
+    job_limit=int(os.environ.get('BANDWIDTH_JOB_LIMIT', 0))
+)
+
+# Speculatively download the format a user will most likely pick while they read the format table
+PREFETCH = os.environ.get('PREFETCH', '0') == '1'
+if PREFETCH and DOWNLOAD_WORKERS < 2:
+    print("PREFETCH needs DOWNLOAD_WORKERS of 2 or more, prefetching is off")
+    PREFETCH = False
+
+# Download rate limit of each prefetch in bytes per second, 0 to only rely on its background priority
+PREFETCH_RATE_LIMIT = int(os.environ.get('PREFETCH_RATE_LIMIT', 0))
+
+prefetcher = Prefetcher(
+    max_jobs=int(os.environ.get('PREFETCH_MAX_JOBS', 2)),
+    max_bytes=int(os.environ.get('PREFETCH_MAX_BYTES', 500 * 1024 ** 2))
+)
+
+# Picks the number of fragments downloaded at once, from a connection budget shared by all running downloads
+fetch_tuner = FetchTuner(
+    budget=int(os.environ.get('FRAGMENT_BUDGET', 16)),
+    max_per_stream=int(os.environ.get('MAX_FRAGMENTS_PER_STREAM', 8))
+)
+
+# Streams run their own yt-dlp fetch (and ffmpeg for merges) outside the scheduler, so only this many at once
+STREAM_SLOTS = int(os.environ.get('STREAM_SLOTS', 4))
+stream_slots = threading.BoundedSemaphore(STREAM_SLOTS)
+
+# Store keys a streaming download is currently saving a copy of
+active_stream_copies = set()
+active_stream_copies_lock = threading.Lock()
+
+# What each job produces: video ID, media store key, display name and, once known, the exact output path
+download_jobs = {}
+
+# ID of the latest job for each video, for clients that still identify downloads by video ID
+video_jobs = {}
+
+# Batches of downloads, keyed by batch ID
+batches = {}
+
+# Metadata for batch items is fetched concurrently, but never by more than this many threads
+batch_info_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_INFO_WORKERS', 4)))
+
+# Most videos a single batch may contain
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+
+# Prometheus metrics for every stage of the pipeline, served on /metrics
+metrics = MetricsRegistry()
+extraction_seconds = metrics.histogram(
+    'youtube_offline_extraction_seconds', 'Time spent extracting video metadata with yt-dlp')
+queue_wait_seconds = metrics.histogram(
+    'youtube_offline_queue_wait_seconds', 'Time jobs waited for a free worker', ['stage'])
+download_seconds = metrics.histogram(
+    'youtube_offline_download_seconds', 'Time spent downloading the streams of a job')
+download_throughput = metrics.histogram(
+    'youtube_offline_download_throughput_bytes_per_second', 'Average download speed of a job', buckets=THROUGHPUT_BUCKETS)
+downloaded_bytes = metrics.counter(
+    'youtube_offline_downloaded_bytes_total', 'Bytes downloaded from YouTube')
+postprocess_seconds = metrics.histogram(
+    'youtube_offline_postprocess_seconds', 'Time spent merging or transcoding with ffmpeg', ['kind'])
+file_serve_seconds = metrics.histogram(
+    'youtube_offline_file_serve_seconds', 'Time spent preparing /download_file responses')
+served_bytes = metrics.counter(
+    'youtube_offline_served_bytes_total', 'Bytes of finished files sent by this server (not counting nginx X-Accel)')
+media_store_lookups = metrics.counter(
+    'youtube_offline_media_store_lookups_total', 'Download requests by how the media store answered them', ['result'])
+errors = metrics.counter(
+    'youtube_offline_errors_total', 'Failures by pipeline stage', ['stage'])
+metrics.gauge(
+    'youtube_offline_jobs', 'Jobs currently running or queued', ['stage', 'state'],
+    function=lambda: {
+        (stage, state): scheduler.stats()[state]
+        for stage, scheduler in (('download', download_scheduler), ('postprocess', postprocess_pool))
+        for state in ('running', 'queued')
+    })
+metrics.counter(
+    'youtube_offline_metadata_cache_lookups_total', 'Metadata cache lookups', ['result'],
+    function=lambda: {('hit',): metadata_cache.hits, ('miss',): metadata_cache.misses})
+metrics.counter(
+    'youtube_offline_prefetches_total', 'Prefetches by what became of them', ['outcome'],
+    function=prefetcher.counts)
+metrics.gauge(
+    'youtube_offline_media_store_bytes', 'Size of the files in the media store',
+    function=lambda: media_store.stats()['bytes'])
+
+# Span timings of every request and job, cProfile profiles when PROFILING is 'header' or 'all',
+# and a JSON line for everything slower than SLOW_REQUEST_SECONDS
+profiler = Profiler(
+    mode=os.environ.get('PROFILING', 'off'),
+    slow_seconds=float(os.environ.get('SLOW_REQUEST_SECONDS', 5)),
+    log_path=os.environ.get('SLOW_REQUEST_LOG') or None,
+    keep=int(os.environ.get('PROFILE_KEEP', 20))
+)
+
+# Requests that wait on purpose, so are never traced
+UNTRACED_PATHS = ('/progress/stream', '/progress/poll', '/metrics')
+
+# /admin endpoints require this token in the X-Admin-Token header, and are disabled without one
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
 # List of common desktop user agents to rotate
 USER_AGENTS = [
@@ -28,6 +240,73 @@ USER_AGENTS = [
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 11_5_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15',
 ]
 
+def client_from_cookie(cookie):
+    """(client ID, cookie value to set or None) for a client_id cookie, with a new ID if it's missing or not signed by us"""
+    if cookie:
+        try:
+            return client_signer.loads(cookie), None
+        except BadSignature:
+            pass
+    client_id = uuid.uuid4().hex
+    return client_id, client_signer.dumps(client_id)
+
+def get_client_id():
+    """Identify the requesting client for fair scheduling, by a cookie this server issued (addresses are shared behind a proxy)"""
+    if 'client_id' not in g:
+        g.client_id, g.client_cookie = client_from_cookie(request.cookies.get(CLIENT_COOKIE))
+    return g.client_id
+
+def is_admin(headers):
+    """Whether request headers carry the admin token, never true while ADMIN_TOKEN isn't set"""
+    token = headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def wants_profile(headers):
+    """Whether to profile a request, X-Profile only counts when it comes with the admin token"""
+    return profiler.wants_profile(headers if is_admin(headers) else None)
+
+def admin_denied():
+    """Error response for an admin request without the right token, None if it's allowed"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled, set ADMIN_TOKEN to use them'}), 403
+    if not is_admin(request.headers):
+        return jsonify({'error': 'Admin token required'}), 403
+    return None
+
+def get_job_id(args):
+    """Job ID from request arguments, accepting a video ID for the video's latest job"""
+    return args.get('job_id') or video_jobs.get(args.get('video_id'))
+
+def forget_job(job_id):
+    """Drop everything kept about a job once the progress store has evicted it"""
+    job = download_jobs.pop(job_id, None)
+    if job and video_jobs.get(job['video_id']) == job_id:
+        video_jobs.pop(job['video_id'], None)
+    progress_broker.forget(job_id)
+
+progress_store.on_evict = forget_job
+
+def progress_with_queue_info(job_id):
+    """Progress for a job, including queue position and estimated start while it waits"""
+    progress = progress_store.get(job_id) or {'status': 'unknown', 'percent': 0}
+    if progress.get('status') == 'queued':
+        position = download_scheduler.position(job_id)
+        if position is not None:
+            progress['queue_position'] = position + 1
+            progress['estimated_start'] = download_scheduler.estimated_start(job_id)
+        elif job_id not in resuming_jobs:
+            # Picked up by a worker but yt-dlp hasn't reported anything yet (resumed jobs stay
+            # queued until their video has been extracted again)
+            progress['status'] = 'starting'
+    elif progress.get('status') == 'downloading':
+        # Bytes per second the job may currently download at, None when it isn't limited
+        progress['bandwidth_allocation'] = bandwidth_governor.allocation(job_id)
+    elif progress.get('stage') == 'postprocess_queued':
+        position = postprocess_pool.position(job_id)
+        if position is not None:
+            progress['postprocess_queue_position'] = position + 1
+    return progress
+
 def get_random_user_agent():
     """Get a random user agent from the list"""
     return random.choice(USER_AGENTS)
@@ -36,49 +315,314 @@ def sanitize_filename(filename):
     """Remove invalid characters from filename"""
     return re.sub(r'[\\/*?:"<>|]', "", filename)
 
-# Progress hook for yt-dlp
-def progress_hook(d):
-    download_id = d.get('info_dict', {}).get('id', 'unknown')
+def build_filename(info_dict):
+    """Download file name (without extension) for a video: "Creator - Title", made safe for all platforms"""
+    title = info_dict.get('title', 'video')
+    uploader = info_dict.get('uploader', 'Unknown')
     
-    if d['status'] == 'downloading':
+    # Create filename with creator and title: "Creator - Title"
+    combined_name = f"{uploader} - {title}"
+    
+    # More thorough sanitization of filename
+    filename = sanitize_filename(combined_name)
+    # Replace problematic characters with safe alternatives
+    filename = filename.replace('+', ' plus ').replace('&', ' and ').replace("'", "")
+    # Remove any other potentially problematic characters
+    filename = re.sub(r'[^\w\s.-]', '', filename)
+    # Trim excessive spaces
+    return re.sub(r'\s+', ' ', filename).strip()
+
+def info_ydl_opts():
+    """Options for yt-dlp metadata extraction, with enhanced protections"""
+    return {
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': True,
+        'youtube_include_dash_manifest': True,
+        'nocheckcertificate': True,
+        'ignoreerrors': True,
+        'http_headers': {
+            'User-Agent': get_random_user_agent(),
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Sec-Fetch-Mode': 'navigate',
+        }
+    }
+
+def download_ydl_opts():
+    """Options shared by all downloads, the format, output template and hooks are set per job"""
+    return {
+        'verbose': True,
+        'overwrites': True,
+        'postprocessors': []
+    }
+
+# YoutubeDL instances reused between requests, with their extractors and HTTP connections.
+# Video and audio downloads have separate instances so each keeps connections to its own hosts
+ydl_pool = YoutubeDLPool(
+    profiles={'info': info_ydl_opts, 'video': download_ydl_opts, 'audio': download_ydl_opts},
+    user_agents=USER_AGENTS,
+    max_idle=int(os.environ.get('YDL_POOL_IDLE', 8)),
+    max_uses=int(os.environ.get('YDL_POOL_MAX_USES', 100))
+)
+
+def fetch_video_info(url):
+    """Get the yt-dlp info dict for a URL, only running extraction on a cache miss"""
+    video_id = canonical_video_id(url)
+    info_dict = metadata_cache.get(video_id)
+    if info_dict is not None:
+        print(f"Metadata cache hit for {video_id}")
+        return info_dict
+    
+    try:
+        with span('extract'), extraction_seconds.time(), ydl_pool.checkout('info') as ydl:
+            info_dict = ydl.extract_info(url, download=False)
+    except Exception:
+        errors.inc(stage='extract')
+        raise
+    
+    if not info_dict:
+        errors.inc(stage='extract')
+    else:
+        metadata_cache.put(info_dict.get('id') or video_id, info_dict)
+    return info_dict
+
+def warm_up():
+    """Load yt-dlp and its YouTube extractor, so the first request doesn't pay for it.
+
+    yt-dlp is only imported where it's used, which keeps it (and its extractors)
+    out of startup. Servers call this in the background once they are listening.
+    """
+    started = time.perf_counter()
+    with ydl_pool.checkout('info') as ydl:
+        ydl.get_info_extractor('Youtube')
+    print(f"yt-dlp loaded in {time.perf_counter() - started:.2f}s")
+
+def start_warm_up(port=None):
+    """Run warm_up on a background thread, after the server accepts connections on port if one is given"""
+    if os.environ.get('WARMUP', '1') == '0':
+        return
+    
+    def run():
+        deadline = time.time() + 30
+        while port and time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
         try:
-            total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-            downloaded_bytes = d.get('downloaded_bytes', 0)
-            
-            if total_bytes > 0:
-                percent = (downloaded_bytes / total_bytes) * 100
-                download_progress[download_id] = {
-                    'percent': round(percent, 2),
-                    'downloaded_bytes': downloaded_bytes,
-                    'total_bytes': total_bytes,
-                    'speed': d.get('speed', 0),
-                    'eta': round(d.get('eta', 0), 2),
-                    'status': 'downloading',
-                    'filename': d.get('filename', ''),
-                    'last_updated': time.time()
-                }
-            else:
-                download_progress[download_id] = {
-                    'percent': 0,
-                    'status': 'downloading',
+            warm_up()
+        except Exception as e:
+            print(f"Error warming up yt-dlp: {str(e)}")
+    
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
+
+def recover_jobs():
+    """Pick up where the previous process stopped, using the job journal, and return the jobs to resume.
+    
+    Jobs that finished within the progress TTL get their progress back, so their job IDs keep
+    working. Unfinished jobs are registered as queued right away, so clients reconnecting after
+    the restart can follow them; resume_jobs then queues them again.
+    """
+    pruned = job_journal.prune(JOB_JOURNAL_RETENTION)
+    if pruned:
+        print(f"Dropped {pruned} old jobs from the journal")
+    
+    for job in job_journal.finished(since=time.time() - progress_store.ttl):
+        if job['job_id'] in download_jobs or not media_store.get(job['store_key'], touch=False):
+            continue
+        download_jobs[job['job_id']] = {
+            'video_id': job['video_id'],
+            'store_key': job['store_key'],
+            'display_name': job['display_name'],
+            'output_path': job['output_path'],
+            'priority': job['priority'],
+            'bandwidth_limit': job['bandwidth_limit'],
+            'subscribers': set()
+        }
+        video_jobs[job['video_id']] = job['job_id']
+        set_progress(job['job_id'], {
+            'percent': 100,
+            'status': 'complete',
+            'last_updated': job['updated']
+        })
+    
+    resumable = []
+    dropped = []
+    for job in job_journal.unfinished():
+        job_id = job['job_id']
+        if job['priority'] == PRIORITY_BACKGROUND:
+            # A prefetch is a guess about what someone was going to do before the restart
+            job_journal.update(job_id, state='cancelled', error='Prefetch dropped on restart')
+            dropped.append(job)
+            continue
+        
+        download_jobs[job_id] = {
+            'video_id': job['video_id'],
+            'store_key': job['store_key'],
+            'display_name': job['display_name'],
+            'output_path': None,
+            'priority': job['priority'],
+            'bandwidth_limit': job['bandwidth_limit'],
+            'subscribers': {job['client_id']} if job['client_id'] else set()
+        }
+        video_jobs[job['video_id']] = job_id
+        with active_downloads_lock:
+            resuming_jobs.add(job_id)
+        set_progress(job_id, {
+            'percent': 0,
+            'status': 'queued',
+            'last_updated': time.time()
+        })
+        resumable.append(job)
+    
+    # A dropped prefetch may have been downloading the same file as a job that is kept
+    kept = {job['store_key'] for job in resumable}
+    for job in dropped:
+        if job['store_key'] and job['store_key'] not in kept:
+            media_store.discard_staging(job['store_key'])
+    return resumable
+
+def resume_jobs(jobs):
+    """Queue the jobs recover_jobs registered again, extracting each video anew"""
+    # Jobs left to resume per store key, whose staging directory must be kept for them
+    pending = Counter(job['store_key'] for job in jobs)
+    
+    for job in jobs:
+        job_id = job['job_id']
+        pending[job['store_key']] -= 1
+        if job_id not in resuming_jobs:
+            # Cancelled while it waited to be resumed
+            discard_staging_unless_used(job['store_key'], pending)
+            continue
+        
+        try:
+            info_dict = fetch_video_info(job['url'])
+            if not info_dict:
+                raise ValueError('Could not fetch video information')
+            if not take_resuming(job_id):
+                discard_staging_unless_used(job['store_key'], pending)
+                continue
+            payload = start_download(
+                info_dict,
+                job['format_id'],
+                job['client_id'] or 'anonymous',
+                priority=job['priority'],
+                clip=job['clip'],
+                audio_format=job['audio_format'] or 'original',
+                bandwidth_limit=job['bandwidth_limit'],
+                job_id=job_id,
+                resume=True
+            )
+            if payload['job_id'] != job_id:
+                # Another job is already producing the same file
+                set_progress(job_id, {
+                    'status': 'cancelled',
+                    'error': f"Same download as job {payload['job_id']}",
                     'last_updated': time.time()
-                }
+                })
+            print(f"Resumed job {job_id} ({job['video_id']}, format {job['format_id']}): {payload['message']}")
         except Exception as e:
-            print(f"Error in progress hook: {str(e)}")
+            take_resuming(job_id)
+            discard_staging_unless_used(job['store_key'], pending)
+            if progress_store.status(job_id) == 'cancelled':
+                continue
+            print(f"Error resuming job {job_id}: {str(e)}")
+            # Also marks the job failed in the journal, so the next start doesn't try it again
+            set_progress(job_id, {
+                'status': 'error',
+                'error': f"Could not resume after restart: {str(e)}",
+                'last_updated': time.time()
+            })
+
+def take_resuming(job_id):
+    """Remove a job from resuming_jobs, True if it was still waiting to be resumed"""
+    with active_downloads_lock:
+        if job_id in resuming_jobs:
+            resuming_jobs.remove(job_id)
+            return True
+        return False
+
+def discard_staging_unless_used(store_key, pending):
+    """Remove a staging directory no running job and no job still to be resumed downloads into"""
+    with active_downloads_lock:
+        in_use = store_key in active_downloads
+    if store_key and not in_use and not pending[store_key]:
+        media_store.discard_staging(store_key)
+
+def start_recovery():
+    """Register the journal's jobs now, then resume them on a background thread since that extracts each video again"""
+    jobs = recover_jobs()
+    
+    def run():
+        try:
+            resume_jobs(jobs)
+        except Exception as e:
+            print(f"Error recovering jobs: {str(e)}")
+            print(traceback.format_exc())
+    
+    threading.Thread(target=run, name='job-recovery', daemon=True).start()
+
+def set_progress(job_id, progress):
+    """Replace the progress entry for a job and notify anyone listening for it"""
+    progress_store.set(job_id, **progress)
+    job_journal.update(job_id, state=progress['status'], error=progress.get('error'))
+
+# Progress hook for yt-dlp, bound to a job with functools.partial
+def progress_hook(download_id, d):
+    if d['status'] == 'downloading':
+        # yt-dlp calls this many times a second, the store updates the job in place and throttles notifications
+        progress_store.update_bytes(
+            download_id,
+            d.get('downloaded_bytes') or 0,
+            d.get('total_bytes') or d.get('total_bytes_estimate'),
+            d.get('filename')
+        )
     
     elif d['status'] == 'finished':
-        download_progress[download_id] = {
+        set_progress(download_id, {
             'percent': 100,
             'status': 'processing',
             'last_updated': time.time()
-        }
+        })
     
     elif d['status'] == 'error':
-        download_progress[download_id] = {
+        set_progress(download_id, {
             'status': 'error',
             'error': d.get('error', 'Unknown error'),
             'last_updated': time.time()
-        }
+        })
+
+@app.before_request
+def start_trace():
+    if request.path not in UNTRACED_PATHS:
+        g.trace = profiler.start(f"{request.method} {request.path}", profile=wants_profile(request.headers))
+
+@app.after_request
+def add_server_timing(response):
+    # Span timings for the browser's developer tools, and the ID of the profile if there is one
+    trace = g.get('trace')
+    if trace is not None:
+        g.status = response.status_code
+        if trace.spans:
+            response.headers['Server-Timing'] = ', '.join(f"{s['name']};dur={s['seconds'] * 1000:.1f}" for s in trace.spans)
+        if trace.profiler is not None:
+            response.headers['X-Profile-Id'] = trace.trace_id
+    return response
+
+@app.after_request
+def set_client_cookie(response):
+    cookie = g.get('client_cookie')
+    if cookie:
+        response.set_cookie(CLIENT_COOKIE, cookie, max_age=CLIENT_COOKIE_MAX_AGE, httponly=True, samesite='Lax')
+    return response
+
+@app.teardown_request
+def finish_trace(error):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        profiler.finish(trace, status=g.get('status', 500), error=str(error) if error else None)
 
 @app.route('/')
 def index():
@@ -88,532 +632,1217 @@ def index():
 def enhanced():
     return render_template('enhanced.html')
 
+def video_info_payload(data, client_id='anonymous'):
+    """(payload, HTTP status) for /get_video_info, shared by the Flask and ASGI servers"""
+    url = data.get('url')
+    if not url:
+        return {'error': 'No URL provided'}, 400
+    
+    print(f"Fetching info for URL: {url}")
+    
+    # Extract information with yt-dlp (or reuse a recent extraction)
+    info_dict = fetch_video_info(url)
+    
+    if not info_dict:
+        return {'error': 'Could not fetch video information'}, 500
+    
+    # Sizes are scaled down when only part of the video is wanted
+    try:
+        clip = resolve_clip(info_dict, data.get('start'), data.get('end'), data.get('chapters'))
+    except ClipError as e:
+        return {'error': str(e)}, 400
+    
+    # Build the whole format table in one pass over the formats
+    with span('format_table'):
+        all_formats = FormatTable(info_dict, clip_duration=clip['duration'] if clip else None).rows
+    
+    if not all_formats:
+        return {'error': 'No downloadable formats found for this video'}, 500
+    
+    video_info = {
+        'title': info_dict.get('title', 'Unknown'),
+        'uploader': info_dict.get('uploader', 'Unknown'),
+        'duration': info_dict.get('duration', 0),
+        # Served by /thumb, the original is only fetched once however often the video is looked up.
+        # Only YouTube video IDs can be proxied, videos from other sites keep their own thumbnail URL
+        'thumbnail': thumbnail_url(info_dict['id']) if VIDEO_ID.fullmatch(info_dict.get('id') or '') else info_dict.get('thumbnail', ''),
+        'thumbnail_source': info_dict.get('thumbnail', ''),
+        'chapters': [
+            {'title': chapter.get('title'), 'start_time': chapter.get('start_time'), 'end_time': chapter.get('end_time')}
+            for chapter in info_dict.get('chapters') or []
+        ],
+        'clip': clip,
+        'formats': all_formats
+    }
+    
+    print(f"Successfully retrieved video info: {video_info['title']}")
+    
+    # Get a head start on the likely download while the user reads the format table
+    if not clip:
+        try:
+            start_prefetch(info_dict, all_formats, client_id)
+        except Exception as e:
+            print(f"Error starting prefetch: {str(e)}")
+    return video_info, 200
+
 @app.route('/get_video_info', methods=['POST'])
 def get_video_info():
     try:
-        url = request.json.get('url')
-        if not url:
-            return jsonify({'error': 'No URL provided'}), 400
-        
-        print(f"Fetching info for URL: {url}")
-        
-        # Options for yt-dlp with enhanced protections
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-            'format': 'best',
-            'youtube_include_dash_manifest': True,
-            'nocheckcertificate': True,
-            'ignoreerrors': True,
-            'http_headers': {
-                'User-Agent': get_random_user_agent(),
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
+        payload, status_code = video_info_payload(request.get_json(silent=True) or {}, get_client_id())
+        return jsonify(payload), status_code
+    
+    except Exception as e:
+        print(f"Error in get_video_info: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/get_download_progress', methods=['GET'])
+def get_download_progress():
+    return jsonify(progress_with_queue_info(get_job_id(request.args)))
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(metadata_cache.stats())
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # Drop one video (by ID or URL) or, with neither given, the whole cache
+    denied = admin_denied()
+    if denied:
+        return denied
+    
+    data = request.get_json(silent=True) or {}
+    if not data.get('video_id') and not data.get('url'):
+        metadata_cache.invalidate()
+        return jsonify({'success': True, 'invalidated': 'all'})
+    
+    video_id = data.get('video_id') or canonical_video_id(data['url'])
+    if not video_id:
+        return jsonify({'error': "Can't tell the video ID from this URL, pass video_id instead"}), 400
+    metadata_cache.invalidate(video_id)
+    return jsonify({'success': True, 'invalidated': video_id})
+
+@app.route('/store/stats', methods=['GET'])
+def store_stats():
+    return jsonify(media_store.stats())
+
+def stream_download(url, format_id, save_copy=False):
+    """Send a format to the client while it is being fetched, optionally keeping a copy in the media store"""
+    info_dict = fetch_video_info(url)
+    if not info_dict:
+        return jsonify({'error': 'Could not fetch video information'}), 500
+    
+    try:
+        plan = plan_stream(info_dict, format_id)
+    except StreamError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    video_id = info_dict.get('id', 'unknown')
+    download_name = f"{build_filename(info_dict)}.{plan['ext']}"
+    format_string = '+'.join(fmt['format_id'] for fmt in plan['formats'])
+    store_key = media_store.make_key(video_id, format_string, plan['profile'])
+    
+    # A copy saved by an earlier stream can simply be sent from disk
+    entry = media_store.get(store_key)
+    if entry:
+        return send_media_file(
+            media_store.path(entry),
+            entry.get('display_name'),
+            media_etag(store_key, entry['size']),
+            mode=SENDFILE_MODE,
+            accel_root=media_store.root,
+            accel_prefix=X_ACCEL_PREFIX
+        )
+    
+    if not stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many streaming downloads right now, try again shortly or download without streaming'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    try:
+        response = stream_response(plan, video_id, format_string, store_key, download_name, save_copy)
+    except Exception:
+        stream_slots.release()
+        raise
+    # Called once the server is done with the response, including when the client went away before it started
+    response.call_on_close(stream_slots.release)
+    return response
+
+def stream_response(plan, video_id, format_string, store_key, download_name, save_copy):
+    print(f"Streaming {video_id} ({format_string}) as {plan['ext']}")
+    chunks = bandwidth_governor.throttle(iter_stream(plan), f"stream-{uuid.uuid4().hex}")
+    
+    with active_stream_copies_lock:
+        save_copy = save_copy and store_key not in active_stream_copies
+        if save_copy:
+            active_stream_copies.add(store_key)
+    
+    if save_copy:
+        def release_copy():
+            with active_stream_copies_lock:
+                active_stream_copies.discard(store_key)
+        
+        # The key is released only once the staging directory is no longer used
+        def publish_copy(path):
+            try:
+                media_store.publish(
+                    store_key,
+                    path,
+                    video_id=video_id,
+                    format=format_string,
+                    profile=plan['profile'],
+                    display_name=download_name
+                )
+            finally:
+                release_copy()
+        
+        def discard_copy():
+            try:
+                media_store.discard_staging(store_key)
+            finally:
+                release_copy()
+        
+        staging_path = os.path.join(media_store.staging_dir(store_key), download_name)
+        chunks = tee(chunks, staging_path, publish_copy, discard_copy)
+    
+    return Response(chunks, mimetype=plan['mimetype'], headers={
+        'Content-Disposition': content_disposition(download_name),
+        'Cache-Control': 'no-store',
+        # Let the bytes through a reverse proxy as soon as they arrive
+        'X-Accel-Buffering': 'no'
+    })
+
+def traced_job(name, target):
+    """Scheduler job target that runs target under its own trace, profiled when PROFILING is 'all'"""
+    def run(job):
+        with profiler.trace(name, profile=profiler.mode == 'all', job_id=job.job_id):
+            target(job)
+    return run
+
+def start_download(info_dict, format_id, client_id, priority=PRIORITY_INTERACTIVE, clip=None, audio_format='original',
+                   bandwidth_limit=None, job_id=None, resume=False, subscriber=None):
+    """Queue a download of format_id (or reuse a stored or in-flight one) and return the response payload.
+    
+    clip (from resolve_clip) limits the download to part of the video. audio_format 'mp3' converts
+    audio-only downloads to MP3 instead of keeping the original stream. bandwidth_limit caps the
+    download rate of this job in bytes per second. resume queues the job_id of a journaled job again,
+    continuing from the files it left in its staging directory. subscriber is who waits for the file
+    (client_id unless given, '' for nobody yet), a job is only cancelled once all its subscribers left.
+    """
+    subscriber = client_id if subscriber is None else subscriber
+    filename = build_filename(info_dict)
+    if clip:
+        filename = f"{filename} ({clip['label']})"
+    video_id = info_dict.get('id', 'unknown')
+    
+    # Plan a download that stream-copies wherever the codecs allow it
+    with span('plan'):
+        table = FormatTable(info_dict)
+        plan = plan_download(table, format_id, audio_format)
+    is_audio_only = table.get(format_id)['is_audio_only']
+    format_string = plan['format']
+    profile = plan['profile']
+    
+    if clip:
+        # A clip is a different artifact from the full video
+        profile = f"{profile}-clip{clip['start']:g}-{clip['end']:g}"
+    
+    store_key = media_store.make_key(video_id, format_string, profile)
+    output_ext = plan['ext']
+    
+    # Another request is already producing this exact file, just follow its progress
+    with active_downloads_lock:
+        active_job_id = active_downloads.get(store_key)
+        if active_job_id:
+            media_store_lookups.inc(result='in_progress')
+            if subscriber:
+                download_jobs[active_job_id]['subscribers'].add(subscriber)
+            return {
+                'success': True,
+                'message': 'Download already in progress',
+                'video_id': video_id,
+                'job_id': active_job_id,
+                'filename': filename
             }
+        
+        # Serve a previously completed download straight from the store
+        with span('store_lookup'):
+            stored = media_store.get(store_key, touch=False) is not None
+        
+        job_id = job_id or uuid.uuid4().hex
+        job_record = {
+            'video_id': video_id,
+            'store_key': store_key,
+            'display_name': f"{filename}.{output_ext}",
+            'output_path': None,
+            # Changed when a prefetch is claimed by a user while it runs
+            'priority': priority,
+            'bandwidth_limit': bandwidth_limit,
+            # Clients (or batches) waiting for this job, it is shared by everyone asking for the same file
+            'subscribers': {subscriber} if subscriber else set()
         }
+        download_jobs[job_id] = job_record
+        video_jobs[video_id] = job_id
+        if not stored:
+            active_downloads[store_key] = job_id
+    media_store_lookups.inc(result='hit' if stored else 'miss')
+    
+    try:
+        job_journal.record(
+            job_id,
+            info_dict.get('webpage_url') or info_dict.get('original_url'),
+            format_id,
+            state='complete' if stored else 'queued',
+            video_id=video_id,
+            client_id=client_id,
+            priority=priority,
+            store_key=store_key,
+            display_name=job_record['display_name'],
+            clip=clip,
+            audio_format=audio_format,
+            bandwidth_limit=bandwidth_limit
+        )
+    except Exception:
+        # The job never starts, don't leave its file marked as in progress for the next request
+        with active_downloads_lock:
+            if active_downloads.get(store_key) == job_id:
+                del active_downloads[store_key]
+            if video_jobs.get(video_id) == job_id:
+                del video_jobs[video_id]
+            download_jobs.pop(job_id, None)
+        raise
+    
+    if stored:
+        print(f"Serving {video_id} ({format_string}) from media store")
+        set_progress(job_id, {
+            'percent': 100,
+            'status': 'complete',
+            'last_updated': time.time(),
+            'is_audio_only': is_audio_only
+        })
+        return {
+            'success': True,
+            'message': 'Download already available',
+            'video_id': video_id,
+            'job_id': job_id,
+            'filename': filename
+        }
+    
+    # Initialize progress for this job
+    set_progress(job_id, {
+        'percent': 0,
+        'status': 'queued',
+        'last_updated': time.time(),
+        'is_audio_only': is_audio_only
+    })
+    
+    # Download into a private staging directory, the file is only published to the store once complete
+    staging_dir = media_store.staging_dir(store_key)
+    output_template = os.path.join(staging_dir, f"{filename}.%(ext)s")
+    
+    def record_output_path(path):
+        # Called by yt-dlp with the final file path once all post-processing is done
+        job_record['output_path'] = path
+    
+    ydl_opts = {
+        'format': format_string,
+        'outtmpl': output_template,
+        # Transcodes run on the post-processing pool, yt-dlp only downloads
+        'postprocessors': [],
+        'verbose': True,  # Enable verbose output for debugging
+        # Force overwrite of leftovers from an earlier failed attempt, but keep what a job
+        # interrupted by a restart already downloaded (.part files are continued either way)
+        'overwrites': not resume,
+        'progress_hooks': [functools.partial(progress_hook, job_id)],  # Add progress hook
+        'post_hooks': [record_output_path]
+    }
+    
+    if clip:
+        # Only fetch the fragments covering the clip, cut on keyframes without re-encoding
+        # (a single ffmpeg process reads both streams of a clip, so they arrive already merged)
+        ydl_opts.update(clip_ydl_opts(clip))
+    
+    # Separate video and audio streams are downloaded as two files and merged afterwards
+    separate = not clip and 'audio_format_id' in plan
+    
+    # How long each stage took, reported in the job's progress
+    timings = {}
+    
+    # Audio-only downloads are taken from a stored video that already holds the same audio stream
+    stored_entries = [] if clip or not is_audio_only else media_store.entries(video_id)
+    local = plan_local_audio(plan, format_id, stored_entries) if stored_entries else None
+    
+    # Where the file came from, reported in the job's progress when it wasn't downloaded
+    origin = {}
+    
+    def publish(job_id, output_path):
+        with span('publish'):
+            entry = media_store.publish(
+                store_key,
+                output_path,
+                video_id=video_id,
+                format=format_string,
+                profile=profile,
+                display_name=job_record['display_name']
+            )
+        job_journal.update(job_id, output_path=media_store.path(entry))
         
-        # Extract information with yt-dlp
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            
-            if not info_dict:
-                return jsonify({'error': 'Could not fetch video information'}), 500
-                
-            # Get available formats
-            formats = []
+        # Update progress to indicate processing is complete
+        set_progress(job_id, {
+            'percent': 100,
+            'status': 'complete',
+            'last_updated': time.time(),
+            'is_audio_only': is_audio_only,
+            'timings': timings,
+            **origin
+        })
+    
+    def fail(job, e, stage='download'):
+        media_store.discard_staging(store_key)
+        if job.cancelled:
+            print(f"Download of {video_id} cancelled")
+            set_progress(job.job_id, {
+                'status': 'cancelled',
+                'last_updated': time.time()
+            })
+            return
+        
+        print(f"Error in {stage}: {str(e)}")
+        errors.inc(stage=stage)
+        # The cached stream URLs may have expired, extract again next time
+        metadata_cache.invalidate(video_id)
+        set_progress(job.job_id, {
+            'status': 'error',
+            'error': str(e),
+            'last_updated': time.time()
+        })
+    
+    def release():
+        with active_downloads_lock:
+            active_downloads.pop(store_key, None)
+    
+    # Merge or transcode the downloaded files on the post-processing pool
+    def postprocess_thread(inputs, ffmpeg_args, job):
+        timings['postprocess_queue'] = round(job.started_at - job.submitted_at, 2)
+        queue_wait_seconds.observe(job.started_at - job.submitted_at, stage='postprocess')
+        set_progress(job.job_id, {
+            'percent': 100,
+            'status': 'processing',
+            'stage': 'postprocessing',
+            'last_updated': time.time(),
+            'is_audio_only': is_audio_only,
+            'timings': timings
+        })
+        
+        try:
+            output_path = os.path.join(staging_dir, f"{filename}.{output_ext}")
+            with span('ffmpeg'):
+                postprocess_pool.run_ffmpeg(job, inputs, output_path, ffmpeg_args)
+            timings['postprocess'] = round(time.time() - job.started_at, 2)
+            postprocess_seconds.observe(time.time() - job.started_at, kind='merge' if len(inputs) > 1 else 'transcode')
+            for path in inputs:
+                os.remove(path)
+            publish(job.job_id, output_path)
+        except Exception as e:
+            fail(job, e, stage='postprocess')
+        finally:
+            release()
+    
+    # Perform the download on one of the scheduler's workers
+    def download_thread(job):
+        import yt_dlp
+        
+        def cancel_hook(d):
+            if job.cancelled:
+                raise yt_dlp.utils.DownloadCancelled('Download cancelled')
+        
+        handed_off = False
+        job_journal.update(job.job_id, state='downloading')
+        lease = bandwidth_governor.acquire(
+            job.job_id, job_record['priority'], cancelled=lambda: job.cancelled, limit=job_record['bandwidth_limit'])
+        try:
+            timings['queue'] = round(job.started_at - job.submitted_at, 2)
+            queue_wait_seconds.observe(job.started_at - job.submitted_at, stage='download')
             
-            # First collect best audio format for later merging
-            best_audio = None
-            for format_entry in info_dict.get('formats', []):
-                if format_entry.get('vcodec') == 'none' and format_entry.get('acodec') != 'none':
-                    if best_audio is None:
-                        best_audio = format_entry
-                    else:
-                        # Safely compare audio bitrates with fallbacks to avoid NoneType comparison
-                        format_abr = format_entry.get('abr')
-                        best_abr = best_audio.get('abr')
-                        
-                        # Only compare if both values are numeric
-                        if isinstance(format_abr, (int, float)) and isinstance(best_abr, (int, float)):
-                            if format_abr > best_abr:
-                                best_audio = format_entry
-                        # If format has abr and best doesn't, prefer format
-                        elif isinstance(format_abr, (int, float)):
-                            best_audio = format_entry
+            # Video and audio streams are fetched at the same time unless PARALLEL_FETCH is off
+            parallel = separate and PARALLEL_FETCH
+            fragments = fetch_tuner.fragments(2 if parallel else 1, download_scheduler.stats()['running'])
+            hooks = [cancel_hook, functools.partial(fetch_tuner.observe, fragments), lease.progress_hook]
             
-            # Now process video formats
-            for format_entry in info_dict.get('formats', []):
-                # Skip formats without resolution or with only audio
-                if 'height' not in format_entry or format_entry.get('vcodec') == 'none':
-                    continue
-                
-                # Process only formats that have a reasonable chance of working
-                if not format_entry.get('format_id') or not format_entry.get('ext'):
-                    continue
-                
-                # Check if format has audio
-                has_audio = format_entry.get('acodec') != 'none'
-                
-                # Get additional info like codec, bitrate
-                vcodec = format_entry.get('vcodec', 'Unknown')
-                codec_description = ''
-                
-                # Create more human-readable codec description
-                if vcodec != 'Unknown':
-                    if 'avc' in vcodec or 'h264' in vcodec:
-                        codec_description = 'H.264'
-                    elif 'av1' in vcodec:
-                        codec_description = 'AV1'
-                    elif 'vp9' in vcodec:
-                        codec_description = 'VP9'
-                    elif 'vp8' in vcodec:
-                        codec_description = 'VP8'
-                    else:
-                        codec_description = vcodec.upper()
-                
-                # Calculate more accurate size based on filesize if available,
-                # or fallback to bitrate calculation
-                size_mb = 'Unknown'
-                filesize = format_entry.get('filesize')
-                
-                if filesize:
-                    size_mb = round(filesize / (1024 * 1024), 2)
+            with span('download'):
+                if separate:
+                    job_opts = dict(ydl_opts, progress_hooks=hooks, concurrent_fragment_downloads=fragments)
+                    paths = download_parallel(
+                        info_dict,
+                        job_opts,
+                        [('video', plan['video_format_id']), ('audio', plan['audio_format_id'])],
+                        staging_dir,
+                        filename,
+                        functools.partial(progress_hook, job.job_id),
+                        concurrent=parallel,
+                        checkout=lambda name, opts: ydl_pool.checkout(name, **opts)
+                    )
+                    inputs = [paths['video'], paths['audio']]
+                    ffmpeg_args = ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy']
                 else:
-                    # Calculate approx size in MB (bitrate * duration / 8 / 1024 / 1024)
-                    duration = info_dict.get('duration', 0)
-                    tbr = format_entry.get('tbr', 0)  # Total bitrate in kbps
-                    
-                    if duration and tbr:
-                        size_mb = round((tbr * 1000 * duration) / (8 * 1024 * 1024), 2)
-                
-                # Determine final size if we need to add audio
-                final_size_mb = size_mb
-                if not has_audio and best_audio:
-                    # Calculate audio size
-                    audio_size = 0
-                    audio_filesize = best_audio.get('filesize')
-                    
-                    if audio_filesize and isinstance(audio_filesize, (int, float)):
-                        audio_size = audio_filesize / (1024 * 1024)
-                    else:
-                        duration = info_dict.get('duration', 0)
-                        abr = best_audio.get('abr')
-                        if duration and isinstance(duration, (int, float)) and abr and isinstance(abr, (int, float)):
-                            audio_size = (abr * 1000 * duration) / (8 * 1024 * 1024)
-                    
-                    # If size_mb is a number, add audio size
-                    if isinstance(size_mb, (int, float)) and audio_size > 0:
-                        final_size_mb = round(size_mb + audio_size, 2)
-                    elif not isinstance(size_mb, (int, float)) and audio_size > 0:
-                        # If we only have audio size but no video size
-                        final_size_mb = round(audio_size, 2)
-                
-                formats.append({
-                    'format_id': format_entry.get('format_id'),
-                    'resolution': f"{format_entry.get('height', 'Unknown')}p",
-                    'extension': format_entry.get('ext', 'Unknown'),
-                    'fps': format_entry.get('fps', 'Unknown'),
-                    'vcodec': vcodec,
-                    'codec_description': codec_description,
-                    'bitrate': format_entry.get('tbr', 0),
-                    'has_audio': has_audio,
-                    'size_mb': size_mb,
-                    'final_size_mb': final_size_mb
-                })
-            
-            # Sort formats by resolution (highest first), then by codec quality
-            try:
-                formats = sorted(formats, 
-                                key=lambda x: (
-                                    int(x['resolution'].replace('p', '')) if x['resolution'] != 'Unknown' and 'p' in x['resolution'] else 0,
-                                    x['bitrate'] if isinstance(x['bitrate'], (int, float)) else 0
-                                ), 
-                                reverse=True)
-            except TypeError as e:
-                print(f"Warning: Error sorting formats: {e}")
-                # Fallback to simpler sorting if complex sorting fails
-                try:
-                    formats = sorted(formats, 
-                                    key=lambda x: int(x['resolution'].replace('p', '')) if x['resolution'] != 'Unknown' and 'p' in x['resolution'] else 0, 
-                                    reverse=True)
-                except:
-                    print("Warning: Could not sort formats by resolution, using original order")
-            
-            # Add audio-only option
-            audio_formats = []
-            for format_entry in info_dict.get('formats', []):
-                if format_entry.get('vcodec') == 'none' and format_entry.get('acodec') != 'none':
-                    # Calculate approx size
-                    duration = info_dict.get('duration', 0)
-                    abr = format_entry.get('abr', 0)  # Audio bitrate in kbps
+                    job_opts = dict(
+                        ydl_opts,
+                        progress_hooks=ydl_opts['progress_hooks'] + hooks,
+                        concurrent_fragment_downloads=fragments
+                    )
                     
-                    size_mb = 'Unknown'
-                    filesize = format_entry.get('filesize')
+                    # Reuse the extracted info instead of letting yt-dlp extract it again
+                    with ydl_pool.checkout('audio' if is_audio_only else 'video', **job_opts) as ydl:
+                        ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
                     
-                    if filesize:
-                        size_mb = round(filesize / (1024 * 1024), 2)
-                    elif duration and abr:
-                        size_mb = round((abr * 1000 * duration) / (8 * 1024 * 1024), 2)
-                    
-                    # Get audio codec
-                    acodec = format_entry.get('acodec', 'Unknown')
-                    audio_quality = f"{int(abr)}kbps" if isinstance(abr, (int, float)) and abr > 0 else 'Unknown'
-                    
-                    audio_formats.append({
-                        'format_id': format_entry.get('format_id'),
-                        'resolution': 'Audio only',
-                        'extension': format_entry.get('ext', 'Unknown'),
-                        'fps': 'N/A',
-                        'acodec': acodec,
-                        'audio_quality': audio_quality,
-                        'has_audio': True,
-                        'size_mb': size_mb,
-                        'final_size_mb': size_mb
-                    })
+                    output_path = job_record['output_path']
+                    if not output_path or not os.path.exists(output_path):
+                        raise FileNotFoundError('yt-dlp did not report an output file')
+                    inputs = [output_path]
+                    ffmpeg_args = plan['ffmpeg_args']
             
-            # Sort audio formats by quality with better error handling
-            try:
-                audio_formats = sorted(audio_formats, 
-                                    key=lambda x: float(x['format_id']) if x['format_id'] and x['format_id'].isdigit() else 0, 
-                                    reverse=True)
-            except (TypeError, ValueError) as e:
-                print(f"Warning: Error sorting audio formats: {e}")
-                # Don't sort if there's an error
+            lease.release()
+            elapsed = time.time() - job.started_at
+            timings['download'] = round(elapsed, 2)
+            size = sum(os.path.getsize(path) for path in inputs)
+            download_seconds.observe(elapsed)
+            downloaded_bytes.inc(size)
+            if elapsed > 0:
+                download_throughput.observe(size / elapsed)
             
-            # Combine formats
-            all_formats = formats + audio_formats
+            if not ffmpeg_args:
+                publish(job.job_id, output_path)
+                return
             
-            if not all_formats:
-                return jsonify({'error': 'No downloadable formats found for this video'}), 500
+            if job.cancelled:
+                raise yt_dlp.utils.DownloadCancelled('Download cancelled')
             
-            video_info = {
-                'title': info_dict.get('title', 'Unknown'),
-                'uploader': info_dict.get('uploader', 'Unknown'),
-                'duration': info_dict.get('duration', 0),
-                'thumbnail': info_dict.get('thumbnail', ''),
-                'formats': all_formats
-            }
+            # Hand the files over to the post-processing pool, which frees this download worker
+            set_progress(job.job_id, {
+                'percent': 100,
+                'status': 'processing',
+                'stage': 'postprocess_queued',
+                'last_updated': time.time(),
+                'is_audio_only': is_audio_only,
+                'timings': timings
+            })
+            postprocess_pool.submit(
+                traced_job(f"postprocess {video_id}", functools.partial(postprocess_thread, inputs, ffmpeg_args)),
+                client_id=client_id,
+                priority=job_record['priority'],
+                job_id=job.job_id,
+                on_cancel=cancelled_while_queued
+            )
+            handed_off = True
+            if job.cancelled:
+                # Cancelled while being handed over
+                postprocess_pool.cancel(job.job_id)
+        except Exception as e:
+            fail(job, e)
+        finally:
+            lease.release()
+            if not handed_off:
+                release()
+    
+    # Clean up after a download that was cancelled before it started, or before its post-processing started
+    def cancelled_while_queued(job):
+        media_store.discard_staging(store_key)
+        with active_downloads_lock:
+            active_downloads.pop(store_key, None)
+        set_progress(job.job_id, {
+            'status': 'cancelled',
+            'last_updated': time.time()
+        })
+    
+    # Queue the download, it starts as soon as a worker is free
+    def queue_network_download():
+        download_scheduler.submit(
+            traced_job(f"download {video_id}", download_thread),
+            client_id=client_id,
+            priority=job_record['priority'],
+            job_id=job_id,
+            on_cancel=cancelled_while_queued
+        )
+    
+    # Take the audio track out of the stored file on the post-processing pool, without going to YouTube
+    def extract_thread(source_key, ffmpeg_args, job):
+        timings['postprocess_queue'] = round(job.started_at - job.submitted_at, 2)
+        queue_wait_seconds.observe(job.started_at - job.submitted_at, stage='postprocess')
+        set_progress(job.job_id, {
+            'percent': 0,
+            'status': 'processing',
+            'stage': 'extracting',
+            'last_updated': time.time(),
+            'is_audio_only': is_audio_only,
+            'timings': timings,
+            **origin
+        })
+        
+        try:
+            # The stored file may have been evicted while this job waited
+            source = media_store.get(source_key)
+            if source is None:
+                raise FileNotFoundError('The stored video is gone')
+            output_path = os.path.join(staging_dir, f"{filename}.{output_ext}")
+            with span('ffmpeg'):
+                postprocess_pool.run_ffmpeg(job, [media_store.path(source)], output_path, ffmpeg_args)
+            timings['postprocess'] = round(time.time() - job.started_at, 2)
+            postprocess_seconds.observe(time.time() - job.started_at, kind='extract')
+            publish(job.job_id, output_path)
+        except Exception as e:
+            if job.cancelled:
+                fail(job, e, stage='postprocess')
+                release()
+                return
             
-            print(f"Successfully retrieved video info: {video_info['title']}")
-            return jsonify(video_info)
+            # Nothing is lost but time, download the audio as if there had been no stored file
+            print(f"Could not extract the audio of {video_id} locally, downloading it instead: {str(e)}")
+            media_store.discard_staging(store_key)
+            origin.clear()
+            set_progress(job.job_id, {
+                'percent': 0,
+                'status': 'queued',
+                'last_updated': time.time(),
+                'is_audio_only': is_audio_only
+            })
+            queue_network_download()
+            return
+        release()
     
-    except Exception as e:
-        print(f"Error in get_video_info: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({'error': str(e)}), 500
+    if local:
+        source_key, ffmpeg_args = local
+        origin.update(source='local', derived_from=dict(stored_entries)[source_key].get('display_name'))
+        print(f"Extracting audio {format_id} of {video_id} from the stored {origin['derived_from']}")
+        set_progress(job_id, {
+            'percent': 0,
+            'status': 'processing',
+            'stage': 'postprocess_queued',
+            'last_updated': time.time(),
+            'is_audio_only': is_audio_only,
+            **origin
+        })
+        postprocess_pool.submit(
+            traced_job(f"extract {video_id}", functools.partial(extract_thread, source_key, ffmpeg_args)),
+            client_id=client_id,
+            priority=job_record['priority'],
+            job_id=job_id,
+            on_cancel=cancelled_while_queued
+        )
+    else:
+        queue_network_download()
+    
+    # Return immediately with the job ID for progress tracking
+    return {
+        'success': True,
+        'message': 'Download queued',
+        'video_id': video_id,
+        'job_id': job_id,
+        'filename': filename,
+        **origin
+    }
 
-@app.route('/get_download_progress', methods=['GET'])
-def get_download_progress():
-    video_id = request.args.get('video_id', 'unknown')
+def job_running(job_id):
+    """Whether a job is still queued, downloading or being post-processed"""
+    status = progress_store.status(job_id)
+    return status is not None and status not in FINAL_STATUSES
+
+def cancel_job(job_id):
+    """Cancel a job wherever it is, False if it has already finished"""
+    # A job is either waiting to be resumed after a restart, downloading or being post-processed
+    if take_resuming(job_id):
+        set_progress(job_id, {'status': 'cancelled', 'last_updated': time.time()})
+        return True
+    return postprocess_pool.cancel(job_id) or download_scheduler.cancel(job_id)
+
+def unsubscribe(job_id, subscriber):
+    """Stop waiting for a job, cancelling it if nobody else waits for it. True if it was cancelled"""
+    job = download_jobs.get(job_id)
+    if job is None:
+        return False
+    with active_downloads_lock:
+        job['subscribers'].discard(subscriber)
+        wanted = bool(job['subscribers'])
+    return not wanted and cancel_job(job_id)
+
+def cancel_unwanted(job_id):
+    """Cancel a job nobody has subscribed to, such as a prefetch no one asked for yet"""
+    job = download_jobs.get(job_id)
+    return bool(job) and not job['subscribers'] and cancel_job(job_id)
+
+def start_prefetch(info_dict, rows, client_id):
+    """Start downloading the format the user will most likely pick, in the background"""
+    video_id = info_dict.get('id')
+    if not PREFETCH or not video_id or prefetcher.get(video_id):
+        return
     
-    if video_id in download_progress:
-        return jsonify(download_progress[video_id])
-    else:
-        return jsonify({
-            'status': 'unknown',
-            'percent': 0
-        })
+    format_id, reason = prefetcher.predict(rows)
+    if format_id is None:
+        prefetcher.skip(reason)
+        return
+    
+    # Never let a guess push a download someone asked for out of the store
+    size_bytes = int(next(row for row in rows if row['format_id'] == format_id)['final_size_mb'] * 1024 ** 2)
+    store = media_store.stats()
+    if store['bytes'] + size_bytes > store['max_bytes']:
+        prefetcher.skip('disk')
+        return
+    
+    # Only the newest prefetches are worth finishing, the user has moved on from the older ones
+    running = prefetcher.running(job_running)
+    for old_video_id, entry in running[:max(len(running) - prefetcher.max_jobs + 1, 0)]:
+        cancel_unwanted(entry['job_id'])
+        prefetcher.abandon(old_video_id)
+    
+    payload = start_download(info_dict, format_id, client_id, priority=PRIORITY_BACKGROUND,
+                             bandwidth_limit=PREFETCH_RATE_LIMIT, subscriber='')
+    if payload['message'] != 'Download queued':
+        prefetcher.skip('stored' if payload['message'] == 'Download already available' else 'in_progress')
+        return
+    prefetcher.start(video_id, payload['job_id'], format_id, size_bytes)
+    print(f"Prefetching {video_id} in format {format_id} ({reason})")
+
+def claim_prefetch(video_id, format_id):
+    """Resolve the prefetch of a video a user now asked to download, promoting it if it is what they want"""
+    entry = prefetcher.get(video_id)
+    if entry is None:
+        return
+    job_id = entry['job_id']
+    entry, outcome = prefetcher.claim(video_id, format_id, progress_store.status(job_id))
+    if entry is None:
+        return
+    print(f"Prefetch of {video_id}: {outcome}")
+    
+    if outcome == 'miss':
+        # Make room for the format that was actually picked
+        cancel_unwanted(job_id)
+    elif outcome == 'partial_hit':
+        # The download the user is waiting for, give it their priority and the full bandwidth
+        job_record = download_jobs.get(job_id)
+        if job_record:
+            job_record['priority'] = PRIORITY_INTERACTIVE
+            job_record['bandwidth_limit'] = None
+        download_scheduler.reprioritize(job_id, PRIORITY_INTERACTIVE)
+        postprocess_pool.reprioritize(job_id, PRIORITY_INTERACTIVE)
+        bandwidth_governor.promote(job_id, PRIORITY_INTERACTIVE)
+        # Otherwise a restart would drop it like any other prefetch
+        job_journal.update(job_id, priority=PRIORITY_INTERACTIVE, bandwidth_limit=None)
+
+def queue_download(data, client_id):
+    """(payload, HTTP status) for a non-streaming /download request, shared by the Flask and ASGI servers"""
+    url = data.get('url')
+    format_id = data.get('format_id')
+    
+    print(f"Downloading URL: {url}, format: {format_id}")
+    
+    # First get video info to determine if format is audio-only
+    info_dict = fetch_video_info(url)
+    if not info_dict:
+        return {'error': 'Could not fetch video information'}, 500
+    
+    try:
+        clip = resolve_clip(info_dict, data.get('start'), data.get('end'), data.get('chapters'))
+        audio_format = data.get('audio_format', 'original')
+        
+        # A prefetch only ever downloads whole videos in their original format
+        plain = not clip and audio_format == 'original'
+        if plain:
+            prefetcher.record_choice(format_id)
+        claim_prefetch(info_dict.get('id'), format_id if plain else None)
+        
+        payload = start_download(info_dict, format_id, client_id, clip=clip, audio_format=audio_format)
+    except (ClipError, PlanError) as e:
+        return {'error': str(e)}, 400
+    
+    return payload, 200
 
-@app.route('/download', methods=['POST'])
+@app.route('/download', methods=['GET', 'POST'])
 def download_video():
     try:
-        url = request.json.get('url')
-        format_id = request.json.get('format_id')
+        # Browsers start a streaming download with a plain GET, API clients can POST {"stream": true}
+        data = request.args if request.method == 'GET' else (request.get_json(silent=True) or {})
+        url = data.get('url')
+        format_id = data.get('format_id')
         
         if not url or not format_id:
             return jsonify({'error': 'URL and format ID are required'}), 400
         
-        print(f"Downloading URL: {url}, format: {format_id}")
+        if request.method == 'GET' or data.get('stream'):
+            if data.get('start') or data.get('end') or data.get('chapters'):
+                return jsonify({'error': "Clips can't be streamed, download them without streaming"}), 400
+            save_copy = str(data.get('save', '')).lower() in ('1', 'true')
+            return stream_download(url, format_id, save_copy=save_copy)
         
-        # Sanitize the filename
-        filename = None
-        is_audio_only = False
-        video_id = None
-        
-        # First get video info to determine if format is audio-only
-        with yt_dlp.YoutubeDL({
-            'quiet': True, 
-            'no_warnings': True, 
-            'skip_download': True,
-            'youtube_include_dash_manifest': True
-        }) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            if not info_dict:
-                return jsonify({'error': 'Could not fetch video information'}), 500
-                
-            title = info_dict.get('title', 'video')
-            uploader = info_dict.get('uploader', 'Unknown')
-            
-            # Create filename with creator and title: "Creator - Title"
-            combined_name = f"{uploader} - {title}"
-            
-            # More thorough sanitization of filename
-            filename = sanitize_filename(combined_name)
-            # Replace problematic characters with safe alternatives
-            filename = filename.replace('+', ' plus ').replace('&', ' and ').replace("'", "")
-            # Remove any other potentially problematic characters
-            filename = re.sub(r'[^\w\s.-]', '', filename)
-            # Trim excessive spaces
-            filename = re.sub(r'\s+', ' ', filename).strip()
-            
-            video_id = info_dict.get('id', 'unknown')
-            
-            # Initialize progress for this video
-            download_progress[video_id] = {
-                'percent': 0,
-                'status': 'starting',
-                'last_updated': time.time()
-            }
-            
-            # Check if the format is audio-only
-            for format_entry in info_dict.get('formats', []):
-                if format_entry.get('format_id') == format_id and format_entry.get('vcodec') == 'none':
-                    is_audio_only = True
-                    # Store this information in the progress dictionary
-                    download_progress[video_id]['is_audio_only'] = True
-                    break
-            
-            # Also check if the selected format has audio already
-            has_built_in_audio = False
-            for format_entry in info_dict.get('formats', []):
-                if format_entry.get('format_id') == format_id and format_entry.get('acodec') != 'none':
-                    has_built_in_audio = True
-                    break
-        
-        # Set up appropriate download options based on format type
-        if is_audio_only:
-            # For audio-only downloads
-            output_template = os.path.join(TEMP_DIR, f"{filename}.%(ext)s")
-            ydl_opts = {
-                'format': format_id,
-                'outtmpl': output_template,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'verbose': True,  # Enable verbose output for debugging
-                'progress_hooks': [progress_hook]  # Add progress hook
-            }
-        else:
-            # For video downloads
-            output_template = os.path.join(TEMP_DIR, f"{filename}.%(ext)s")
-            
-            # If the format already has audio, use it directly
-            # Otherwise, select the format and merge with best audio
-            if has_built_in_audio:
-                format_string = format_id
-            else:
-                format_string = f"{format_id}+bestaudio"
-            
-            ydl_opts = {
-                'format': format_string,
-                'outtmpl': output_template,
-                'merge_output_format': 'mp4',
-                'verbose': True,  # Enable verbose output for debugging
-                # Force overwrite of existing files
-                'overwrites': True,
-                # Make sure FFmpeg knows to keep audio
-                'postprocessor_args': {
-                    'ffmpeg': ['-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k']
-                },
-                'progress_hooks': [progress_hook]  # Add progress hook
-            }
+        payload, status_code = queue_download(data, get_client_id())
+        return jsonify(payload), status_code
+    
+    except Exception as e:
+        print(f"Error in download_video: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+def download_status(job_id):
+    """Current status of a job as (payload, HTTP status), including the file URL once complete"""
+    progress = progress_with_queue_info(job_id)
+    if progress.get('status') != 'complete':
+        return progress, 200
+    
+    # Completed jobs point at their media store entry, no need to search for the file
+    entry = media_store.get(download_jobs[job_id]['store_key'], touch=False)
+    if not entry:
+        return {'status': 'error', 'error': 'Downloaded file not found'}, 500
+    
+    if entry['size'] < 1024:  # If file is less than 1KB, it's probably corrupt
+        return {'status': 'error', 'error': 'Download failed, file is empty or corrupt'}, 500
+    
+    payload = {
+        'status': 'complete',
+        'download_path': f"/download_file?job_id={job_id}",
+        'file_size_mb': round(entry['size'] / (1024*1024), 2)
+    }
+    for field in ('timings', 'source', 'derived_from'):
+        if progress.get(field):
+            payload[field] = progress[field]
+    return payload, 200
+
+def progress_stream_events(job_id):
+    """Generate Server-Sent Events for a job until it reaches a final status"""
+    stream = ProgressEventStream(job_id, progress_broker, download_status, progress_store.status)
+    yield stream.RETRY
+    
+    while True:
+        event = stream.next_event()
+        if event:
+            yield event
+            if stream.finished:
+                return
+            # Coalesce the burst of hook updates that typically follows
+            time.sleep(PROGRESS_STREAM_INTERVAL)
+        elif progress_broker.wait(job_id, stream.version, timeout=stream.wait_timeout()) == stream.version:
+            keep_alive = stream.idle()
+            if keep_alive:
+                yield keep_alive
+
+@app.route('/progress/stream', methods=['GET'])
+def progress_stream():
+    job_id = get_job_id(request.args)
+    
+    if not job_id:
+        return jsonify({'error': 'Job ID is required'}), 400
+    
+    return Response(progress_stream_events(job_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/progress/poll', methods=['GET'])
+def progress_poll():
+    # Long-poll fallback for clients without EventSource support
+    try:
+        job_id = get_job_id(request.args)
+        try:
+            since = int(request.args.get('since', -1))
+        except ValueError:
+            return jsonify({'error': 'since must be a number'}), 400
         
-        # Store the original filename and sanitized filename in the progress dictionary
-        download_progress[video_id]['original_filename'] = combined_name
-        download_progress[video_id]['sanitized_filename'] = filename
-        download_progress[video_id]['is_audio_only'] = is_audio_only
+        if not job_id:
+            return jsonify({'error': 'Job ID is required'}), 400
         
-        # Perform the download in a separate thread
-        def download_thread():
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                
-                # Update progress to indicate processing is complete
-                download_progress[video_id] = {
-                    'percent': 100,
-                    'status': 'complete',
-                    'last_updated': time.time(),
-                    'original_filename': combined_name,
-                    'sanitized_filename': filename,
-                    'is_audio_only': is_audio_only
-                }
-            except Exception as e:
-                print(f"Error in download thread: {str(e)}")
-                download_progress[video_id] = {
-                    'status': 'error',
-                    'error': str(e),
-                    'last_updated': time.time()
-                }
+        if progress_store.status(job_id) is None:
+            return jsonify({'status': 'error', 'error': 'Unknown job'}), 404
         
-        # Start download in background thread
-        threading.Thread(target=download_thread).start()
+        version = progress_broker.version(job_id)
+        if version <= since:
+            version = progress_broker.wait(job_id, since, timeout=25)
         
-        # Return immediately with video ID for progress tracking
-        return jsonify({
-            'success': True,
-            'message': 'Download started',
-            'video_id': video_id,
-            'filename': filename
-        })
+        payload, status_code = download_status(job_id)
+        payload['version'] = version
+        return jsonify(payload), status_code
     
     except Exception as e:
-        print(f"Error in download_video: {str(e)}")
+        print(f"Error in progress_poll: {str(e)}")
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/cancel_download', methods=['POST'])
+def cancel_download():
+    # Only by job ID: a video ID would let anyone cancel whatever download of that video is running
+    job_id = (request.get_json(silent=True) or {}).get('job_id')
+    job = download_jobs.get(job_id)
+    
+    if not job:
+        return jsonify({'error': 'No download found to cancel'}), 404
+    
+    if get_client_id() not in job['subscribers']:
+        return jsonify({'error': 'This download was not started by you'}), 403
+    
+    if not job_running(job_id):
+        return jsonify({'error': 'Download has already finished'}), 409
+    
+    # Downloads are shared, the job only stops once nobody else is waiting for it
+    cancelled = unsubscribe(job_id, get_client_id())
+    return jsonify({'success': True, 'job_id': job_id, 'cancelled': cancelled})
+
+@app.route('/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    return jsonify(dict(
+        download_scheduler.stats(),
+        postprocess=postprocess_pool.stats(),
+        fetch=fetch_tuner.stats(),
+        progress=progress_store.stats(),
+        ydl_pool=ydl_pool.stats(),
+        journal=job_journal.stats(),
+        bandwidth=bandwidth_governor.stats(),
+        prefetch=prefetcher.stats()
+    ))
+
+@app.route('/prefetch/stats', methods=['GET'])
+def prefetch_stats():
+    return jsonify(dict(prefetcher.stats(), enabled=PREFETCH, rate_limit=PREFETCH_RATE_LIMIT or None))
+
+@app.route('/prefetch/cancel', methods=['POST'])
+def cancel_prefetch():
+    """Cancel the prefetch of a video the user moved away from, or every running prefetch (admin only)"""
+    video_id = (request.get_json(silent=True) or {}).get('video_id')
+    if not video_id:
+        denied = admin_denied()
+        if denied:
+            return denied
+    
+    running = [(vid, entry) for vid, entry in prefetcher.running(job_running) if not video_id or vid == video_id]
+    for vid, entry in running:
+        cancel_unwanted(entry['job_id'])
+        prefetcher.abandon(vid)
+    
+    return jsonify({'success': True, 'cancelled': [entry['job_id'] for _, entry in running]})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({'mode': profiler.mode, 'slow_seconds': profiler.slow_seconds, 'traces': profiler.recent()})
+
+@app.route('/admin/bandwidth', methods=['GET', 'POST'])
+def bandwidth_settings():
+    """Show or change the download rate limits, in bytes per second (0 for unlimited)"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            limits = {key: int(data[key]) for key in ('global_limit', 'job_limit', 'limit') if data.get(key) is not None}
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Limits must be whole numbers of bytes per second'}), 400
+        if any(value < 0 for value in limits.values()):
+            return jsonify({'error': 'Limits must not be negative'}), 400
+        if 'limit' in limits and not data.get('job_id'):
+            return jsonify({'error': 'A job ID is required to set a job\'s limit'}), 400
+        
+        try:
+            bandwidth_governor.configure(job_id=data.get('job_id'), **limits)
+        except KeyError:
+            return jsonify({'error': 'Job is not downloading'}), 404
+        print(f"Bandwidth limits changed: {limits}")
+    
+    return jsonify(bandwidth_governor.stats())
+
+@app.route('/admin/profiles/<trace_id>', methods=['GET'])
+def get_profile(trace_id):
+    denied = admin_denied()
+    if denied:
+        return denied
+    
+    trace = profiler.get(trace_id)
+    if trace is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    # The trace, and the functions that took the longest when it was profiled
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'ncalls'):
+        return jsonify({'error': 'sort must be cumulative, tottime or ncalls'}), 400
+    return jsonify(dict(trace.to_dict(), profile=trace.profile_text(limit=request.args.get('limit', 40, type=int), sort=sort)))
+
 @app.route('/check_download_status', methods=['GET'])
 def check_download_status():
     try:
-        video_id = request.args.get('video_id')
-        filename = request.args.get('filename')
-        
-        if not video_id or not filename:
-            return jsonify({'error': 'Video ID and filename are required'}), 400
-        
-        # Check if download is complete
-        if video_id in download_progress and download_progress[video_id].get('status') == 'complete':
-            # Determine output file extension
-            ext = 'mp3' if download_progress[video_id].get('is_audio_only', False) else 'mp4'
-            expected_filename = f"{filename}.{ext}"
-            file_path = os.path.join(TEMP_DIR, expected_filename)
-            
-            # If file doesn't exist with expected name, search for other possible names
-            if not os.path.exists(file_path):
-                print(f"File not found at expected path: {file_path}, searching for alternatives...")
-                
-                # More robust file search - handle special characters better
-                found_file = None
-                sanitized_filename = sanitize_filename(filename)
-                
-                # Try different variations of the filename
-                possible_filenames = [
-                    filename,                      # Original filename
-                    sanitized_filename,            # Sanitized filename
-                    filename.replace('+', ' '),    # Replace + with space
-                    filename.replace('&', 'and'),  # Replace & with 'and'
-                    filename.replace("'", "")      # Remove apostrophes
-                ]
-                
-                # Search for any file that starts with any of the possible filename variations
-                for file in os.listdir(TEMP_DIR):
-                    file_lower = file.lower()
-                    # Check if the file has the right extension
-                    if not file_lower.endswith(f'.{ext.lower()}'):
-                        continue
-                        
-                    # Check if the file matches any of our possible filename patterns
-                    for possible_name in possible_filenames:
-                        possible_name_lower = possible_name.lower()
-                        # Check if file starts with the possible name (case insensitive)
-                        if file_lower.startswith(possible_name_lower) or \
-                           possible_name_lower in file_lower or \
-                           file_lower.startswith(possible_name_lower.replace(' ', '_')):
-                            found_file = file
-                            break
-                    
-                    if found_file:
-                        break
-                
-                if found_file:
-                    expected_filename = found_file
-                    file_path = os.path.join(TEMP_DIR, expected_filename)
-                    print(f"Found alternative file: {file_path}")
-                else:
-                    # If still not found, try a more aggressive search for any file with similar content
-                    for file in os.listdir(TEMP_DIR):
-                        if file.endswith(f'.{ext}') and os.path.getmtime(os.path.join(TEMP_DIR, file)) > time.time() - 60:
-                            # This file has the right extension and was modified in the last minute
-                            expected_filename = file
-                            file_path = os.path.join(TEMP_DIR, expected_filename)
-                            print(f"Found recently modified file with matching extension: {file_path}")
-                            break
-            
-            # Verify file exists and has a reasonable size
-            if not os.path.exists(file_path):
-                return jsonify({'status': 'error', 'error': 'Downloaded file not found'}), 500
-            
-            file_size = os.path.getsize(file_path)
-            print(f"Download complete: {expected_filename}, size: {file_size / (1024*1024):.2f} MB")
-            
-            if file_size < 1024:  # If file is less than 1KB, it's probably corrupt
-                return jsonify({'status': 'error', 'error': 'Download failed, file is empty or corrupt'}), 500
-            
-            return jsonify({
-                'status': 'complete',
-                'download_path': f"/download_file?path={expected_filename}",
-                'file_size_mb': round(file_size / (1024*1024), 2)
-            })
+        job_id = get_job_id(request.args)
+        
+        if not job_id:
+            return jsonify({'error': 'Job ID or video ID is required'}), 400
         
-        # Return current progress
-        if video_id in download_progress:
-            return jsonify(download_progress[video_id])
-        else:
-            return jsonify({'status': 'unknown', 'percent': 0})
+        payload, status_code = download_status(job_id)
+        return jsonify(payload), status_code
     
     except Exception as e:
         print(f"Error in check_download_status: {str(e)}")
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/thumb/<video_id>', methods=['GET'])
+def thumbnail(video_id):
+    """A video's thumbnail, resized (?w=160, 320 or 640) and cached, as WebP for browsers that accept it"""
+    try:
+        width = request.args.get('w', DEFAULT_WIDTH, type=int)
+        fmt = request.args.get('format')
+        if not fmt:
+            fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+        
+        # The info dict knows the video's best thumbnail, without it the standard one is used
+        info_dict = metadata_cache.peek(video_id)
+        path, content_type, key = thumbnail_cache.get(
+            video_id,
+            width,
+            fmt,
+            source_url=pick_source(info_dict) if info_dict else None
+        )
+        
+        response = send_file(
+            path,
+            mimetype=content_type,
+            conditional=True,
+            etag=media_etag(key, os.path.getsize(path)),
+            max_age=THUMBNAIL_MAX_AGE
+        )
+        response.cache_control.public = True
+        if not request.args.get('format'):
+            response.vary.add('Accept')
+        return response
+    
+    except ThumbnailFetchError as e:
+        return jsonify({'error': str(e)}), 502
+    except ThumbnailError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in thumbnail: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/download_file', methods=['GET'])
 def download_file():
     try:
-        path = request.args.get('path')
-        if not path:
-            return jsonify({'error': 'No file path provided'}), 400
+        # Files are looked up by job (or directly by media store key), never by searching TEMP_DIR
+        store_key = request.args.get('key')
+        job_id = request.args.get('job_id')
+        if job_id:
+            job = download_jobs.get(job_id)
+            if not job:
+                # Never existed, or its record expired together with its progress
+                return jsonify({'error': 'Unknown job'}), 404
+            store_key = job['store_key']
         
-        file_path = os.path.join(TEMP_DIR, path)
+        if not store_key:
+            return jsonify({'error': 'No job ID provided'}), 400
         
-        if not os.path.exists(file_path):
-            print(f"File not found at path: {file_path}, searching for alternatives...")
-            
-            # Try to find a file with a similar name
-            base_name = os.path.splitext(path)[0]
-            ext = os.path.splitext(path)[1]
-            
-            # Search for files with similar names
-            for file in os.listdir(TEMP_DIR):
-                file_base, file_ext = os.path.splitext(file)
-                
-                # Check if extensions match and if the filename is similar
-                if file_ext.lower() == ext.lower() and (
-                    file_base.lower().startswith(base_name.lower()) or
-                    base_name.lower() in file_base.lower() or
-                    file_base.lower().startswith(base_name.lower().replace(' ', '_')) or
-                    file_base.lower().startswith(base_name.lower().replace('+', ' '))
-                ):
-                    file_path = os.path.join(TEMP_DIR, file)
-                    print(f"Found alternative file for download: {file_path}")
-                    break
-            
-            # If still not found, try to find any recently created file with the right extension
-            if not os.path.exists(file_path):
-                for file in os.listdir(TEMP_DIR):
-                    if file.endswith(ext) and os.path.getmtime(os.path.join(TEMP_DIR, file)) > time.time() - 60:
-                        file_path = os.path.join(TEMP_DIR, file)
-                        print(f"Found recently modified file for download: {file_path}")
-                        break
-        
-        if not os.path.exists(file_path):
+        # Only a request from the start of the file counts as a use, not every range a player asks for
+        first_request = request.range is None or request.range.ranges[0][0] == 0
+        with span('store_lookup'):
+            entry = media_store.get(store_key, touch=first_request)
+        if not entry:
             return jsonify({'error': 'File not found'}), 404
         
-        # Send the file as an attachment
-        return send_file(file_path, as_attachment=True)
+        # Send the file as an attachment, under its original display name
+        with span('send_file'), file_serve_seconds.time():
+            response = send_media_file(
+                media_store.path(entry),
+                entry.get('display_name'),
+                media_etag(store_key, entry['size']),
+                mode=SENDFILE_MODE,
+                accel_root=media_store.root,
+                accel_prefix=X_ACCEL_PREFIX
+            )
+        if response.status_code in (200, 206):
+            served_bytes.inc(response.content_length or 0)
+        return response
     
+    except HTTPException:
+        # e.g. 416 with Content-Range for a range past the end of the file, not a server error
+        raise
     except Exception as e:
+        errors.inc(stage='serve')
         print(f"Error in download_file: {str(e)}")
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+def get_batch_urls(data):
+    """URLs of a batch request, which can give a single url, a list of urls or both"""
+    urls = data.get('urls') or []
+    if isinstance(urls, str):
+        urls = urls.split()
+    if data.get('url'):
+        urls = [data['url']] + list(urls)
+    return [url.strip() for url in urls if isinstance(url, str) and url.strip()]
+
+def expand_batch_urls(urls):
+    """Videos behind a list of URLs, caching those that flat extraction already extracted fully"""
+    items = expand_urls(urls, info_ydl_opts(), max_items=BATCH_MAX_ITEMS)
+    for item in items:
+        info_dict = item.pop('info', None)
+        if info_dict:
+            metadata_cache.put(info_dict.get('id') or item['video_id'], info_dict)
+    return items
+
+def fetch_batch_item_info(item):
+    """(info_dict, error) for one batch item, so one broken video doesn't fail the whole batch"""
+    try:
+        info_dict = fetch_video_info(item['url'])
+        if not info_dict:
+            return None, 'Could not fetch video information'
+        return info_dict, None
+    except Exception as e:
+        return None, str(e)
+
+def queue_batch_item(batch, index):
+    """Fetch the metadata of one batch item and queue its download at bulk priority"""
+    if batch.cancelled:
+        batch.update_item(index, status='cancelled')
+        return
+    
+    info_dict, error = fetch_batch_item_info(batch.items[index])
+    if error:
+        batch.update_item(index, status='error', error=error)
+        return
+    
+    format_id = select_format(info_dict, batch.quality)
+    if not format_id:
+        batch.update_item(index, status='error', error=f"No format matching quality {batch.quality}")
+        return
+    
+    try:
+        result = start_download(info_dict, format_id, batch.client_id, priority=PRIORITY_BULK, subscriber=batch.subscriber)
+        batch.update_item(
+            index,
+            status='queued',
+            job_id=result['job_id'],
+            title=info_dict.get('title'),
+            format_id=format_id,
+            total_bytes=estimate_size(info_dict, format_id)
+        )
+        if batch.cancelled:
+            # The batch was cancelled while this item was being queued
+            unsubscribe(result['job_id'], batch.subscriber)
+    except Exception as e:
+        print(f"Error queueing batch item: {str(e)}")
+        batch.update_item(index, status='error', error=str(e))
+
+def run_batch(batch):
+    """Expand a batch's URLs and queue all of its videos, in the background"""
+    try:
+        batch.set_items(expand_batch_urls(batch.urls))
+    except Exception as e:
+        print(f"Error expanding batch: {str(e)}")
+        batch.status = 'error'
+        batch.error = str(e)
+        return
+    
+    batch.status = 'fetching'
+    futures = [batch_info_pool.submit(queue_batch_item, batch, index) for index in range(len(batch.items))]
+    for future in futures:
+        future.result()
+    batch.status = 'queued'
+
+@app.route('/batch/info', methods=['POST'])
+def batch_info():
+    try:
+        urls = get_batch_urls(request.get_json(silent=True) or {})
+        
+        if not urls:
+            return jsonify({'error': 'At least one URL is required'}), 400
+        
+        items = expand_batch_urls(urls)
+        
+        videos = []
+        for item, (info_dict, error) in zip(items, batch_info_pool.map(fetch_batch_item_info, items)):
+            if error:
+                videos.append({'video_id': item['video_id'], 'url': item['url'], 'error': error})
+                continue
+            videos.append({
+                'video_id': info_dict.get('id'),
+                'url': item['url'],
+                'title': info_dict.get('title', 'Unknown Title'),
+                'author': info_dict.get('uploader', 'Unknown Author'),
+                'length': info_dict.get('duration', 0),
+                'thumbnail_url': thumbnail_url(info_dict['id'], width=160) if VIDEO_ID.fullmatch(info_dict.get('id') or '') else info_dict.get('thumbnail', '')
+            })
+        
+        return jsonify({'count': len(videos), 'videos': videos})
+    
+    except Exception as e:
+        print(f"Error in batch_info: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch/download', methods=['POST'])
+def batch_download():
+    try:
+        data = request.get_json(silent=True) or {}
+        urls = get_batch_urls(data)
+        quality = str(data.get('quality', 'best'))
+        
+        if not urls:
+            return jsonify({'error': 'At least one URL is required'}), 400
+        
+        if quality not in ('best', 'audio') and not quality.isdigit():
+            return jsonify({'error': "Quality must be 'best', 'audio' or a maximum height such as 720"}), 400
+        
+        # Forget batches nobody has looked at for a day
+        cutoff = time.time() - 86400
+        for batch_id in [batch_id for batch_id, batch in batches.items() if batch.created < cutoff]:
+            batches.pop(batch_id, None)
+        
+        batch = Batch(urls, quality=quality, client_id=get_client_id())
+        batches[batch.batch_id] = batch
+        
+        # Expanding a playlist can take a while, so answer right away and let the client poll
+        threading.Thread(target=run_batch, args=(batch,), daemon=True).start()
+        
+        return jsonify({'success': True, 'message': 'Batch accepted', 'batch_id': batch.batch_id})
+    
+    except Exception as e:
+        print(f"Error in batch_download: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch/status', methods=['GET'])
+def batch_status():
+    batch = batches.get(request.args.get('batch_id'))
+    
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    return jsonify(batch.summary(progress_with_queue_info))
+
+@app.route('/batch/cancel', methods=['POST'])
+def batch_cancel():
+    batch = batches.get((request.get_json(silent=True) or {}).get('batch_id'))
+    
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    # Items that haven't been queued yet are skipped. Queued and running ones are cancelled,
+    # unless someone else is also waiting for the same download
+    batch.cancelled = True
+    cancelled = sum(1 for item in list(batch.items) if item['job_id'] and unsubscribe(item['job_id'], batch.subscriber))
+    
+    return jsonify({'success': True, 'batch_id': batch.batch_id, 'cancelled': cancelled})
+
 if __name__ == '__main__':
     # Create directories if they don't exist
     os.makedirs('static', exist_ok=True)
     os.makedirs('templates', exist_ok=True)
     
     print("YouTube Offline Downloader starting...")
-    app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
+    # FLASK_DEBUG=0 skips the debugger and the reloader, which starts the app a second time
+    debug = os.environ.get('FLASK_DEBUG', '1') != '0'
+    port = int(os.environ.get('PORT', '5001'))
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Only the process that serves requests, not the reloader watching for changes
+        start_warm_up(port=port)
+        start_recovery()
+    app.run(debug=debug, host='0.0.0.0', port=port) 
\ No newline at end of file
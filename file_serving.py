@@ -0,0 +1,62 @@
+import os
+import unicodedata
+from urllib.parse import quote
+
+from flask import Response, send_file
+from werkzeug.http import dump_options_header
+
+
+def media_etag(store_key, size):
+    """Strong ETag for a media store artifact, which never changes once published"""
+    return f"{store_key}-{size}"
+
+
+def content_disposition(download_name):
+    """Content-Disposition header value for an attachment, built the way send_file builds it.
+
+    Header values must be Latin-1, so names with other characters get an ASCII
+    fallback in filename and the full name in RFC 5987 filename*.
+    """
+    try:
+        download_name.encode('ascii')
+        options = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        options = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+    return dump_options_header('attachment', options)
+
+
+def send_media_file(path, download_name, etag, mode='', accel_root=None, accel_prefix=None, max_age=86400):
+    """Send a stored media file with Range, If-Range, ETag and Last-Modified support.
+
+    mode selects who copies the bytes:
+      ''          this app, through the WSGI server's file wrapper
+      'x-accel'   nginx, via X-Accel-Redirect to accel_prefix + the path below accel_root
+      'x-sendfile' Apache/lighttpd, via the X-Sendfile header
+    """
+    if mode == 'x-accel':
+        # nginx serves the internal location itself, including ranges and conditional requests
+        relative_path = os.path.relpath(path, accel_root).replace(os.sep, '/')
+        response = Response(headers={
+            'X-Accel-Redirect': f"{accel_prefix.rstrip('/')}/{relative_path}",
+            'Content-Disposition': content_disposition(download_name),
+            'ETag': f'"{etag}"',
+        })
+        response.headers.pop('Content-Type', None)
+        return response
+
+    response = send_file(
+        path,
+        as_attachment=True,
+        download_name=download_name,
+        # With X-Sendfile the front server answers range and conditional requests itself
+        conditional=mode != 'x-sendfile',
+        etag=etag,
+        max_age=max_age
+    )
+    # Only the requesting client should cache a personal download
+    response.cache_control.public = False
+    response.cache_control.private = True
+
+    # With x-sendfile Flask already left the body empty and set X-Sendfile (USE_X_SENDFILE)
+    return response
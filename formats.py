@@ -0,0 +1,169 @@
+from codec_plan import codec_family, pair_audio
+
+MIB = 1024 * 1024
+
+# Human-readable names for the video codecs YouTube serves, checked in order
+CODEC_DESCRIPTIONS = [
+    (('avc', 'h264'), 'H.264'),
+    (('av1',), 'AV1'),
+    (('vp9',), 'VP9'),
+    (('vp8',), 'VP8'),
+]
+
+
+def _number(value):
+    """value if it is a usable number, otherwise None"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def describe_codec(vcodec):
+    if vcodec == 'Unknown':
+        return ''
+    for names, description in CODEC_DESCRIPTIONS:
+        if any(name in vcodec for name in names):
+            return description
+    return vcodec.upper()
+
+
+def _size_mb(filesize, bitrate, duration, scale=1):
+    """Size in MB from the exact filesize, or estimated from a kbps bitrate and the duration"""
+    if filesize:
+        return round(filesize * scale / MIB, 2)
+    if duration and bitrate:
+        return round((bitrate * 1000 * duration * scale) / (8 * MIB), 2)
+    return 'Unknown'
+
+
+def _audio_size_mb(entry, duration, scale=1):
+    """Size in MB of an audio stream, 0 if it can't be worked out"""
+    filesize = _number(entry.get('filesize'))
+    if filesize:
+        return filesize * scale / MIB
+    abr = _number(entry.get('abr'))
+    if duration and abr:
+        return (abr * 1000 * duration * scale) / (8 * MIB)
+    return 0
+
+
+class FormatTable:
+    """The download options for a video, built from its info dict in a single pass.
+
+    ``rows`` is the format list shown to the user: video formats by resolution
+    and bitrate (highest first), followed by the audio-only formats. Each row
+    says which container it is saved in and whether that needs a transcode.
+    ``get`` looks up how a format ID has to be downloaded without scanning the
+    formats again. With ``clip_duration`` the sizes are scaled down to that many seconds
+    of the video.
+    """
+
+    def __init__(self, info_dict, clip_duration=None):
+        duration = _number(info_dict.get('duration')) or 0
+        scale = min(clip_duration / duration, 1) if clip_duration and duration else 1
+        self._index = {}
+        self.best_audio = None
+        # Best audio format of each codec family, for pairing with video-only formats
+        self.audio_by_family = {}
+        video_rows = []
+        audio_rows = []
+        best_abr = None
+
+        for entry in info_dict.get('formats') or []:
+            format_id = entry.get('format_id')
+            vcodec = entry.get('vcodec')
+            acodec = entry.get('acodec')
+            self._index[format_id] = {
+                'is_audio_only': vcodec == 'none',
+                'has_audio': acodec != 'none',
+                'entry': entry,
+            }
+
+            if vcodec == 'none':
+                if acodec == 'none':
+                    continue
+                abr = entry.get('abr', 0)
+                # Highest numeric audio bitrate wins, the first audio format if none has one
+                numeric_abr = _number(abr)
+                if self.best_audio is None or (numeric_abr is not None and (best_abr is None or numeric_abr > best_abr)):
+                    self.best_audio = entry
+                    best_abr = numeric_abr
+                family = codec_family(acodec)
+                family_best = self.audio_by_family.get(family)
+                if family_best is None or (numeric_abr or 0) > (_number(family_best.get('abr')) or 0):
+                    self.audio_by_family[family] = entry
+
+                size_mb = _size_mb(entry.get('filesize'), abr, duration, scale)
+                audio_rows.append((int(format_id) if format_id and format_id.isdigit() else 0, {
+                    'format_id': format_id,
+                    'resolution': 'Audio only',
+                    'extension': entry.get('ext', 'Unknown'),
+                    'fps': 'N/A',
+                    'acodec': entry.get('acodec', 'Unknown'),
+                    'audio_quality': f"{int(abr)}kbps" if _number(abr) and abr > 0 else 'Unknown',
+                    'has_audio': True,
+                    'container': entry.get('ext', 'Unknown'),
+                    'transcode': None,
+                    'size_mb': size_mb,
+                    'final_size_mb': size_mb
+                }))
+                continue
+
+            # Skip formats without a resolution, or without what it takes to download them
+            if 'height' not in entry or not format_id or not entry.get('ext'):
+                continue
+
+            vcodec = vcodec or 'Unknown'
+            bitrate = entry.get('tbr', 0)
+            video_rows.append(((_number(entry['height']) or 0, _number(bitrate) or 0), {
+                'format_id': format_id,
+                'resolution': f"{entry['height']}p",
+                'extension': entry['ext'],
+                'fps': entry.get('fps', 'Unknown'),
+                'vcodec': vcodec,
+                'codec_description': describe_codec(vcodec),
+                'bitrate': bitrate,
+                'has_audio': acodec != 'none',
+                'size_mb': _size_mb(entry.get('filesize'), bitrate, duration, scale),
+            }, entry))
+
+        # Video-only formats are merged with an audio stream their container can hold, so include its size
+        audio_sizes = {}
+        for _, row, entry in video_rows:
+            if row['has_audio']:
+                row['container'] = row['extension']
+                row['transcode'] = None
+                row['final_size_mb'] = row['size_mb']
+                continue
+
+            row['container'], audio = pair_audio(entry, self.audio_by_family, self.best_audio)
+            row['transcode'] = None
+            size_mb = row['size_mb']
+            if audio is None:
+                row['final_size_mb'] = size_mb
+                continue
+
+            row['audio_format_id'] = audio.get('format_id')
+            if id(audio) not in audio_sizes:
+                audio_sizes[id(audio)] = _audio_size_mb(audio, duration, scale)
+            audio_size = audio_sizes[id(audio)]
+            if not audio_size:
+                row['final_size_mb'] = size_mb
+            elif size_mb == 'Unknown':
+                row['final_size_mb'] = round(audio_size, 2)
+            else:
+                row['final_size_mb'] = round(size_mb + audio_size, 2)
+
+        video_rows.sort(key=lambda item: item[0], reverse=True)
+        audio_rows.sort(key=lambda item: item[0], reverse=True)
+        self.rows = [row for _, row, _ in video_rows] + [row for _, row in audio_rows]
+
+    def get(self, format_id):
+        """Classification of a format ID (is_audio_only, has_audio, entry), or None if the video doesn't have it"""
+        return self._index.get(format_id)
+
+    def __contains__(self, format_id):
+        return format_id in self._index
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,143 @@
+import json
+import sqlite3
+import threading
+import time
+
+from progress_store import FINAL_STATUSES
+
+# What start_download needs to queue a job again, kept as JSON next to the job's state
+OPTION_FIELDS = ('clip', 'audio_format', 'bandwidth_limit')
+
+
+class JobJournal:
+    """Durable record of download jobs in SQLite, so they outlive the process.
+
+    Each job's URL, format, options, media store key, state and output path are
+    written when it is queued and whenever its state changes. The database runs
+    in WAL mode: writes append to the log without blocking readers, and a crash
+    loses at most the last transaction instead of corrupting the file. After a
+    restart, ``unfinished`` lists the jobs to queue again and ``finished`` the
+    ones whose files can still be served under their old job IDs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Durable across process crashes; only a power loss can drop the last commits
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                video_id TEXT,
+                url TEXT NOT NULL,
+                format_id TEXT NOT NULL,
+                client_id TEXT,
+                priority INTEGER,
+                options TEXT,
+                store_key TEXT,
+                display_name TEXT,
+                output_path TEXT,
+                state TEXT NOT NULL,
+                error TEXT,
+                created REAL,
+                updated REAL
+            )
+        """)
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated)')
+
+    def record(self, job_id, url, format_id, state='queued', **fields):
+        """Add a job, or replace it when a job is queued again under the same ID"""
+        options = {name: fields.pop(name, None) for name in OPTION_FIELDS}
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                """INSERT OR REPLACE INTO jobs
+                   (job_id, video_id, url, format_id, client_id, priority, options, store_key, display_name,
+                    output_path, state, error, created, updated)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL,
+                           COALESCE((SELECT created FROM jobs WHERE job_id = ?), ?), ?)""",
+                (job_id, fields.get('video_id'), url, format_id, fields.get('client_id'), fields.get('priority'),
+                 json.dumps(options), fields.get('store_key'), fields.get('display_name'),
+                 fields.get('output_path'), state, job_id, now, now)
+            )
+
+    def update(self, job_id, state=None, output_path=None, error=None, priority=None, **options):
+        """Change a job's state, output path, priority or OPTION_FIELDS, unknown jobs are ignored"""
+        unknown = set(options) - set(OPTION_FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown job options: {', '.join(sorted(unknown))}")
+        with self._lock:
+            if state is not None:
+                # Progress reports the same state many times, only write when it changes
+                self._db.execute(
+                    'UPDATE jobs SET state = ?, error = ?, updated = ? WHERE job_id = ? AND state != ?',
+                    (state, error, time.time(), job_id, state)
+                )
+            if output_path is not None:
+                self._db.execute(
+                    'UPDATE jobs SET output_path = ?, updated = ? WHERE job_id = ?',
+                    (output_path, time.time(), job_id)
+                )
+            if priority is not None:
+                self._db.execute(
+                    'UPDATE jobs SET priority = ?, updated = ? WHERE job_id = ?',
+                    (priority, time.time(), job_id)
+                )
+            if options:
+                row = self._db.execute('SELECT options FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+                if row:
+                    merged = dict(json.loads(row['options'] or '{}'), **options)
+                    self._db.execute(
+                        'UPDATE jobs SET options = ?, updated = ? WHERE job_id = ?',
+                        (json.dumps(merged), time.time(), job_id)
+                    )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def unfinished(self):
+        """Jobs that were queued or running when the process stopped, oldest first"""
+        placeholders = ', '.join('?' * len(FINAL_STATUSES))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM jobs WHERE state NOT IN ({placeholders}) ORDER BY created", FINAL_STATUSES
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def finished(self, since, state='complete'):
+        """Jobs that reached state after the timestamp since"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT * FROM jobs WHERE state = ? AND updated >= ? ORDER BY updated', (state, since)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def prune(self, max_age):
+        """Forget finished jobs last updated more than max_age seconds ago, returns how many"""
+        placeholders = ', '.join('?' * len(FINAL_STATUSES))
+        with self._lock:
+            cursor = self._db.execute(
+                f"DELETE FROM jobs WHERE state IN ({placeholders}) AND updated < ?",
+                (*FINAL_STATUSES, time.time() - max_age)
+            )
+        return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {'path': self.path, 'jobs': {state: count for state, count in rows}}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job.update(json.loads(job.pop('options') or '{}'))
+        return job
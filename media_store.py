@@ -0,0 +1,232 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+
+
+class MediaStore:
+    """Content-addressed store for finished downloads.
+
+    Artifacts are keyed by (video ID, format string, post-processing profile)
+    and recorded in ``index.json`` inside the store directory. Downloads are
+    written into a per-key staging directory and only moved into the store
+    (with an atomic rename) once they are complete, so a half-merged file is
+    never visible. When the store grows past ``max_bytes`` the least recently
+    used (``policy='lru'``) or least frequently used (``policy='lfu'``)
+    artifacts are deleted.
+
+    Changes are appended to ``index.log`` instead of rewriting the whole index,
+    which is only written out again once the log outgrows it. Access times
+    only order evictions, so they are kept in memory and appended at most
+    every ``flush_interval`` seconds (and by ``flush``).
+    """
+
+    def __init__(self, root, max_bytes=10 * 1024 ** 3, policy='lru', flush_interval=10, compact_lines=1000):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.flush_interval = flush_interval
+        self.compact_lines = compact_lines
+        self.index_path = os.path.join(root, 'index.json')
+        self.log_path = os.path.join(root, 'index.log')
+        self.staging_root = os.path.join(root, '.staging')
+        self._lock = threading.RLock()
+        self._log_lines = 0
+        self._touched = set()
+        self._last_flush = time.monotonic()
+        os.makedirs(self.staging_root, exist_ok=True)
+        with self._lock:
+            self._index = self._load_index()
+            # Start from a fresh log, new lines must never follow one a crash cut short
+            self._save_index()
+
+    @staticmethod
+    def make_key(video_id, format_string, profile):
+        """Build the store key for a (video, format, post-processing profile) combination"""
+        raw = f"{video_id}|{format_string}|{profile}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {}
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read media store index, starting empty: {e}")
+            index = {}
+
+        # Replay the changes made since the index was last written in full
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash, everything before it is intact
+                        break
+                    self._apply(index, change)
+                    self._log_lines += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not read media store log: {e}")
+
+        # Drop entries whose files were removed behind our back
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(os.path.join(self.root, entry.get('file', '')))}
+
+    @staticmethod
+    def _apply(index, change):
+        key = change.get('key')
+        if change.get('op') == 'set':
+            index[key] = change['entry']
+        elif change.get('op') == 'del':
+            index.pop(key, None)
+        elif change.get('op') == 'touch' and key in index:
+            index[key].update(last_access=change['last_access'], hits=change['hits'])
+
+    def _save_index(self):
+        # Called with the lock held. The log is only emptied once the index holds its changes
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+        open(self.log_path, 'w').close()
+        self._log_lines = 0
+        self._touched.clear()
+        self._last_flush = time.monotonic()
+
+    def _append(self, changes):
+        # Called with the lock held. Appending a line is much cheaper than rewriting the index
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            for change in changes:
+                f.write(json.dumps(change) + '\n')
+        self._log_lines += len(changes)
+        if self._log_lines > max(self.compact_lines, len(self._index)):
+            self._save_index()
+
+    def _flush_touches(self, force=False):
+        # Called with the lock held
+        if not self._touched or (not force and time.monotonic() - self._last_flush < self.flush_interval):
+            return
+        changes = [
+            {'op': 'touch', 'key': key, 'last_access': self._index[key]['last_access'], 'hits': self._index[key]['hits']}
+            for key in self._touched if key in self._index
+        ]
+        self._touched.clear()
+        self._last_flush = time.monotonic()
+        if changes:
+            self._append(changes)
+
+    def flush(self):
+        """Write access times that are still only in memory, e.g. before shutting down"""
+        with self._lock:
+            self._flush_touches(force=True)
+
+    def path(self, entry):
+        """Absolute path of a stored artifact"""
+        return os.path.join(self.root, entry['file'])
+
+    def get(self, key, touch=True):
+        """Return the index entry for key, or None if it isn't stored.
+
+        With ``touch`` the access time and hit count used for eviction are updated.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+
+            if not os.path.exists(self.path(entry)):
+                del self._index[key]
+                self._append([{'op': 'del', 'key': key}])
+                return None
+
+            if touch:
+                entry['last_access'] = time.time()
+                entry['hits'] = entry.get('hits', 0) + 1
+                self._touched.add(key)
+                self._flush_touches()
+            return dict(entry)
+
+    def entries(self, video_id):
+        """(key, entry) of every stored artifact of a video"""
+        with self._lock:
+            return [(key, dict(entry)) for key, entry in self._index.items() if entry.get('video_id') == video_id]
+
+    def staging_dir(self, key):
+        """Private directory a download for key should write into before publishing"""
+        path = os.path.join(self.staging_root, key)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def discard_staging(self, key):
+        """Remove the staging directory for key, e.g. after a failed download"""
+        shutil.rmtree(os.path.join(self.staging_root, key), ignore_errors=True)
+
+    def publish(self, key, src_path, **metadata):
+        """Atomically move a finished file into the store and index it"""
+        ext = os.path.splitext(src_path)[1]
+        file_name = f"{key}{ext}"
+        dest_path = os.path.join(self.root, file_name)
+
+        with self._lock:
+            # Same filesystem as the staging directory, so this is an atomic rename
+            os.replace(src_path, dest_path)
+            now = time.time()
+            entry = dict(metadata)
+            entry.update({
+                'file': file_name,
+                'size': os.path.getsize(dest_path),
+                'created': now,
+                'last_access': now,
+                'hits': 0,
+            })
+            self._index[key] = entry
+            evicted = self._evict(protect=key)
+            self._append([{'op': 'set', 'key': key, 'entry': entry}] + [{'op': 'del', 'key': k} for k in evicted])
+
+        self.discard_staging(key)
+        return dict(entry)
+
+    def _eviction_order(self, key):
+        entry = self._index[key]
+        if self.policy == 'lfu':
+            return (entry.get('hits', 0), entry.get('last_access', 0))
+        return entry.get('last_access', 0)
+
+    def _evict(self, protect=None):
+        total = sum(entry['size'] for entry in self._index.values())
+        evicted = []
+        if total <= self.max_bytes:
+            return evicted
+
+        for key in sorted(self._index, key=self._eviction_order):
+            if total <= self.max_bytes:
+                break
+            if key == protect:
+                continue
+            entry = self._index.pop(key)
+            evicted.append(key)
+            try:
+                os.remove(self.path(entry))
+            except FileNotFoundError:
+                pass
+            total -= entry['size']
+            print(f"Evicted {entry['file']} from media store ({entry['size'] / (1024*1024):.2f} MB)")
+        return evicted
+
+    def stats(self):
+        """Return size and usage information for the store"""
+        with self._lock:
+            return {
+                'entries': len(self._index),
+                'bytes': sum(entry['size'] for entry in self._index.values()),
+                'max_bytes': self.max_bytes,
+                'policy': self.policy,
+            }
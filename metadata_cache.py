@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Patterns for pulling the 11 character video ID out of the URL shapes we accept
+VIDEO_ID_PATTERNS = [
+    re.compile(r'(?:v=|/v/)([0-9A-Za-z_-]{11})'),
+    re.compile(r'youtu\.be/([0-9A-Za-z_-]{11})'),
+    re.compile(r'/(?:embed|shorts|live)/([0-9A-Za-z_-]{11})'),
+]
+
+
+def canonical_video_id(url):
+    """Return the YouTube video ID for a URL, or None if it can't be determined without extraction"""
+    if not url:
+        return None
+    for pattern in VIDEO_ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
+    return None
+
+
+class MetadataCache:
+    """Thread-safe in-process cache of yt-dlp info dicts keyed by video ID.
+
+    Entries expire after ``ttl`` seconds (YouTube stream URLs stop working after
+    a few hours, so this should stay well below that) and the least recently
+    used entry is dropped once ``max_entries`` is reached.
+    """
+
+    def __init__(self, ttl=1800, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, video_id):
+        """Return the cached info dict for video_id, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(video_id) if video_id else None
+            if entry is not None and entry[0] < time.time():
+                del self._entries[video_id]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(video_id)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, video_id):
+        """Return the cached info dict for video_id if there is one, without counting a hit or miss"""
+        with self._lock:
+            entry = self._entries.get(video_id) if video_id else None
+            if entry is None or entry[0] < time.time():
+                return None
+            return entry[1]
+
+    def put(self, video_id, info_dict):
+        """Store info_dict under video_id, evicting the least recently used entries if needed"""
+        if not video_id or not info_dict:
+            return
+        with self._lock:
+            self._entries[video_id] = (time.time() + self.ttl, info_dict)
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, video_id=None):
+        """Drop a single entry, or the whole cache when no video_id is given"""
+        with self._lock:
+            if video_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(video_id, None)
+
+    def stats(self):
+        """Return hit/miss counters and the current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
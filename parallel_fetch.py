@@ -0,0 +1,166 @@
+import copy
+import functools
+import os
+import threading
+
+# Protocols yt-dlp downloads fragment by fragment, where concurrent fragment downloads apply
+FRAGMENT_PROTOCOLS = ('http_dash_segments', 'm3u8_native', 'ism', 'f4m')
+
+
+class FetchTuner:
+    """Chooses how many fragments each stream downloads at once.
+
+    Every running stream gets an equal share of a global connection budget.
+    Within that share the tuner hill-climbs on measured throughput: it keeps
+    doubling the number of concurrent fragments while that makes streams
+    noticeably faster, and halves it again when it stops paying off.
+    """
+
+    def __init__(self, budget=16, max_per_stream=8, start=2):
+        self.budget = max(1, budget)
+        self.max_per_stream = max(1, max_per_stream)
+        self._level = min(start, self.max_per_stream)
+        self._throughput = {}
+        self._lock = threading.Lock()
+
+    def fragments(self, streams, running_jobs):
+        """Concurrent fragments for each of a job's streams, given how many jobs are running"""
+        share = self.budget // max(1, streams * running_jobs)
+        with self._lock:
+            return max(1, min(self._level, share, self.max_per_stream))
+
+    def record(self, level, throughput):
+        """Feed back the throughput (bytes/s) a stream achieved with level concurrent fragments"""
+        with self._lock:
+            previous = self._throughput.get(level)
+            self._throughput[level] = throughput if previous is None else 0.7 * previous + 0.3 * throughput
+            if level != self._level:
+                return
+
+            lower = self._throughput.get(level // 2) if level > 1 else None
+            if lower is None or self._throughput[level] > lower * 1.1:
+                self._level = min(level * 2, self.max_per_stream)
+            else:
+                self._level = max(1, level // 2)
+
+    def observe(self, level, d):
+        """Progress hook recording the throughput of finished fragmented streams"""
+        if d.get('status') != 'finished' or not d.get('elapsed'):
+            return
+        if (d.get('info_dict') or {}).get('protocol') not in FRAGMENT_PROTOCOLS:
+            return
+        size = d.get('total_bytes') or d.get('downloaded_bytes')
+        if size:
+            self.record(level, size / d['elapsed'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'fragments_per_stream': self._level,
+                'throughput': {level: round(value) for level, value in sorted(self._throughput.items())},
+            }
+
+
+class CombinedProgress:
+    """Merges the progress of streams downloaded at the same time into a single yt-dlp style progress hook"""
+
+    def __init__(self, names, hook):
+        self._streams = {name: {} for name in names}
+        self._hook = hook
+        self._lock = threading.Lock()
+
+    def hook(self, name):
+        return functools.partial(self._update, name)
+
+    def _update(self, name, d):
+        with self._lock:
+            self._streams[name] = d
+            if d['status'] == 'error':
+                self._hook(d)
+                return
+
+            streams = self._streams.values()
+            if all(s.get('status') == 'finished' for s in streams):
+                self._hook({'status': 'finished'})
+                return
+
+            downloaded = total = speed = 0
+            for s in streams:
+                size = s.get('total_bytes') or s.get('total_bytes_estimate') or 0
+                if s.get('status') == 'finished':
+                    downloaded += size or s.get('downloaded_bytes', 0)
+                    total += size or s.get('downloaded_bytes', 0)
+                else:
+                    downloaded += s.get('downloaded_bytes', 0)
+                    total += size
+                    speed += s.get('speed') or 0
+            # The total is only meaningful once every stream has reported its size
+            if not all(s.get('total_bytes') or s.get('total_bytes_estimate') or s.get('status') == 'finished' for s in streams):
+                total = 0
+
+            self._hook({
+                'status': 'downloading',
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'speed': speed,
+                'eta': (total - downloaded) / speed if speed and total > downloaded else None,
+                'filename': d.get('filename', ''),
+            })
+
+
+def download_parallel(info_dict, ydl_opts, streams, output_dir, basename, progress_hook, concurrent=True, checkout=None):
+    """Download several formats of a video at the same time, each with its own YoutubeDL.
+
+    streams is a list of (name, format selector) pairs. Returns a dict mapping
+    each name to the downloaded file. If one stream fails the others are
+    stopped and the first error is raised. With concurrent=False the streams
+    are downloaded one after the other instead. checkout(name, opts) returns a
+    context manager giving the YoutubeDL for a stream, by default a new one.
+    """
+    import yt_dlp
+
+    if checkout is None:
+        checkout = lambda name, opts: yt_dlp.YoutubeDL(opts)
+
+    combined = CombinedProgress([name for name, _ in streams], progress_hook)
+    stop = threading.Event()
+    paths = {}
+    errors = []
+
+    def stop_hook(d):
+        if stop.is_set():
+            raise yt_dlp.utils.DownloadCancelled('Another stream failed')
+
+    def fetch(name, selector):
+        opts = dict(
+            ydl_opts,
+            format=selector,
+            outtmpl=os.path.join(output_dir, f"{basename}.{name}.%(ext)s"),
+            progress_hooks=list(ydl_opts.get('progress_hooks', [])) + [combined.hook(name), stop_hook],
+            post_hooks=[lambda path: paths.__setitem__(name, path)],
+            postprocessors=[],
+        )
+        try:
+            with checkout(name, opts) as ydl:
+                ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    if concurrent:
+        threads = [threading.Thread(target=fetch, args=stream, daemon=True) for stream in streams]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for stream in streams:
+            if not stop.is_set():
+                fetch(*stream)
+
+    if errors:
+        # Report the failure that stopped the others, not the resulting cancellations
+        raise next((e for e in errors if not isinstance(e, yt_dlp.utils.DownloadCancelled)), errors[0])
+    return paths
+
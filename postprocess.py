@@ -0,0 +1,55 @@
+import os
+import subprocess
+
+from scheduler import DownloadScheduler
+
+
+class PostProcessPool(DownloadScheduler):
+    """Runs post-processing (ffmpeg merges and transcodes) separately from the download workers.
+
+    At most cpu_budget // threads_per_job ffmpeg processes run at once, each
+    limited to threads_per_job threads and started at a lower CPU priority
+    (nice), so post-processing can't starve the web server. Waiting tasks are
+    queued by priority and served round-robin between clients, like downloads.
+    """
+
+    def __init__(self, cpu_budget=None, threads_per_job=2, nice=10):
+        self.cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+        self.threads_per_job = max(1, min(threads_per_job, self.cpu_budget))
+        self.nice = nice
+        super().__init__(workers=self.cpu_budget // self.threads_per_job, name='postprocess')
+
+    def ffmpeg_command(self, inputs, output_path, ffmpeg_args):
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y']
+        for path in inputs:
+            command += ['-i', path]
+        return command + ['-threads', str(self.threads_per_job), *ffmpeg_args, output_path]
+
+    def run_ffmpeg(self, job, inputs, output_path, ffmpeg_args):
+        """Run ffmpeg for a post-processing task, killing it if the task is cancelled"""
+        process = subprocess.Popen(
+            self.ffmpeg_command(inputs, output_path, ffmpeg_args),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            preexec_fn=self._lower_priority if os.name == 'posix' else None
+        )
+        while True:
+            try:
+                _, stderr = process.communicate(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                if job.cancelled:
+                    process.kill()
+
+        if job.cancelled:
+            raise RuntimeError('Post-processing cancelled')
+        if process.returncode != 0:
+            error = stderr.decode('utf-8', 'replace').strip()
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {error}")
+
+    def stats(self):
+        return dict(super().stats(), cpu_budget=self.cpu_budget, threads_per_job=self.threads_per_job, nice=self.nice)
+
+    def _lower_priority(self):
+        # Runs in the child process just before ffmpeg starts
+        os.nice(self.nice)
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+
+class Prefetcher:
+    """Predicts the format a user will download, and keeps track of how often prefetching it paid off.
+
+    The prediction is the format users of this deployment picked most often
+    (YouTube's format IDs mean the same thing for every video), once at least
+    ``min_history`` choices have been seen. Until then, or when the video
+    doesn't have that format, it is the highest resolution H.264 format, which
+    gets paired with the best compatible audio. Formats larger than
+    ``max_bytes`` are never prefetched.
+
+    The app starts and cancels the actual downloads. This class remembers the
+    prefetch of each video until a download of the video is requested, which
+    makes it a hit (the predicted format) or a miss (any other format), or
+    a failure if the prefetch didn't succeed. Prefetches replaced by newer
+    ones before anyone asked are abandoned.
+    """
+
+    def __init__(self, max_jobs=2, max_bytes=500 * 1024 ** 2, history=200, min_history=5, max_entries=1000):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.min_history = min_history
+        self.max_entries = max_entries
+        self._choices = deque(maxlen=history)
+        self._entries = OrderedDict()
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record_choice(self, format_id):
+        """Remember a format a user asked to download"""
+        with self._lock:
+            self._choices.append(format_id)
+
+    def predict(self, rows):
+        """(format_id, reason) for the format table rows of a video, or (None, reason) if nothing should be prefetched"""
+        by_id = {row['format_id']: row for row in rows}
+        with self._lock:
+            popular = [format_id for format_id, _ in Counter(self._choices).most_common()] if len(self._choices) >= self.min_history else []
+
+        candidates = [(format_id, 'history') for format_id in popular if format_id in by_id]
+        candidates += [(row['format_id'], 'default') for row in rows if row.get('codec_description') == 'H.264'][:1]
+        for format_id, reason in candidates:
+            size_mb = by_id[format_id].get('final_size_mb')
+            if not isinstance(size_mb, (int, float)):
+                # Unknown sizes could be anything, don't risk the disk on them
+                continue
+            if size_mb * 1024 ** 2 > self.max_bytes:
+                return None, 'too_large'
+            return format_id, reason
+        return None, 'no_candidate'
+
+    def start(self, video_id, job_id, format_id, size_bytes):
+        with self._lock:
+            self._entries[video_id] = {
+                'job_id': job_id,
+                'format_id': format_id,
+                'size_bytes': size_bytes,
+                'started': time.time(),
+            }
+            self._entries.move_to_end(video_id)
+            self._counts['started'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts['abandoned'] += 1
+
+    def get(self, video_id):
+        with self._lock:
+            entry = self._entries.get(video_id)
+            return dict(entry) if entry else None
+
+    def running(self, is_running):
+        """Unclaimed prefetches whose job is still queued or downloading, oldest first, as (video_id, entry)"""
+        with self._lock:
+            entries = list(self._entries.items())
+        return [(video_id, dict(entry)) for video_id, entry in entries if is_running(entry['job_id'])]
+
+    def skip(self, reason):
+        with self._lock:
+            self._counts[f"skipped_{reason}"] += 1
+
+    def claim(self, video_id, format_id, status):
+        """Resolve the prefetch of a video that a user now downloads format_id of.
+
+        format_id is None for downloads a prefetch can't produce (clips, MP3s).
+        status is the prefetch job's progress status. Returns the prefetch
+        entry and the outcome: 'hit' (the job has already finished),
+        'partial_hit' (it is still running), 'miss', 'failed', or None if the
+        video wasn't prefetched.
+        """
+        with self._lock:
+            entry = self._entries.pop(video_id, None)
+            if entry is None:
+                return None, None
+            if entry['format_id'] != format_id:
+                outcome = 'miss'
+            elif status in ('error', 'cancelled'):
+                outcome = 'failed'
+            else:
+                outcome = 'hit' if status == 'complete' else 'partial_hit'
+            self._counts[outcome] += 1
+            return entry, outcome
+
+    def abandon(self, video_id):
+        with self._lock:
+            if self._entries.pop(video_id, None) is not None:
+                self._counts['abandoned'] += 1
+
+    def counts(self):
+        """Prefetch outcomes so far, as {(outcome,): count} for the metrics registry"""
+        with self._lock:
+            return {(outcome,): count for outcome, count in self._counts.items() if outcome != 'started'}
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            history = Counter(self._choices).most_common(5)
+            pending = len(self._entries)
+        resolved = sum(counts.get(outcome, 0) for outcome in ('hit', 'partial_hit', 'miss', 'failed', 'abandoned'))
+        hits = counts.get('hit', 0) + counts.get('partial_hit', 0)
+        return {
+            'max_jobs': self.max_jobs,
+            'max_bytes': self.max_bytes,
+            'pending': pending,
+            'outcomes': counts,
+            'hit_rate': round(hits / resolved, 3) if resolved else None,
+            'popular_formats': [{'format_id': format_id, 'choices': count} for format_id, count in history],
+        }
@@ -0,0 +1,157 @@
+import cProfile
+import contextvars
+import io
+import json
+import pstats
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Trace of the request or job running in the current context
+_current = contextvars.ContextVar('trace', default=None)
+
+# cProfile can only profile one thing at a time on newer Pythons, later requests go unprofiled meanwhile
+_profile_lock = threading.Lock()
+
+
+class Trace:
+    """Span timings, and optionally a cProfile profile, of one request or background job"""
+
+    def __init__(self, name, profile=False):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.time()
+        self.duration = None
+        self.spans = []
+        self.fields = {}
+        self.profiler = None
+        self._start = time.perf_counter()
+        self._token = None
+        if profile and _profile_lock.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+
+    def run(self, func, *args):
+        """Call func, profiling it if this trace is profiled. Used for work handed to another thread"""
+        if self.profiler is None:
+            return func(*args)
+        return self.profiler.runcall(func, *args)
+
+    def profile_text(self, limit=40, sort='cumulative'):
+        """The functions that took the longest, as printed by pstats"""
+        if self.profiler is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def to_dict(self):
+        return dict(
+            self.fields,
+            trace_id=self.trace_id,
+            name=self.name,
+            started=self.started,
+            duration=self.duration,
+            spans=self.spans,
+            profiled=self.profiler is not None
+        )
+
+
+@contextmanager
+def span(name):
+    """Record how long the body of a with block takes in the current trace, if there is one"""
+    trace = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.spans.append({'name': name, 'seconds': round(time.perf_counter() - start, 4)})
+
+
+def current_trace():
+    return _current.get()
+
+
+class Profiler:
+    """Traces requests and background jobs and logs the slow ones.
+
+    Every trace records spans (see ``span``). mode selects what is also
+    profiled with cProfile: 'off', 'header' (requests sent with an
+    ``X-Profile: 1`` header) or 'all'. Traces taking at least slow_seconds are
+    written to log_path (stdout if not set) as one JSON object per line.
+    Profiled and slow traces are kept, the most recent ``keep`` of them.
+    """
+
+    def __init__(self, mode='off', slow_seconds=5.0, log_path=None, keep=20):
+        self.mode = mode
+        self.slow_seconds = slow_seconds
+        self.log_path = log_path
+        self._recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def wants_profile(self, headers=None):
+        if self.mode == 'all':
+            return True
+        return self.mode == 'header' and headers is not None and headers.get('X-Profile') == '1'
+
+    def start(self, name, profile=False, enable=True):
+        """Start a trace and make it the current one. Must be finished in the same context.
+
+        A profiled trace profiles the calling thread from now on, unless enable
+        is False, in which case only the work passed to Trace.run is profiled.
+        """
+        trace = Trace(name, profile)
+        trace._token = _current.set(trace)
+        if trace.profiler is not None and enable:
+            trace.profiler.enable()
+        return trace
+
+    def finish(self, trace, **fields):
+        """End a trace, keep it if it was profiled or slow, and log it if it was slow"""
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            _profile_lock.release()
+        trace.duration = round(time.perf_counter() - trace._start, 4)
+        trace.fields.update(fields)
+        if trace._token is not None:
+            try:
+                _current.reset(trace._token)
+            except ValueError:
+                # Finished from another context than it was started in
+                _current.set(None)
+            trace._token = None
+
+        slow = trace.duration >= self.slow_seconds
+        if slow or trace.profiler is not None:
+            with self._lock:
+                self._recent.append(trace)
+        if slow:
+            self._log(trace)
+        return trace
+
+    @contextmanager
+    def trace(self, name, profile=False, **fields):
+        """Trace the body of a with block, profiling it when asked. Profiling happens in the calling thread"""
+        trace = self.start(name, profile)
+        try:
+            yield trace
+        finally:
+            self.finish(trace, **fields)
+
+    def recent(self):
+        with self._lock:
+            return [trace.to_dict() for trace in reversed(self._recent)]
+
+    def get(self, trace_id):
+        with self._lock:
+            return next((trace for trace in self._recent if trace.trace_id == trace_id), None)
+
+    def _log(self, trace):
+        line = json.dumps(dict(trace.to_dict(), event='slow'))
+        if not self.log_path:
+            print(line)
+            return
+        with self._lock, open(self.log_path, 'a') as f:
+            f.write(line + '\n')
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import threading
+
+from progress_store import FINAL_STATUSES
+
+
+class ProgressBroker:
+    """Notifies waiting listeners when a download's progress changes.
+
+    Every publish bumps a per-key version number. Listeners remember the last
+    version they saw and block in ``wait`` until a newer one exists, so any
+    number of updates published in between are coalesced into a single wake-up.
+    Threads wait with ``wait``, asyncio tasks with ``wait_async``, which doesn't
+    tie up a thread per listener.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._listeners = {}
+        self._async_waiters = {}
+
+    def _condition(self, key):
+        condition = self._conditions.get(key)
+        if condition is None:
+            condition = self._conditions[key] = threading.Condition(self._lock)
+        return condition
+
+    def publish(self, key):
+        """Record a change for key and wake up everyone waiting on it"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            if self._listeners.get(key):
+                self._conditions[key].notify_all()
+            waiters = self._async_waiters.pop(key, ())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def version(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def wait(self, key, since, timeout):
+        """Block until key's version is newer than since (or timeout) and return the current version"""
+        with self._lock:
+            condition = self._condition(key)
+            self._listeners[key] = self._listeners.get(key, 0) + 1
+            try:
+                condition.wait_for(lambda: self._versions.get(key, 0) > since, timeout)
+                return self._versions.get(key, 0)
+            finally:
+                self._listeners[key] -= 1
+                if not self._listeners[key]:
+                    del self._listeners[key]
+                    del self._conditions[key]
+
+    async def wait_async(self, key, since, timeout):
+        """Like wait, for coroutines running on an asyncio event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._versions.get(key, 0) > since:
+                return self._versions[key]
+            waiter = (loop, loop.create_future())
+            self._async_waiters.setdefault(key, []).append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                waiters = self._async_waiters.get(key)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._async_waiters[key]
+        return self.version(key)
+
+    def forget(self, key):
+        """Drop the version kept for a key that will not be published again"""
+        with self._lock:
+            if not self._listeners.get(key) and not self._async_waiters.get(key):
+                self._versions.pop(key, None)
+
+    def listeners(self):
+        """Total number of listeners currently waiting"""
+        with self._lock:
+            return sum(self._listeners.values()) + sum(len(waiters) for waiters in self._async_waiters.values())
+
+
+class ProgressEventStream:
+    """The Server-Sent Events of one job's progress stream.
+
+    Decides what the threaded and the asyncio server send: the progress
+    payloads, when the stream ends, and what goes out while nothing changes.
+    The servers only differ in how they wait, so each runs the same loop: send
+    ``RETRY``, then ``next_event`` until it is ``finished``, waiting
+    ``wait_timeout`` seconds on the broker whenever there is no event and
+    sending ``idle`` (if not None) when that wait times out. ``load`` returns
+    a job's (payload, HTTP status) and ``status`` its bare status.
+    """
+
+    # Ask the browser to wait a little before reconnecting if the connection drops
+    RETRY = "retry: 3000\n\n"
+
+    def __init__(self, job_id, broker, load, status):
+        self.job_id = job_id
+        self.version = -1
+        self.finished = False
+        self._broker = broker
+        self._load = load
+        self._status = status
+        self._queued = False
+
+    def next_event(self):
+        """Event with the job's current progress, None if nothing was published since the last one"""
+        current = self._broker.version(self.job_id)
+        if current == self.version:
+            return None
+        self.version = current
+        payload, _ = self._load(self.job_id)
+        if payload.get('status') == 'unknown':
+            # Never existed or already expired, nothing will ever be published for it
+            payload = {'status': 'error', 'error': 'Unknown job'}
+        self.finished = payload.get('status') in FINAL_STATUSES
+        return f"data: {json.dumps(payload)}\n\n"
+
+    def wait_timeout(self):
+        # Queue position isn't published, so refresh queued downloads more often
+        self._queued = self._status(self.job_id) == 'queued'
+        return 5 if self._queued else 15
+
+    def idle(self):
+        """What to send after a wait timed out: nothing for a queued job, whose next event is sent again instead"""
+        if self._queued:
+            self.version = -1
+            return None
+        # Comment line that keeps proxies from closing an idle connection
+        return ": keep-alive\n\n"
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Statuses after which a job's progress no longer changes
+FINAL_STATUSES = ('complete', 'error', 'cancelled')
+
+
+class ProgressRecord:
+    """Progress of one job. Updated in place by the download hooks instead of being rebuilt on every callback"""
+
+    __slots__ = ('status', 'percent', 'downloaded_bytes', 'total_bytes', 'filename', 'error',
+                 'last_updated', 'last_published', 'samples', 'extra')
+
+    def __init__(self, status, samples, **fields):
+        self.status = status
+        self.percent = fields.pop('percent', 0)
+        self.downloaded_bytes = fields.pop('downloaded_bytes', None)
+        self.total_bytes = fields.pop('total_bytes', None)
+        self.filename = fields.pop('filename', None)
+        self.error = fields.pop('error', None)
+        self.last_updated = fields.pop('last_updated', None) or time.time()
+        self.last_published = 0
+        # (time, downloaded bytes) samples used for a smoothed speed
+        self.samples = deque(maxlen=samples)
+        # Anything else callers attach, e.g. is_audio_only
+        self.extra = fields
+
+    def speed(self):
+        """Average bytes per second over the sample window, None until there are two samples"""
+        if len(self.samples) < 2:
+            return None
+        (first_time, first_bytes), (last_time, last_bytes) = self.samples[0], self.samples[-1]
+        if last_time <= first_time:
+            return None
+        return max(last_bytes - first_bytes, 0) / (last_time - first_time)
+
+    def to_dict(self):
+        progress = {'status': self.status, 'percent': self.percent, 'last_updated': self.last_updated}
+        if self.total_bytes:
+            progress['downloaded_bytes'] = self.downloaded_bytes
+            progress['total_bytes'] = self.total_bytes
+            speed = self.speed()
+            progress['speed'] = round(speed) if speed is not None else None
+            if speed:
+                progress['eta'] = round(max(self.total_bytes - self.downloaded_bytes, 0) / speed, 2)
+            else:
+                progress['eta'] = None
+        if self.filename:
+            progress['filename'] = self.filename
+        if self.error:
+            progress['error'] = self.error
+        progress.update(self.extra)
+        return progress
+
+
+class ProgressStore:
+    """Thread-safe store of job progress.
+
+    Byte counts reported by download hooks only notify listeners (``on_change``)
+    at most once every ``min_interval`` seconds; status changes always do.
+    Finished jobs are dropped ``ttl`` seconds after their last update, and jobs
+    that stopped reporting altogether after ``stale_ttl``. ``on_evict`` is
+    called with the job ID of every dropped job.
+    """
+
+    def __init__(self, ttl=3600, stale_ttl=86400, max_entries=10000, min_interval=0.25, samples=10,
+                 on_change=None, on_evict=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.min_interval = min_interval
+        self.samples = samples
+        self.on_change = on_change
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def set(self, job_id, status, **fields):
+        """Replace a job's progress with a new status (e.g. queued, processing, complete)"""
+        record = ProgressRecord(status, self.samples, **fields)
+        with self._lock:
+            self._records.pop(job_id, None)
+            self._records[job_id] = record
+            record.last_published = record.last_updated
+            evicted = self._prune(record.last_updated)
+        self._notify(job_id, evicted)
+
+    def update_bytes(self, job_id, downloaded_bytes, total_bytes, filename=None):
+        """Record bytes reported by a download hook, notifying listeners at most every min_interval"""
+        now = time.time()
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record.status in FINAL_STATUSES:
+                return
+            if record.status != 'downloading':
+                record.status = 'downloading'
+                record.last_published = 0
+            if downloaded_bytes < (record.downloaded_bytes or 0):
+                # yt-dlp moved on to the next stream (e.g. audio after video), restart the speed window
+                record.samples.clear()
+            record.downloaded_bytes = downloaded_bytes
+            record.total_bytes = total_bytes
+            record.percent = round(downloaded_bytes / total_bytes * 100, 2) if total_bytes else 0
+            if filename:
+                record.filename = filename
+            record.samples.append((now, downloaded_bytes))
+            record.last_updated = now
+            self._records.move_to_end(job_id)
+
+            if now - record.last_published < self.min_interval:
+                return
+            record.last_published = now
+        self._notify(job_id, ())
+
+    def get(self, job_id):
+        """A job's progress as a dict, or None if the job is unknown"""
+        with self._lock:
+            record = self._records.get(job_id)
+            return record.to_dict() if record is not None else None
+
+    def status(self, job_id):
+        with self._lock:
+            record = self._records.get(job_id)
+            return record.status if record is not None else None
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._records), 'max_entries': self.max_entries, 'evictions': self.evictions}
+
+    def _prune(self, now):
+        """Drop expired records, and the oldest ones beyond max_entries. Called with the lock held"""
+        evicted = []
+        if now - self._last_prune >= 60:
+            self._last_prune = now
+            for job_id, record in list(self._records.items()):
+                age = now - record.last_updated
+                if age > self.stale_ttl or (record.status in FINAL_STATUSES and age > self.ttl):
+                    del self._records[job_id]
+                    evicted.append(job_id)
+
+        while len(self._records) > self.max_entries:
+            job_id, _ = self._records.popitem(last=False)
+            evicted.append(job_id)
+
+        self.evictions += len(evicted)
+        return evicted
+
+    def _notify(self, job_id, evicted):
+        if self.on_change:
+            self.on_change(job_id)
+        if self.on_evict:
+            for evicted_id in evicted:
+                self.on_evict(evicted_id)
@@ -7,24 +7,25 @@ This script will check for required dependencies and install them if needed.
 
 import os
 import sys
+import runpy
 import subprocess
+import importlib.util
 
-def check_dependency(package):
-    """Check if a Python package is installed."""
-    try:
-        __import__(package)
-        return True
-    except ImportError:
-        return False
+# Module each dependency is imported as, and the package pip installs it from
+DEPENDENCIES = [
+    ('flask', 'flask'),
+    ('flask_cors', 'flask-cors'),
+    ('yt_dlp', 'yt-dlp'),
+    ('ffmpeg', 'ffmpeg-python'),
+]
+
+def check_dependency(module):
+    """Check if a Python package is installed, without importing it."""
+    return importlib.util.find_spec(module) is not None
 
 def install_dependencies():
     """Install required dependencies."""
-    dependencies = ['flask', 'flask_cors', 'yt_dlp', 'ffmpeg']
-    missing = []
-    
-    for dep in dependencies:
-        if not check_dependency(dep.replace('-', '_')):
-            missing.append(dep)
+    missing = [package for module, package in DEPENDENCIES if not check_dependency(module)]
     
     if missing:
         print(f"Installing missing dependencies: {', '.join(missing)}")
@@ -36,15 +37,15 @@ def install_dependencies():
             sys.exit(1)
 
 def run_app():
-    """Run the application."""
+    """Run the application in this process, instead of starting a second interpreter."""
     try:
         # Try to run the enhanced version first
         if os.path.exists('enhanced_app.py'):
             print("Running enhanced version...")
-            os.system(f"{sys.executable} enhanced_app.py")
+            runpy.run_path('enhanced_app.py', run_name='__main__')
         else:
             print("Running basic version...")
-            os.system(f"{sys.executable} app.py")
+            runpy.run_path('app.py', run_name='__main__')
     except Exception as e:
         print(f"Error running application: {e}")
         sys.exit(1)
@@ -0,0 +1,226 @@
+import math
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+# Priority levels, lower values are dispatched first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+
+
+class Job:
+    """A unit of work queued on the DownloadScheduler"""
+
+    def __init__(self, target, client_id, priority, job_id=None, on_cancel=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.target = target
+        self.client_id = client_id
+        self.priority = priority
+        self.on_cancel = on_cancel
+        self.state = 'queued'
+        self.cancel_event = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class DownloadScheduler:
+    """Runs jobs on a fixed number of worker threads.
+
+    Jobs are grouped by priority and, within a priority, by client. Each
+    client has its own FIFO queue and clients are served round-robin, so one
+    client submitting a burst of jobs can't starve everybody else.
+    ``limits`` caps the number of running jobs of a priority, so that e.g.
+    background work never occupies every worker, as running jobs are never
+    preempted.
+    """
+
+    def __init__(self, workers=2, default_duration=60.0, name='download', limits=None):
+        self.workers = max(1, workers)
+        self.limits = dict(limits or {})
+        self._queues = {}
+        self._jobs = {}
+        self._running = 0
+        self._running_by_priority = {}
+        # Moving average of job run time, used to estimate queue start times
+        self._avg_duration = default_duration
+        self._completed = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{name}-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, target, client_id='anonymous', priority=PRIORITY_INTERACTIVE, job_id=None, on_cancel=None):
+        """Queue target(job) to run on a worker and return the Job"""
+        job = Job(target, client_id, priority, job_id=job_id, on_cancel=on_cancel)
+        with self._cond:
+            clients = self._queues.setdefault(priority, OrderedDict())
+            clients.setdefault(client_id, deque()).append(job)
+            self._jobs[job.job_id] = job
+            self._cond.notify()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job. Queued jobs are dropped, running jobs are asked to stop.
+
+        Returns False if the job is unknown or already finished.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state not in ('queued', 'running'):
+                return False
+
+            job.cancel_event.set()
+            if job.state == 'running':
+                # The target is expected to check job.cancel_event and stop
+                return True
+
+            clients = self._queues[job.priority]
+            clients[job.client_id].remove(job)
+            if not clients[job.client_id]:
+                del clients[job.client_id]
+            self._finish(job, 'cancelled')
+
+        if job.on_cancel:
+            job.on_cancel(job)
+        return True
+
+    def reprioritize(self, job_id, priority):
+        """Move a queued job to another priority, at the back of its client's queue there"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.priority == priority:
+                return
+            if job.state == 'queued':
+                clients = self._queues[job.priority]
+                clients[job.client_id].remove(job)
+                if not clients[job.client_id]:
+                    del clients[job.client_id]
+                self._queues.setdefault(priority, OrderedDict()).setdefault(job.client_id, deque()).append(job)
+                self._cond.notify()
+            elif job.state == 'running':
+                # Frees a slot under the old priority's limit
+                self._running_by_priority[job.priority] -= 1
+                self._running_by_priority[priority] = self._running_by_priority.get(priority, 0) + 1
+                self._cond.notify()
+            job.priority = priority
+
+    def position(self, job_id):
+        """Number of queued jobs that will be dispatched before job_id, or None if it isn't queued"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != 'queued':
+                return None
+
+            ahead = 0
+            for priority in sorted(self._queues):
+                clients = self._queues[priority]
+                if priority != job.priority:
+                    ahead += sum(len(queue) for queue in clients.values())
+                    continue
+
+                # Round-robin dispatch: every client ahead of us in rotation gets one more
+                # turn than our index in our own queue, everyone after us gets the same number
+                index = clients[job.client_id].index(job)
+                before_us = True
+                for client_id, queue in clients.items():
+                    if client_id == job.client_id:
+                        before_us = False
+                        continue
+                    ahead += min(len(queue), index + 1 if before_us else index)
+                ahead += index
+                break
+            return ahead
+
+    def estimated_start(self, job_id):
+        """Rough number of seconds until job_id starts, based on recent job durations"""
+        position = self.position(job_id)
+        if position is None:
+            return None
+        with self._cond:
+            idle = self.workers - self._running
+            if position < idle:
+                return 0
+            waves = math.ceil((position + 1 - idle) / self.workers)
+            return round(waves * self._avg_duration, 1)
+
+    def stats(self):
+        with self._cond:
+            queued = sum(len(queue) for clients in self._queues.values() for queue in clients.values())
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'limits': self.limits,
+                'queued': queued,
+                'completed': self._completed,
+                'avg_duration': round(self._avg_duration, 2),
+            }
+
+    def _next_job(self):
+        for priority in sorted(self._queues):
+            clients = self._queues[priority]
+            if not clients or self._running_by_priority.get(priority, 0) >= self.limits.get(priority, self.workers):
+                continue
+            client_id, queue = next(iter(clients.items()))
+            job = queue.popleft()
+            # Rotate this client to the back so the next client gets the following turn
+            del clients[client_id]
+            if queue:
+                clients[client_id] = queue
+            return job
+        return None
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        # Finished jobs stay visible for a while so their state can still be queried
+        cutoff = job.finished_at - 3600
+        for old_id, old_job in list(self._jobs.items()):
+            if old_job.finished_at and old_job.finished_at < cutoff:
+                del self._jobs[old_id]
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.state = 'running'
+                job.started_at = time.time()
+                self._running += 1
+                self._running_by_priority[job.priority] = self._running_by_priority.get(job.priority, 0) + 1
+
+            state = 'done'
+            try:
+                job.target(job)
+                if job.cancelled:
+                    state = 'cancelled'
+            except Exception as e:
+                state = 'cancelled' if job.cancelled else 'failed'
+                print(f"Error in scheduled job {job.job_id}: {str(e)}")
+                print(traceback.format_exc())
+
+            with self._cond:
+                self._running -= 1
+                self._running_by_priority[job.priority] -= 1
+                # A job held back by its priority's limit may be able to start on an idle worker now
+                self._cond.notify()
+                duration = time.time() - job.started_at
+                if state == 'done':
+                    self._completed += 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                self._finish(job, state)
@@ -17,9 +17,22 @@ document.addEventListener('DOMContentLoaded', () => {
     const downloadSpeed = document.getElementById('download-speed');
     const downloadSize = document.getElementById('download-size');
     const downloadEta = document.getElementById('download-eta');
+    const cancelBtn = document.getElementById('cancel-btn');
+    const streamModeCheckbox = document.getElementById('stream-mode');
+    const clipStartInput = document.getElementById('clip-start');
+    const clipEndInput = document.getElementById('clip-end');
+    const clipChapterSelect = document.getElementById('clip-chapter');
+    const clipSummary = document.getElementById('clip-summary');
+    
+    // Job ID of the download currently being tracked, used for cancelling
+    let currentJobId = null;
     
     // Event Listeners
     fetchBtn.addEventListener('click', fetchVideoInfo);
+    cancelBtn.addEventListener('click', cancelDownload);
+    clipStartInput.addEventListener('change', refreshFormatSizes);
+    clipEndInput.addEventListener('change', refreshFormatSizes);
+    clipChapterSelect.addEventListener('change', refreshFormatSizes);
     videoUrlInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter') {
             fetchVideoInfo();
@@ -45,12 +58,43 @@ document.addEventListener('DOMContentLoaded', () => {
         hideVideoInfo();
         hideDownloadProgress();
         
-        fetch('/get_video_info', {
+        // A new video starts without a clip
+        clipStartInput.value = '';
+        clipEndInput.value = '';
+        clipChapterSelect.value = '';
+        
+        requestVideoInfo(url)
+        .then(data => {
+            displayVideoInfo(data);
+            hideLoading();
+        })
+        .catch(error => {
+            hideLoading();
+            showError(error.message);
+            console.error('Error fetching video info:', error);
+        });
+    }
+    
+    // Fetch the format table again so the sizes match the selected clip
+    function refreshFormatSizes() {
+        const url = videoUrlInput.value.trim();
+        
+        hideError();
+        requestVideoInfo(url, getClipOptions())
+        .then(data => displayVideoInfo(data))
+        .catch(error => {
+            showError(error.message);
+            console.error('Error updating clip sizes:', error);
+        });
+    }
+    
+    function requestVideoInfo(url, clipOptions = {}) {
+        return fetch('/get_video_info', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ url }),
+            body: JSON.stringify({ url, ...clipOptions }),
         })
         .then(response => {
             if (!response.ok) {
@@ -64,24 +108,57 @@ document.addEventListener('DOMContentLoaded', () => {
             if (data.error) {
                 throw new Error(data.error);
             }
-            
-            displayVideoInfo(data);
-            hideLoading();
-        })
-        .catch(error => {
-            hideLoading();
-            showError(error.message);
-            console.error('Error fetching video info:', error);
+            return data;
         });
     }
     
+    // Start/end timestamps, or a chapter, of the part of the video to download
+    function getClipOptions() {
+        const options = {};
+        if (clipChapterSelect.value) {
+            options.chapters = [clipChapterSelect.value];
+        } else {
+            if (clipStartInput.value.trim()) {
+                options.start = clipStartInput.value.trim();
+            }
+            if (clipEndInput.value.trim()) {
+                options.end = clipEndInput.value.trim();
+            }
+        }
+        return options;
+    }
+    
+    function displayChapters(data) {
+        const selected = clipChapterSelect.value;
+        clipChapterSelect.innerHTML = '<option value="">or pick a chapter...</option>';
+        (data.chapters || []).forEach(chapter => {
+            const option = document.createElement('option');
+            option.value = chapter.title;
+            option.textContent = `${chapter.title} (${formatDuration(Math.round(chapter.start_time || 0)) || '0:00'})`;
+            clipChapterSelect.appendChild(option);
+        });
+        clipChapterSelect.value = selected;
+        clipChapterSelect.classList.toggle('hidden', !(data.chapters && data.chapters.length));
+        
+        if (data.clip) {
+            clipSummary.textContent = `Sizes below are for the ${formatDuration(Math.round(data.clip.duration))} clip from ${formatDuration(Math.round(data.clip.start)) || '0:00'} to ${formatDuration(Math.round(data.clip.end))}.`;
+            clipSummary.classList.remove('hidden');
+        } else {
+            clipSummary.classList.add('hidden');
+        }
+    }
+    
     function displayVideoInfo(data) {
         try {
             // Set video details
             videoThumbnail.src = data.thumbnail || '';
+            // Proxied thumbnails also come at twice the size for high density screens
+            videoThumbnail.srcset = data.thumbnail && data.thumbnail.startsWith('/thumb/') ?
+                `${data.thumbnail}?w=640 2x` : '';
             videoTitle.textContent = data.title || 'Unknown Title';
             videoAuthor.textContent = data.uploader || 'Unknown Author';
             videoDuration.textContent = formatDuration(data.duration || 0);
+            displayChapters(data);
             
             // Clear previous streams
             streamsTable.innerHTML = '';
@@ -118,25 +195,41 @@ document.addEventListener('DOMContentLoaded', () => {
                     `${format.final_size_mb} MB` : 
                     (format.final_size_mb || 'Unknown size');
                 
+                // Output container, and whether getting it needs a re-encode
+                const outputDisplay = `${format.container || format.extension} ${transcodeBadge(format.transcode)}`;
+                
+                // Audio streams can also be converted to MP3, which is a re-encode
+                const mp3Button = format.resolution === 'Audio only' ? `
+                        <button class="download-btn mp3-btn" title="Re-encodes the audio to MP3">
+                            <i class="fas fa-music"></i> MP3
+                        </button>` : '';
+                
                 row.innerHTML = `
                     <td>${format.resolution || 'Unknown'}</td>
                     <td>${formatDescription}</td>
                     <td>${format.fps || 'N/A'}</td>
                     <td>${sizeDisplay}</td>
+                    <td>${outputDisplay}</td>
                     <td>
                         <button class="download-btn" data-format-id="${format.format_id}">
                             <i class="fas fa-download"></i> Download
-                        </button>
+                        </button>${mp3Button}
                     </td>
                 `;
                 
                 streamsTable.appendChild(row);
                 
-                // Add download event listener
+                // Add download event listeners
                 const downloadBtn = row.querySelector('.download-btn');
                 downloadBtn.addEventListener('click', () => {
                     downloadVideo(format.format_id);
                 });
+                const mp3Btn = row.querySelector('.mp3-btn');
+                if (mp3Btn) {
+                    mp3Btn.addEventListener('click', () => {
+                        downloadVideo(format.format_id, 'mp3');
+                    });
+                }
             });
             
             showVideoInfo();
@@ -146,9 +239,31 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
-    function downloadVideo(format_id) {
+    function transcodeBadge(transcode) {
+        if (transcode) {
+            return `<span class="transcode-badge transcode-yes" title="${transcode}">Re-encode</span>`;
+        }
+        return '<span class="transcode-badge transcode-no" title="Streams are copied as they are">No re-encoding</span>';
+    }
+    
+    function downloadVideo(format_id, audio_format = 'original') {
         try {
             const url = videoUrlInput.value.trim();
+            const clipOptions = getClipOptions();
+            
+            // In streaming mode the browser receives the file while the server is still fetching it
+            if (streamModeCheckbox.checked) {
+                if (Object.keys(clipOptions).length) {
+                    showError("Clips can't be streamed, untick streaming to download part of the video");
+                    return;
+                }
+                if (audio_format !== 'original') {
+                    showError("MP3 conversion can't be streamed, untick streaming to convert the audio");
+                    return;
+                }
+                window.location.href = `/download?url=${encodeURIComponent(url)}&format_id=${encodeURIComponent(format_id)}`;
+                return;
+            }
             
             hideVideoInfo();
             showDownloadProgress();
@@ -162,7 +277,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ url, format_id }),
+                body: JSON.stringify({ url, format_id, audio_format, ...clipOptions }),
             })
             .then(response => {
                 if (!response.ok) {
@@ -177,15 +292,15 @@ document.addEventListener('DOMContentLoaded', () => {
                     throw new Error(data.error);
                 }
                 
-                // Start polling for progress updates
-                const videoId = data.video_id;
-                const filename = data.filename;
+                // Start listening for progress updates
+                const jobId = data.job_id;
                 
-                if (videoId) {
-                    // Start progress polling
-                    pollDownloadProgress(videoId, filename);
+                if (jobId) {
+                    currentJobId = jobId;
+                    // Start progress updates
+                    trackDownloadProgress(jobId);
                 } else {
-                    throw new Error('No video ID returned from server');
+                    throw new Error('No job ID returned from server');
                 }
             })
             .catch(error => {
@@ -200,100 +315,218 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
-    // Function to poll for download progress
-    function pollDownloadProgress(videoId, filename) {
-        // Clear any existing interval
-        if (window.progressInterval) {
-            clearInterval(window.progressInterval);
+    // Follow download progress, pushed by the server as Server-Sent Events
+    function trackDownloadProgress(jobId) {
+        stopProgressUpdates();
+        
+        const query = `job_id=${encodeURIComponent(jobId)}`;
+        
+        if (!window.EventSource) {
+            longPollDownloadProgress(query, -1);
+            return;
         }
         
-        // Set up polling interval (check every 500ms)
-        window.progressInterval = setInterval(() => {
-            fetch(`/check_download_status?video_id=${videoId}&filename=${filename}`)
-                .then(response => response.json())
-                .then(data => {
-                    // Update progress bar
-                    if (data.percent) {
-                        updateProgressBar(data.percent);
-                    }
-                    
-                    // Update status message
-                    if (data.status === 'downloading') {
-                        // Format speed and ETA if available
-                        let statusText = 'Downloading...';
-                        
-                        if (data.speed && data.speed > 0) {
-                            const speedMB = (data.speed / (1024 * 1024)).toFixed(2);
-                            statusText += ` ${speedMB} MB/s`;
-                            downloadSpeed.textContent = `Speed: ${speedMB} MB/s`;
-                        } else {
-                            downloadSpeed.textContent = 'Speed: Calculating...';
-                        }
-                        
-                        if (data.eta && data.eta > 0) {
-                            const minutes = Math.floor(data.eta / 60);
-                            const seconds = data.eta % 60;
-                            statusText += `, ETA: ${minutes}m ${seconds}s`;
-                            downloadEta.textContent = `ETA: ${minutes}m ${seconds}s`;
-                        } else {
-                            downloadEta.textContent = 'ETA: Calculating...';
-                        }
-                        
-                        if (data.downloaded_bytes && data.total_bytes) {
-                            const downloadedMB = (data.downloaded_bytes / (1024 * 1024)).toFixed(2);
-                            const totalMB = (data.total_bytes / (1024 * 1024)).toFixed(2);
-                            statusText += ` (${downloadedMB}/${totalMB} MB)`;
-                            downloadSize.textContent = `${downloadedMB}/${totalMB} MB`;
-                        } else {
-                            downloadSize.textContent = 'Size: Calculating...';
-                        }
-                        
-                        progressStatus.textContent = statusText;
-                    } else if (data.status === 'processing') {
-                        progressStatus.textContent = 'Processing video...';
-                        downloadSpeed.textContent = 'Processing...';
-                        downloadEta.textContent = 'Almost done';
-                        downloadSize.textContent = 'Finalizing file';
-                    } else if (data.status === 'complete') {
-                        // Download is complete
-                        updateProgressBar(100);
-                        
-                        // Include file size in the success message if available
-                        if (data.file_size_mb) {
-                            progressStatus.textContent = `Download complete (${data.file_size_mb} MB)! Starting file download...`;
-                            downloadSize.textContent = `Total: ${data.file_size_mb} MB`;
-                        } else {
-                            progressStatus.textContent = 'Download complete! Starting file download...';
-                            downloadSize.textContent = 'Download complete';
-                        }
-                        
-                        downloadSpeed.textContent = 'Complete';
-                        downloadEta.textContent = 'Ready';
-                        
-                        // Clear the interval
-                        clearInterval(window.progressInterval);
-                        
-                        // Trigger file download
-                        if (data.download_path) {
-                            window.location.href = data.download_path;
-                            
-                            // Show video info again after a delay
-                            setTimeout(() => {
-                                hideDownloadProgress();
-                                showVideoInfo();
-                            }, 3000);
-                        }
-                    } else if (data.status === 'error') {
-                        // Handle error
-                        clearInterval(window.progressInterval);
-                        hideDownloadProgress();
-                        showError(data.error || 'Download failed');
+        let receivedUpdate = false;
+        const source = new EventSource(`/progress/stream?${query}`);
+        window.progressSource = source;
+        
+        source.onmessage = (event) => {
+            receivedUpdate = true;
+            handleProgressUpdate(JSON.parse(event.data));
+        };
+        
+        source.onerror = () => {
+            // If the stream never worked (e.g. a proxy blocks it) fall back to long-polling,
+            // otherwise let EventSource reconnect on its own
+            if (!receivedUpdate && window.progressSource === source) {
+                source.close();
+                window.progressSource = null;
+                longPollDownloadProgress(query, -1);
+            }
+        };
+    }
+    
+    // Fallback for browsers or networks without EventSource support
+    function longPollDownloadProgress(query, since) {
+        const token = {};
+        window.progressPoll = token;
+        
+        fetch(`/progress/poll?${query}&since=${since}`)
+            .then(response => response.json())
+            .then(data => {
+                if (window.progressPoll !== token) {
+                    return;
+                }
+                handleProgressUpdate(data);
+                if (window.progressPoll === token) {
+                    longPollDownloadProgress(query, data.version);
+                }
+            })
+            .catch(error => {
+                console.error('Error polling for progress:', error);
+                // Back off briefly before trying again
+                setTimeout(() => {
+                    if (window.progressPoll === token) {
+                        longPollDownloadProgress(query, since);
                     }
-                })
-                .catch(error => {
-                    console.error('Error polling for progress:', error);
-                });
-        }, 500);
+                }, 2000);
+            });
+    }
+    
+    function stopProgressUpdates() {
+        if (window.progressSource) {
+            window.progressSource.close();
+            window.progressSource = null;
+        }
+        window.progressPoll = null;
+    }
+    
+    function handleProgressUpdate(data) {
+        // Update progress bar
+        if (data.percent) {
+            updateProgressBar(data.percent);
+        }
+        
+        // Update status message
+        if (data.status === 'queued') {
+            let statusText = 'Waiting in queue...';
+            
+            if (data.queue_position) {
+                statusText = `Queued (position ${data.queue_position})`;
+            }
+            
+            if (data.estimated_start > 0) {
+                const minutes = Math.floor(data.estimated_start / 60);
+                const seconds = Math.round(data.estimated_start % 60);
+                downloadEta.textContent = `Starts in about ${minutes}m ${seconds}s`;
+            } else {
+                downloadEta.textContent = 'Starting soon';
+            }
+            
+            progressStatus.textContent = statusText;
+            downloadSpeed.textContent = '';
+            downloadSize.textContent = '';
+        } else if (data.status === 'downloading') {
+            // Format speed and ETA if available
+            let statusText = 'Downloading...';
+            
+            if (data.speed && data.speed > 0) {
+                const speedMB = (data.speed / (1024 * 1024)).toFixed(2);
+                statusText += ` ${speedMB} MB/s`;
+                downloadSpeed.textContent = `Speed: ${speedMB} MB/s`;
+            } else {
+                downloadSpeed.textContent = 'Speed: Calculating...';
+            }
+            
+            if (data.bandwidth_allocation) {
+                // The server is sharing a limited download rate between jobs
+                const allocationMB = (data.bandwidth_allocation / (1024 * 1024)).toFixed(2);
+                downloadSpeed.textContent += ` (limit ${allocationMB} MB/s)`;
+            }
+            
+            if (data.eta && data.eta > 0) {
+                const minutes = Math.floor(data.eta / 60);
+                const seconds = data.eta % 60;
+                statusText += `, ETA: ${minutes}m ${seconds}s`;
+                downloadEta.textContent = `ETA: ${minutes}m ${seconds}s`;
+            } else {
+                downloadEta.textContent = 'ETA: Calculating...';
+            }
+            
+            if (data.downloaded_bytes && data.total_bytes) {
+                const downloadedMB = (data.downloaded_bytes / (1024 * 1024)).toFixed(2);
+                const totalMB = (data.total_bytes / (1024 * 1024)).toFixed(2);
+                statusText += ` (${downloadedMB}/${totalMB} MB)`;
+                downloadSize.textContent = `${downloadedMB}/${totalMB} MB`;
+            } else {
+                downloadSize.textContent = 'Size: Calculating...';
+            }
+            
+            progressStatus.textContent = statusText;
+        } else if (data.status === 'processing') {
+            if (data.stage === 'postprocess_queued') {
+                // Downloaded, waiting for a free post-processing slot
+                progressStatus.textContent = data.postprocess_queue_position ?
+                    `Waiting to process (position ${data.postprocess_queue_position})...` :
+                    'Waiting to process...';
+            } else if (data.source === 'local') {
+                // The audio is taken from a video this server already downloaded
+                progressStatus.textContent = 'Extracting audio from the downloaded video...';
+            } else {
+                progressStatus.textContent = 'Processing video...';
+            }
+            downloadSpeed.textContent = data.source === 'local' ? 'No download needed' : 'Processing...';
+            downloadEta.textContent = 'Almost done';
+            downloadSize.textContent = 'Finalizing file';
+        } else if (data.status === 'complete') {
+            // Download is complete
+            updateProgressBar(100);
+            
+            // Include file size in the success message if available
+            if (data.file_size_mb) {
+                progressStatus.textContent = `Download complete (${data.file_size_mb} MB)! Starting file download...`;
+                downloadSize.textContent = `Total: ${data.file_size_mb} MB`;
+            } else {
+                progressStatus.textContent = 'Download complete! Starting file download...';
+                downloadSize.textContent = 'Download complete';
+            }
+            
+            downloadSpeed.textContent = 'Complete';
+            downloadEta.textContent = 'Ready';
+            
+            // Stop listening for updates
+            stopProgressUpdates();
+            
+            // Trigger file download
+            if (data.download_path) {
+                window.location.href = data.download_path;
+                
+                // Show video info again after a delay
+                setTimeout(() => {
+                    hideDownloadProgress();
+                    showVideoInfo();
+                }, 3000);
+            }
+        } else if (data.status === 'error') {
+            // Handle error
+            stopProgressUpdates();
+            hideDownloadProgress();
+            showError(data.error || 'Download failed');
+        } else if (data.status === 'cancelled') {
+            stopProgressUpdates();
+            hideDownloadProgress();
+            showVideoInfo();
+        }
+    }
+    
+    function cancelDownload() {
+        if (!currentJobId) {
+            return;
+        }
+        
+        progressStatus.textContent = 'Cancelling...';
+        
+        fetch('/cancel_download', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ job_id: currentJobId }),
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                console.error('Error cancelling download:', data.error);
+            } else if (!data.cancelled) {
+                // Someone else is waiting for the same file, it keeps downloading for them
+                stopProgressUpdates();
+                hideDownloadProgress();
+                showVideoInfo();
+            }
+        })
+        .catch(error => {
+            console.error('Error cancelling download:', error);
+        });
     }
     
     // Helper Functions
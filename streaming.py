@@ -0,0 +1,164 @@
+import subprocess
+
+import requests
+
+from codec_plan import pair_audio
+from formats import FormatTable
+
+# Size of the pieces sent to the client while streaming
+CHUNK_SIZE = 64 * 1024
+
+# Protocols we can read as a single plain HTTP response
+DIRECT_PROTOCOLS = ('http', 'https')
+
+# Protocols ffmpeg can read from a URL by itself
+FFMPEG_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+
+MIMETYPES = {
+    'mp4': 'video/mp4',
+    'mkv': 'video/x-matroska',
+    'webm': 'video/webm',
+    'm4a': 'audio/mp4',
+    'mp3': 'audio/mpeg',
+    'opus': 'audio/ogg',
+    'ogg': 'audio/ogg',
+}
+
+
+class StreamError(Exception):
+    """Raised when a format can't be streamed"""
+
+
+def plan_stream(info_dict, format_id):
+    """Work out how to stream format_id from info_dict.
+
+    Formats that already contain everything the client needs (audio-only or
+    video with built-in audio) are passed through directly. Video-only formats
+    are muxed with an audio stream through an ffmpeg pipe, paired the same way
+    as regular downloads: fragmented MP4 or WebM when the codecs allow it and
+    Matroska otherwise.
+    """
+    table = FormatTable(info_dict)
+    if format_id not in table:
+        raise StreamError(f"Format {format_id} is not available")
+    selected = table.get(format_id)['entry']
+
+    has_video = selected.get('vcodec') != 'none'
+    has_audio = selected.get('acodec') != 'none'
+
+    if not has_video or has_audio:
+        if selected.get('protocol') not in DIRECT_PROTOCOLS:
+            raise StreamError(f"Format {format_id} can't be streamed ({selected.get('protocol')})")
+        ext = selected.get('ext', 'bin')
+        if not has_video and ext == 'webm':
+            mimetype = 'audio/webm'
+        else:
+            mimetype = MIMETYPES.get(ext, 'application/octet-stream')
+        return {
+            'mode': 'direct',
+            'formats': [selected],
+            'ext': ext,
+            'mimetype': mimetype,
+            'profile': 'stream-direct',
+        }
+
+    ext, audio = pair_audio(selected, table.audio_by_family, table.best_audio)
+    if audio is None:
+        raise StreamError('No audio stream available to merge with')
+
+    for fmt in (selected, audio):
+        if fmt.get('protocol') not in FFMPEG_PROTOCOLS:
+            raise StreamError(f"Format {fmt.get('format_id')} can't be streamed ({fmt.get('protocol')})")
+
+    muxer = {'mkv': 'matroska'}.get(ext, ext)
+    return {
+        'mode': 'ffmpeg',
+        'formats': [selected, audio],
+        'ext': ext,
+        'muxer': muxer,
+        'mimetype': MIMETYPES[ext],
+        'profile': f"stream-{ext}-copy",
+    }
+
+
+def iter_direct(fmt, chunk_size=CHUNK_SIZE):
+    """Yield the bytes of a single format straight from its URL"""
+    response = requests.get(fmt['url'], headers=fmt.get('http_headers') or {}, stream=True, timeout=30)
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+
+def ffmpeg_command(formats, muxer):
+    """ffmpeg command that stream-copies the given formats into one container on stdout"""
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for fmt in formats:
+        headers = fmt.get('http_headers') or {}
+        if headers:
+            command += ['-headers', ''.join(f"{key}: {value}\r\n" for key, value in headers.items())]
+        command += ['-i', fmt['url']]
+
+    command += ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy']
+    if muxer == 'mp4':
+        # Fragmented MP4 can be written to a pipe and played before it is complete
+        command += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+    command += ['-f', muxer, 'pipe:1']
+    return command
+
+
+def iter_ffmpeg(formats, muxer, chunk_size=CHUNK_SIZE):
+    """Yield the output of an ffmpeg process muxing the formats, killing it if the client goes away"""
+    process = subprocess.Popen(ffmpeg_command(formats, muxer), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finished = False
+    try:
+        while True:
+            # read1 returns whatever is available instead of waiting for a full chunk
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        if process.wait() != 0:
+            error = process.stderr.read().decode('utf-8', 'replace').strip()
+            raise StreamError(f"ffmpeg exited with code {process.returncode}: {error}")
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def iter_stream(plan, chunk_size=CHUNK_SIZE):
+    """Yield the bytes for a plan returned by plan_stream"""
+    if plan['mode'] == 'direct':
+        return iter_direct(plan['formats'][0], chunk_size)
+    return iter_ffmpeg(plan['formats'], plan['muxer'], chunk_size)
+
+
+def tee(chunks, path, on_complete, on_abort):
+    """Pass chunks through while also writing them to path.
+
+    on_complete(path) is called once every chunk was written, on_abort() if the
+    stream fails or the client disconnects first.
+    """
+    completed = False
+    try:
+        with open(path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        completed = True
+    finally:
+        # Make sure the source (e.g. an ffmpeg process) is stopped if the client went away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if completed:
+            on_complete(path)
+        else:
+            on_abort()
@@ -0,0 +1,125 @@
+import os
+import re
+import subprocess
+import threading
+
+import requests
+
+# Widths a thumbnail can be requested at, a fixed set keeps the number of cached variants bounded
+WIDTHS = (160, 320, 640)
+DEFAULT_WIDTH = 320
+
+# Encoder arguments and content type of each output format
+FORMATS = {
+    'webp': (['-c:v', 'libwebp', '-quality', '80'], 'image/webp'),
+    'jpeg': (['-c:v', 'mjpeg', '-q:v', '4'], 'image/jpeg'),
+}
+
+# Served when the video's metadata isn't cached, every video has one
+FALLBACK_URL = 'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg'
+
+VIDEO_ID = re.compile(r'[0-9A-Za-z_-]{11}')
+
+
+class ThumbnailError(ValueError):
+    pass
+
+
+class ThumbnailFetchError(ThumbnailError):
+    """The source image couldn't be fetched from YouTube"""
+
+
+def thumbnail_url(video_id, width=DEFAULT_WIDTH):
+    """Path of the proxied thumbnail for a video"""
+    if width == DEFAULT_WIDTH:
+        return f"/thumb/{video_id}"
+    return f"/thumb/{video_id}?w={width}"
+
+
+def pick_source(info_dict):
+    """URL of the smallest thumbnail of a video that is at least as wide as the largest variant"""
+    candidates = [t for t in info_dict.get('thumbnails') or [] if t.get('url') and t.get('width')]
+    large_enough = [t for t in candidates if t['width'] >= max(WIDTHS)]
+    if large_enough:
+        return min(large_enough, key=lambda t: t['width'])['url']
+    return info_dict.get('thumbnail') or (max(candidates, key=lambda t: t['width'])['url'] if candidates else None)
+
+
+class ThumbnailCache:
+    """Resized thumbnails kept in a MediaStore, which bounds their total size.
+
+    Each video's source image is fetched once and kept too, so every width and
+    format is made from it without going back to YouTube. Variants are made
+    with ffmpeg; if it fails the source image is served as it is.
+    """
+
+    def __init__(self, store, timeout=10):
+        self.store = store
+        self.timeout = timeout
+        # Concurrent requests for the same video wait for one fetch instead of each downloading it
+        self._locks = [threading.Lock() for _ in range(64)]
+
+    def _lock(self, video_id):
+        return self._locks[hash(video_id) % len(self._locks)]
+
+    def get(self, video_id, width=DEFAULT_WIDTH, fmt='jpeg', source_url=None):
+        """(path, content type, store key) of a thumbnail variant, made on first use"""
+        if not VIDEO_ID.fullmatch(video_id or ''):
+            raise ThumbnailError('Invalid video ID')
+        if width not in WIDTHS:
+            raise ThumbnailError(f"Width must be one of {', '.join(map(str, WIDTHS))}")
+        if fmt not in FORMATS:
+            raise ThumbnailError(f"Format must be one of {', '.join(FORMATS)}")
+
+        key = self.store.make_key(video_id, 'thumbnail', f"{width}.{fmt}")
+        entry = self.store.get(key)
+        if entry:
+            return self.store.path(entry), FORMATS[fmt][1], key
+
+        with self._lock(video_id):
+            entry = self.store.get(key, touch=False)
+            if entry:
+                return self.store.path(entry), FORMATS[fmt][1], key
+
+            source_key = self.store.make_key(video_id, 'thumbnail', 'source')
+            source = self.store.get(source_key, touch=False) or self._fetch(video_id, source_key, source_url)
+            try:
+                entry = self._resize(self.store.path(source), key, width, fmt)
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"Error resizing thumbnail of {video_id}, serving it as it is: {str(e)}")
+                return self.store.path(source), source.get('content_type', 'image/jpeg'), source_key
+        return self.store.path(entry), FORMATS[fmt][1], key
+
+    def _fetch(self, video_id, key, source_url):
+        url = source_url or FALLBACK_URL.format(video_id=video_id)
+        try:
+            response = requests.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise ThumbnailFetchError(f"Could not fetch thumbnail: {str(e)}")
+
+        content_type = response.headers.get('Content-Type', 'image/jpeg').split(';')[0]
+        if not content_type.startswith('image/'):
+            raise ThumbnailFetchError('Thumbnail URL did not return an image')
+        path = os.path.join(self.store.staging_dir(key), f"source.{content_type.split('/')[1]}")
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        return self.store.publish(key, path, video_id=video_id, content_type=content_type)
+
+    def _resize(self, source_path, key, width, fmt):
+        codec_args, _ = FORMATS[fmt]
+        path = os.path.join(self.store.staging_dir(key), f"thumbnail.{fmt}")
+        try:
+            # Never scale up, and keep the height even for the encoders that need it
+            subprocess.run(
+                ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path,
+                 '-vf', f"scale='min({width},iw)':-2", '-frames:v', '1', *codec_args, path],
+                check=True, capture_output=True, timeout=30
+            )
+        except subprocess.CalledProcessError as e:
+            self.store.discard_staging(key)
+            raise subprocess.SubprocessError(e.stderr.decode('utf-8', 'replace').strip() or str(e))
+        except (OSError, subprocess.SubprocessError):
+            self.store.discard_staging(key)
+            raise
+        return self.store.publish(key, path, content_type=FORMATS[fmt][1])
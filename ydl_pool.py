@@ -0,0 +1,204 @@
+import copy
+import random
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Per-use state of a YoutubeDL, cleared every time an instance goes back to the pool
+_COUNTERS = {
+    '_download_retcode': 0,
+    '_num_downloads': 0,
+    '_num_videos': 0,
+    '_playlist_level': 0,
+}
+
+# YoutubeDL internals _configure resets, none of them public API. An instance missing any of them
+# means yt-dlp changed, and the pool falls back to building a new instance for every checkout
+_INTERNALS = (
+    *_COUNTERS, '_parse_outtmpl', 'build_format_selector', 'format_selector', '_progress_hooks',
+    '_post_hooks', '_postprocessor_hooks', '_pps', '_playlist_urls', '_printed_messages',
+)
+
+
+def _snapshot(params):
+    """Copy of a YoutubeDL's params, one level deep so the pristine copy isn't changed through nested dicts"""
+    return {key: copy.copy(value) for key, value in params.items()}
+
+
+class YoutubeDLPool:
+    """Reusable YoutubeDL instances, kept per option profile.
+
+    Constructing a YoutubeDL registers every extractor, and each one opens its
+    own HTTP connections, so building one per request costs tens of
+    milliseconds plus new TLS handshakes to YouTube. Instances checked out of
+    the pool keep their extractors (and what those have learned, such as
+    YouTube's player code) and their HTTP session between requests.
+
+    ``profiles`` maps a profile name to a function returning its base options.
+    ``checkout`` applies the options of one use on top of them and resets the
+    instance afterwards, so hooks, output templates and counters never leak
+    from one job into the next. Each checkout gets a user agent picked from
+    ``user_agents``. Instances that raised are closed rather than reused, and
+    instances are replaced after ``max_uses`` checkouts to start over with a
+    fresh session and cookies. At most ``max_idle`` instances per profile are
+    kept; the pool never blocks, it creates another instance when none is free.
+    Resetting an instance relies on yt-dlp internals. When the installed yt-dlp
+    doesn't have them, every checkout gets a new instance built with its
+    options instead.
+    """
+
+    def __init__(self, profiles, user_agents=(), max_idle=8, max_uses=100):
+        self.profiles = profiles
+        self.user_agents = list(user_agents)
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self._idle = defaultdict(list)
+        self._stats = defaultdict(lambda: {'created': 0, 'reused': 0, 'discarded': 0})
+        self._lock = threading.Lock()
+        # Whether instances can be reset and reused, known once the first one was created
+        self.reusable = None
+
+    @contextmanager
+    def checkout(self, profile, **options):
+        """Borrow an instance of profile configured with options, for the body of a with block"""
+        ydl = None if self.reusable is False else self._take(profile)
+        if not self.reusable:
+            if ydl is not None:
+                self._discard(profile, ydl)
+            with self._single_use(profile, options) as ydl:
+                yield ydl
+            return
+
+        try:
+            self._configure(ydl, options)
+        except Exception:
+            self._discard(profile, ydl)
+            raise
+
+        try:
+            yield ydl
+        except BaseException:
+            # A failed or cancelled download can leave a connection half read, start over with a new instance
+            self._discard(profile, ydl)
+            raise
+        self._release(profile, ydl)
+
+    def _take(self, profile):
+        if profile not in self.profiles:
+            raise ValueError(f"Unknown YoutubeDL profile: {profile}")
+        with self._lock:
+            if self._idle[profile]:
+                self._stats[profile]['reused'] += 1
+                return self._idle[profile].pop()
+            self._stats[profile]['created'] += 1
+
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(self.profiles[profile]())
+        ydl._pool_params = _snapshot(ydl.params)
+        ydl._pool_uses = 0
+        if self.reusable is None:
+            missing = [name for name in _INTERNALS if not hasattr(ydl, name)]
+            self.reusable = not missing
+            if missing:
+                print(f"yt-dlp {yt_dlp.version.__version__} lacks {', '.join(missing)}, "
+                      f"YoutubeDL instances won't be reused")
+        return ydl
+
+    @contextmanager
+    def _single_use(self, profile, options):
+        """A new instance built with the profile's options and options, closed after the with block"""
+        import yt_dlp
+        params = dict(self.profiles[profile](), **options)
+        if self.user_agents:
+            params['http_headers'] = dict(params.get('http_headers') or {}, **{'User-Agent': random.choice(self.user_agents)})
+        with self._lock:
+            self._stats[profile]['created'] += 1
+        ydl = yt_dlp.YoutubeDL(params)
+        try:
+            yield ydl
+        finally:
+            self._discard(profile, ydl)
+
+    def _configure(self, ydl, options):
+        """Restore the profile's options, then apply options the same way YoutubeDL.__init__ would"""
+        params = ydl.params
+        params.clear()
+        params.update(_snapshot(ydl._pool_params))
+        params.update({key: value for key, value in options.items() if not key.endswith('hooks') and key != 'postprocessors'})
+        if params.get('overwrites') is not None:
+            params['nooverwrites'] = not params['overwrites']
+        ydl._parse_outtmpl()
+        ydl.format_selector = (
+            params.get('format') if params.get('format') in (None, '-')
+            else params['format'] if callable(params['format'])
+            else ydl.build_format_selector(params['format']))
+
+        ydl._progress_hooks = []
+        ydl._post_hooks = []
+        ydl._postprocessor_hooks = []
+        ydl._pps = {when: [] for when in ydl._pps}
+        for hook in options.get('progress_hooks', []):
+            ydl.add_progress_hook(hook)
+        for hook in options.get('post_hooks', []):
+            ydl.add_post_hook(hook)
+        for hook in options.get('postprocessor_hooks', []):
+            ydl.add_postprocessor_hook(hook)
+        if options.get('postprocessors'):
+            from yt_dlp.postprocessor import get_postprocessor
+            for pp_def in map(dict, options['postprocessors']):
+                when = pp_def.pop('when', 'post_process')
+                ydl.add_post_processor(get_postprocessor(pp_def.pop('key'))(ydl, **pp_def), when=when)
+
+        for name, value in _COUNTERS.items():
+            setattr(ydl, name, value)
+        ydl._playlist_urls = set()
+        ydl._printed_messages = set()
+
+        if self.user_agents:
+            self._set_user_agent(ydl, random.choice(self.user_agents))
+        ydl._pool_uses += 1
+
+    @staticmethod
+    def _set_user_agent(ydl, user_agent):
+        ydl.params['http_headers']['User-Agent'] = user_agent
+        # The request handlers copied the headers when they were created, extractor requests use their copy
+        if '_request_director' in ydl.__dict__:
+            for handler in ydl._request_director.handlers.values():
+                handler.headers['User-Agent'] = user_agent
+
+    def _release(self, profile, ydl):
+        # Drop the job's hooks now, they hold on to the job until the instance is used again
+        try:
+            self._configure(ydl, {})
+        except Exception:
+            self._discard(profile, ydl)
+            return
+
+        with self._lock:
+            if ydl._pool_uses < self.max_uses and len(self._idle[profile]) < self.max_idle:
+                self._idle[profile].append(ydl)
+                return
+        self._discard(profile, ydl)
+
+    def _discard(self, profile, ydl):
+        with self._lock:
+            self._stats[profile]['discarded'] += 1
+        try:
+            ydl.close()
+        except Exception as e:
+            print(f"Error closing YoutubeDL: {str(e)}")
+
+    def close(self):
+        """Close every idle instance"""
+        with self._lock:
+            idle = [(profile, ydl) for profile, instances in self._idle.items() for ydl in instances]
+            self._idle.clear()
+        for profile, ydl in idle:
+            self._discard(profile, ydl)
+
+    def stats(self):
+        with self._lock:
+            return {
+                profile: dict(self._stats[profile], idle=len(self._idle[profile]))
+                for profile in self.profiles
+            }